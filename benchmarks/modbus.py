@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# modbus round trip benchmark: time of one request and its answer through every
+# transport, on a simulated bus (see simulator.py) or on a probe with --port
+#
+#   python benchmarks/modbus.py --save modbus.json
+#   python benchmarks/modbus.py --port /dev/ttyUSB2 -a 1 --baseline modbus.json
+import os
+import sys
+import json
+import argparse
+import statistics
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simulator
+import utils
+
+# registers read to make the probe answer with an exception frame, more than any
+# probe firmware exposes
+EXCEPTION_REGISTERS = 100
+
+
+def _read_status(instr):
+    utils.modbus_get_status(instr)
+
+
+def _write_command(instr):
+    utils.modbus_set_cmd(instr, 0)
+
+
+def _read_exception(instr):
+    import minimalmodbus
+
+    try:
+        with utils.modbus_transaction(instr):
+            instr.read_registers(instr.registers.status, EXCEPTION_REGISTERS)
+    except minimalmodbus.SlaveReportedException:
+        pass
+
+
+OPERATIONS = {
+    "status": _read_status,
+    "command": _write_command,
+    "exception": _read_exception,
+}
+
+
+def run_transport(serial_port, slave_address, transport, args):
+    settings = utils.ModbusSettings(args.baudrate, args.timeout, transport)
+    instr = utils.modbus_connect(serial_port, slave_address, settings)
+    results = {}
+    try:
+        for name, operation in OPERATIONS.items():
+            for _ in range(args.warm_up):
+                operation(instr)
+            times = []
+            for _ in range(args.transactions):
+                start = time.perf_counter()
+                operation(instr)
+                times.append(time.perf_counter() - start)
+            times.sort()
+            results[name] = {
+                "p50": statistics.median(times),
+                "p95": times[min(len(times) - 1, int(len(times) * 0.95))],
+                "mean": statistics.mean(times),
+            }
+    finally:
+        utils.modbus_pool.close_all()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="modbus round trip benchmark")
+    parser.add_argument("-p", "--port", help="modbus serial port, simulated if none")
+    parser.add_argument("-a", "--address", type=int, default=1, help="slave address")
+    parser.add_argument(
+        "--baudrate", type=int, default=utils.MODBUS_SETTINGS_DEFAULT.baudrate
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=utils.MODBUS_SETTINGS_DEFAULT.timeout
+    )
+    parser.add_argument(
+        "--response-delay",
+        type=float,
+        default=0.002,
+        help="processing time of the simulated probe",
+    )
+    parser.add_argument("-n", "--transactions", type=int, default=200)
+    parser.add_argument("--warm-up", type=int, default=10)
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON")
+    parser.add_argument(
+        "--baseline", metavar="FILE", help="fail on a regression against this run"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed increase of the round trip time, 0.2 is 20%%",
+    )
+    args = parser.parse_args(argv)
+
+    bus = None
+    serial_port = args.port
+    if serial_port is None:
+        bus = simulator.ModbusBusSimulator(
+            {args.address: simulator.SimulatedProbe()},
+            baudrate=args.baudrate,
+            response_delay=args.response_delay,
+        )
+        serial_port = bus.start()
+
+    results = {}
+    try:
+        for transport in utils.MODBUS_TRANSPORTS:
+            results[transport] = run_transport(
+                serial_port, args.address, transport, args
+            )
+    finally:
+        if bus:
+            bus.stop()
+
+    reference = results[utils.MODBUS_TRANSPORT_MINIMALMODBUS]
+    for transport, operations in results.items():
+        for name, result in operations.items():
+            print(
+                f"{transport:>13} {name:>9}: p50 {result['p50'] * 1000:.2f} ms "
+                f"p95 {result['p95'] * 1000:.2f} ms, "
+                f"{reference[name]['p50'] / result['p50']:.1f}x"
+            )
+
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = [
+            (transport, name)
+            for transport, operations in results.items()
+            for name, result in operations.items()
+            if name in baseline.get(transport, {})
+            and result["p50"] > baseline[transport][name]["p50"] * (1 + args.tolerance)
+        ]
+        for transport, name in regressions:
+            print(
+                f"{transport} {name}: regression, "
+                f"{results[transport][name]['p50'] * 1000:.2f} ms "
+                f"against {baseline[transport][name]['p50'] * 1000:.2f} ms",
+                file=sys.stderr,
+            )
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
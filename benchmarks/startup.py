@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# cold start benchmark: import time of main.py and time to the first frame of the
+# window, each measured in a fresh interpreter
+#
+#   python benchmarks/startup.py --save startup.json
+#   python benchmarks/startup.py --baseline startup.json
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+"""
+
+# the window is closed as soon as it is mapped, the time is measured by the parent
+# from the spawn of the interpreter, like an operator launching the tester. The
+# logs, results and metrics of the run go to a temporary folder, not to the repo
+FIRST_FRAME_SCRIPT = """
+import os
+import tempfile
+import main
+with tempfile.TemporaryDirectory() as log_directory:
+    main.LOG_DIRECTORY = log_directory
+    main.RESULTS_DATABASE = os.path.join(log_directory, "results.sqlite3")
+    main.METRICS_FILE = os.path.join(log_directory, "metrics.json")
+    app = main.App()
+    def handle_map(event):
+        if event.widget is app:
+            print("mapped", flush=True)
+            app.after_idle(app.handle_close)
+    app.bind("<Map>", handle_map, add="+")
+    app.mainloop()
+"""
+
+
+def _run(script):
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    elapsed = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+    return completed.stdout, elapsed
+
+
+def measure_import():
+    stdout, _ = _run(IMPORT_SCRIPT)
+    return float(stdout.split()[-1])
+
+
+def measure_first_frame():
+    stdout, elapsed = _run(FIRST_FRAME_SCRIPT)
+    if "mapped" not in stdout:
+        raise RuntimeError("the window was never mapped")
+    return elapsed
+
+
+def _summary(samples):
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "max": max(samples),
+        "samples": len(samples),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="cold start benchmark")
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON")
+    parser.add_argument(
+        "--baseline", metavar="FILE", help="fail on a regression against this run"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed slowdown of the medians, 0.2 is 20%%",
+    )
+    args = parser.parse_args(argv)
+
+    benchmarks = {"import": measure_import, "first_frame": measure_first_frame}
+    results = {}
+    for name, measure in benchmarks.items():
+        try:
+            results[name] = _summary([measure() for _ in range(args.repeat)])
+        except RuntimeError as error:
+            # e.g. no display for the first frame
+            print(f"{name}: skipped, {error}", file=sys.stderr)
+            continue
+        print(f"{name}: median {results[name]['median'] * 1000:.0f} ms")
+
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = [
+            name
+            for name, result in results.items()
+            if name in baseline
+            and result["median"] > baseline[name]["median"] * (1 + args.tolerance)
+        ]
+        for name in regressions:
+            print(
+                f"{name}: regression, {results[name]['median'] * 1000:.0f} ms "
+                f"against {baseline[name]['median'] * 1000:.0f} ms",
+                file=sys.stderr,
+            )
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+# station benchmark: flash and test of simulated devices through the pipeline,
+# with 1 to 32 stations at the same time. Every station has its own simulated UPDI
+# adapter and modbus bus, see simulator.py
+#
+#   python benchmarks/stations.py --save stations.json
+#   python benchmarks/stations.py --baseline stations.json
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import statistics
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import metrics
+import pipeline
+import simulator
+import utils
+
+# bytes of the generated firmware, about the size of the probe application
+FIRMWARE_SIZE = 1536
+
+
+def _write_firmware(filename, size, seed=0):
+    from intelhex import IntelHex
+
+    rng = random.Random(seed)
+    hexfile = IntelHex()
+    hexfile.frombytes(bytes(rng.randrange(256) for _ in range(size)))
+    hexfile.write_hex_file(filename)
+
+
+def run_stations(filename, stations, devices, args):
+    rng = random.Random(stations)
+    buses = []
+    duts = []
+    metrics.cycle_metrics.reset()
+
+    for station in range(stations):
+        flash_port = f"{simulator.SIMULATOR_PORT_PREFIX}updi{station}"
+        simulator.simulated_updi_targets[flash_port] = simulator.SimulatedUpdiTarget(
+            failure_rate=args.failure_rate, rng=rng
+        )
+        bus = simulator.ModbusBusSimulator(
+            {
+                address: simulator.SimulatedProbe(
+                    init_time=args.init_time,
+                    test_time=args.test_time,
+                    failure_rate=args.failure_rate,
+                    rng=rng,
+                )
+                for address in range(1, devices + 1)
+            }
+        )
+        test_port = bus.start()
+        buses.append(bus)
+        duts += [
+            pipeline.Dut(
+                flash_port,
+                test_port,
+                address,
+                filename,
+                {"incremental": args.incremental, "verify": args.verify},
+                args.deadline,
+            )
+            for address in range(1, devices + 1)
+        ]
+
+    start = time.monotonic()
+    flash_pipeline = pipeline.Pipeline()
+    # one device at a time per station, like an operator loading the fixture
+    for index in range(devices):
+        for dut in duts[index::devices]:
+            flash_pipeline.submit(dut)
+    flash_pipeline.close()
+    elapsed = time.monotonic() - start
+
+    utilization = statistics.mean(bus.get_utilization() for bus in buses)
+    for bus in buses:
+        bus.stop()
+    for station in range(stations):
+        simulator.simulated_updi_targets.pop(
+            f"{simulator.SIMULATOR_PORT_PREFIX}updi{station}", None
+        )
+
+    cycles = sorted(
+        dut.times[dut.stage] - dut.times[pipeline.DutStage.FLASHING] for dut in duts
+    )
+    passed = sum(dut.stage == pipeline.DutStage.PASSED for dut in duts)
+    return {
+        "stations": stations,
+        "units": len(duts),
+        "passed": passed,
+        "elapsed": elapsed,
+        "units_per_hour": len(duts) * 3600 / elapsed,
+        "cycle_p50": statistics.median(cycles),
+        "cycle_p95": cycles[min(len(cycles) - 1, int(len(cycles) * 0.95))],
+        "bus_utilization": utilization,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="simulated station benchmark")
+    parser.add_argument(
+        "-s",
+        "--stations",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8, 16, 32],
+        help="station counts to run",
+    )
+    parser.add_argument(
+        "-d", "--devices", type=int, default=4, help="devices per station"
+    )
+    parser.add_argument("--init-time", type=float, default=0.1)
+    parser.add_argument("--test-time", type=float, default=0.5)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--deadline", type=float, default=10)
+    parser.add_argument("-i", "--incremental", action="store_true")
+    parser.add_argument(
+        "--verify", choices=utils.VERIFY_MODES, default=utils.VERIFY_READBACK
+    )
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON")
+    parser.add_argument(
+        "--baseline", metavar="FILE", help="fail on a regression against this run"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed loss of throughput, 0.2 is 20%%",
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "firmware.hex")
+        _write_firmware(filename, FIRMWARE_SIZE)
+
+        for stations in args.stations:
+            result = run_stations(filename, stations, args.devices, args)
+            if results:
+                # throughput per station against the smallest run
+                first = next(iter(results.values()))
+                result["scaling"] = (result["units_per_hour"] / stations) / (
+                    first["units_per_hour"] / first["stations"]
+                )
+            else:
+                result["scaling"] = 1.0
+            results[str(stations)] = result
+            print(
+                f"{stations:2} stations: {result['passed']}/{result['units']} passed, "
+                f"{result['units_per_hour']:.0f} units/h, "
+                f"cycle p50 {result['cycle_p50']:.2f} s p95 {result['cycle_p95']:.2f} s, "
+                f"bus {result['bus_utilization'] * 100:.1f}%, "
+                f"scaling {result['scaling'] * 100:.0f}%"
+            )
+
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = [
+            name
+            for name, result in results.items()
+            if name in baseline
+            and result["units_per_hour"]
+            < baseline[name]["units_per_hour"] * (1 - args.tolerance)
+        ]
+        for name in regressions:
+            print(
+                f"{name} stations: regression, "
+                f"{results[name]['units_per_hour']:.0f} units/h "
+                f"against {baseline[name]['units_per_hour']:.0f} units/h",
+                file=sys.stderr,
+            )
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,485 @@
+#!/usr/bin/python3
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+import utils
+import results
+import metrics
+import pipeline
+import profiles
+import serialtrace
+
+EXIT_SUCCESS = 0
+# at least one device failed
+EXIT_FAILURE = 1
+# invalid arguments, same as argparse
+EXIT_USAGE = 2
+
+STATE_NAMES = {
+    utils.TestState.INIT: "init",
+    utils.TestState.IN_PROGRESS: "in_progress",
+    utils.TestState.FAILED: "failed",
+    utils.TestState.SUCCESS: "success",
+}
+
+
+def get_flash_result(serial_port, success, duration):
+    return {
+        "operation": "flash",
+        "port": serial_port,
+        "success": success,
+        "duration": round(duration, 3),
+    }
+
+
+def get_test_result(serial_port, slave_address, result, duration):
+    test_result = {
+        "operation": "test",
+        "port": serial_port,
+        "address": slave_address,
+        "success": False,
+        "duration": round(duration, 3),
+    }
+
+    if isinstance(result, utils.ProbeStatus):
+        test_result.update(result._asdict())
+        test_result["state"] = STATE_NAMES.get(result.state, "unknown")
+        test_result["success"] = result.state == utils.TestState.SUCCESS
+        if result.firmware_version is not None:
+            test_result["firmware_version"] = utils.format_firmware_version(
+                result.firmware_version
+            )
+    elif isinstance(result, TimeoutError):
+        test_result.update(state="timeout", error=str(result))
+    else:
+        test_result.update(state="error", error=str(result))
+
+    return test_result
+
+
+def _flash(filename, serial_ports, options, result_store=None):
+    # ports may wait for a free worker, time each one from its first stage
+    starts = {}
+    durations = {}
+    reports = {}
+
+    def handle_progress(serial_port, stage):
+        starts.setdefault(serial_port, time.monotonic())
+
+    def handle_result(serial_port, success):
+        durations[serial_port] = time.monotonic() - starts[serial_port]
+        if result_store:
+            result_store.record(results.flash_row(serial_port, reports[serial_port]))
+
+    flash_results = utils.flash_file_batch(
+        filename,
+        serial_ports,
+        handle_progress,
+        handle_result,
+        reports=reports,
+        **options,
+    )
+    return [
+        get_flash_result(
+            serial_port, flash_results[serial_port], durations[serial_port]
+        )
+        for serial_port in serial_ports
+    ]
+
+
+def _test(buses, deadline, test_options, result_store=None):
+    start = time.monotonic()
+    test_results = []
+    transitions = {}
+    # (serial port, slave address) -> seconds from the start of the probe
+    durations = {}
+
+    def handle_state(serial_port, slave_address, status):
+        transitions.setdefault((serial_port, slave_address), []).append(
+            (time.monotonic() - start, status.state)
+        )
+
+    def handle_result(serial_port, slave_address, result):
+        duration = durations[(serial_port, slave_address)]
+        test_results.append(
+            get_test_result(serial_port, slave_address, result, duration)
+        )
+        if result_store:
+            result_store.record(
+                results.test_row(
+                    serial_port,
+                    slave_address,
+                    result,
+                    duration,
+                    transitions.get((serial_port, slave_address), ()),
+                )
+            )
+
+    utils.modbus_test_buses(
+        buses, handle_state, handle_result, deadline, durations, **test_options
+    )
+    return sorted(test_results, key=lambda result: (result["port"], result["address"]))
+
+
+def _flash_and_test(
+    filename, duts, flash_options, deadline, test_options, result_store=None
+):
+    # every device is tested as soon as it is flashed, while the next one on the
+    # same adapter is being flashed
+    def handle_event(dut):
+        if not result_store:
+            return
+        if dut.stage in (pipeline.DutStage.FLASH_FAILED, pipeline.DutStage.TEST_QUEUED):
+            result_store.record(results.flash_row(dut.flash_port, dut.report))
+        elif dut.stage in pipeline.DutStage.DONE:
+            # the test row is traced back to the flashed device
+            result_store.record(
+                results.test_row(
+                    dut.test_port,
+                    dut.slave_address,
+                    dut.result,
+                    dut.get_test_duration(),
+                    dut.transitions,
+                    device_id=dut.report.get("device_id"),
+                    firmware_file=dut.report.get("firmware_file"),
+                    firmware_sha256=dut.report.get("firmware_sha256"),
+                )
+            )
+
+    flash_pipeline = pipeline.Pipeline(handle_event)
+    duts = [
+        pipeline.Dut(
+            flash_port,
+            test_port,
+            slave_address or utils.MODBUS_SLAVE_ADDRESS_DEFAULT,
+            filename,
+            flash_options,
+            deadline,
+            test_options,
+        )
+        for flash_port, test_port, slave_address in duts
+    ]
+    for dut in duts:
+        flash_pipeline.submit(dut)
+    flash_pipeline.close()
+
+    flash_results = [
+        get_flash_result(
+            dut.flash_port, dut.report["success"], dut.get_flash_duration()
+        )
+        for dut in duts
+    ]
+    # only the devices flashed succesfully are tested
+    test_results = [
+        get_test_result(
+            dut.test_port, dut.slave_address, dut.result, dut.get_test_duration()
+        )
+        for dut in duts
+        if dut.report["success"]
+    ]
+    return flash_results + sorted(
+        test_results, key=lambda result: (result["port"], result["address"])
+    )
+
+
+def parse_dut(text):
+    # "flash port,test port[,slave address]"
+    parts = text.split(",")
+    if len(parts) not in (2, 3) or not all(parts):
+        raise argparse.ArgumentTypeError(f"invalid device under test: {text}")
+    try:
+        slave_address = int(parts[2]) if len(parts) == 3 else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid slave address: {parts[2]}")
+    return parts[0], parts[1], slave_address
+
+
+def _parse_addresses(text):
+    try:
+        return utils.parse_slave_addresses(text)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+def _parse_speed(text):
+    if text == utils.UPDI_BAUDRATE_AUTO:
+        return text
+    try:
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid speed: {text}")
+
+
+def _parse_profile(text):
+    # "name" or "name:version"
+    name, _, version = text.partition(":")
+    try:
+        return name, int(version) if version else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid profile version: {version}")
+
+
+def _parse_timeout(text):
+    try:
+        timeout = float(text)
+    except ValueError:
+        timeout = 0
+    if timeout <= 0:
+        raise argparse.ArgumentTypeError(f"invalid timeout: {text}")
+    return timeout
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(
+        description="coffe probe tester, headless batch runner",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="log pymcuprog to stderr"
+    )
+    parser.add_argument(
+        "--results", metavar="FILE", help="also store the results in this database"
+    )
+    parser.add_argument(
+        "--metrics", metavar="FILE", help="write the phase timings to this file"
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="DIRECTORY",
+        help="record the serial traffic of every port to this directory",
+    )
+    parser.add_argument(
+        "--profile",
+        type=_parse_profile,
+        metavar="NAME[:VERSION]",
+        help="station profile, the defaults of every other option",
+    )
+    parser.add_argument(
+        "--profiles",
+        metavar="DIRECTORY",
+        default=profiles.PROFILES_DIRECTORY,
+        help="directory of the profiles",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    flash_arguments = argparse.ArgumentParser(add_help=False)
+    flash_arguments.add_argument(
+        "-f", "--file", help="Intel HEX file, required without a profile"
+    )
+    flash_arguments.add_argument(
+        "--incremental",
+        action="store_true",
+        help="skip erase/write of the content already on the device",
+    )
+    flash_arguments.add_argument(
+        "--speed",
+        type=_parse_speed,
+        help=f"UPDI baud rate or {utils.UPDI_BAUDRATE_AUTO}, "
+        f"default {utils.UPDI_BAUDRATE_DEFAULT}",
+    )
+    flash_arguments.add_argument(
+        "--verify",
+        choices=utils.VERIFY_MODES,
+        help="read the flash back, or compare the CRC computed by the device "
+        f"and read back every {utils.VERIFY_AUDIT_INTERVAL}th device, "
+        f"default {utils.VERIFY_READBACK}",
+    )
+
+    test_arguments = argparse.ArgumentParser(add_help=False)
+    test_arguments.add_argument(
+        "--timeout",
+        type=_parse_timeout,
+        help="fail a probe without a result after this many seconds",
+    )
+    test_arguments.add_argument(
+        "--transport",
+        choices=utils.MODBUS_TRANSPORTS,
+        help="modbus requests through minimalmodbus or the faster rtu transport",
+    )
+
+    flash_parser = commands.add_parser(
+        "flash", parents=[flash_arguments], help="flash one or more UPDI ports"
+    )
+    flash_parser.add_argument(
+        "-p", "--port", action="append", required=True, help="UPDI serial port"
+    )
+
+    test_parser = commands.add_parser(
+        "test", parents=[test_arguments], help="test the probes on modbus ports"
+    )
+    test_parser.add_argument(
+        "-p", "--port", action="append", required=True, help="modbus serial port"
+    )
+    test_parser.add_argument(
+        "-a",
+        "--address",
+        type=_parse_addresses,
+        help="slave addresses on every port, e.g. 1-8, "
+        f"default {utils.MODBUS_SLAVE_ADDRESS_DEFAULT}",
+    )
+
+    flash_and_test_parser = commands.add_parser(
+        "flash-and-test",
+        parents=[flash_arguments, test_arguments],
+        help="flash the devices and test each one as soon as it is flashed",
+    )
+    flash_and_test_parser.add_argument(
+        "-d",
+        "--dut",
+        type=parse_dut,
+        action="append",
+        required=True,
+        help="FLASH_PORT,TEST_PORT[,SLAVE_ADDRESS] of a device under test, "
+        "the devices on a bus take the profile addresses in turn by default",
+    )
+
+    return parser
+
+
+def _assign_slave_addresses(duts, slave_addresses):
+    # the devices without an address take the next free one on their bus
+    free_addresses = {}
+    for _, test_port, slave_address in duts:
+        free_addresses.setdefault(test_port, list(slave_addresses))
+        if slave_address in free_addresses[test_port]:
+            free_addresses[test_port].remove(slave_address)
+
+    assigned_duts = []
+    for flash_port, test_port, slave_address in duts:
+        if slave_address is None:
+            if not free_addresses[test_port]:
+                raise ValueError(f"no slave address left for {flash_port}")
+            slave_address = free_addresses[test_port].pop(0)
+        assigned_duts.append((flash_port, test_port, slave_address))
+    return assigned_duts
+
+
+def _apply_profile(args, profile):
+    # the options given on the command line win over the profile
+    flash_options = {"device": utils.UPDI_DEVICE_DEFAULT}
+    test_options = {}
+    if profile:
+        flash_options = profile.get_flash_options()
+        test_options = profile.get_test_options()
+
+    if args.command in ("flash", "flash-and-test"):
+        args.file = args.file or (profile and profile.firmware)
+        if args.speed is not None:
+            flash_options["baudrate"] = args.speed
+        flash_options.setdefault("baudrate", utils.UPDI_BAUDRATE_DEFAULT)
+        if args.verify is not None:
+            flash_options["verify"] = args.verify
+        flash_options["incremental"] = args.incremental or flash_options.get(
+            "incremental", False
+        )
+    if args.command in ("test", "flash-and-test"):
+        if args.timeout is None and profile:
+            args.timeout = profile.deadline
+        if args.transport is not None:
+            settings = test_options.get("settings", utils.MODBUS_SETTINGS_DEFAULT)
+            test_options["settings"] = settings._replace(transport=args.transport)
+    if args.command == "test" and args.address is None:
+        args.address = (
+            profile.slave_addresses if profile else [utils.MODBUS_SLAVE_ADDRESS_DEFAULT]
+        )
+    if args.command == "flash-and-test" and profile:
+        args.dut = _assign_slave_addresses(args.dut, profile.slave_addresses)
+
+    return flash_options, test_options
+
+
+def _run(args, flash_options, test_options, result_store=None):
+    run_results = []
+    if args.command == "flash":
+        run_results = _flash(args.file, args.port, flash_options, result_store)
+    elif args.command == "test":
+        buses = {port: args.address for port in args.port}
+        run_results = _test(buses, args.timeout, test_options, result_store)
+    elif args.command == "flash-and-test":
+        run_results = _flash_and_test(
+            args.file,
+            args.dut,
+            flash_options,
+            args.timeout,
+            test_options,
+            result_store,
+        )
+
+    return run_results
+
+
+def main(argv=None):
+    args = _build_parser().parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(stream=sys.stderr, format="%(levelname)s: %(message)s")
+        logging.getLogger("pymcuprog").setLevel(logging.INFO)
+        utils.logger.setLevel(logging.INFO)
+
+    if args.trace:
+        serialtrace.serial_capture.start(args.trace)
+
+    profile = None
+    if args.profile:
+        try:
+            profile = profiles.ProfileRegistry(args.profiles).get(*args.profile)
+        except profiles.ProfileError as error:
+            print(error, file=sys.stderr)
+            return EXIT_USAGE
+    try:
+        flash_options, test_options = _apply_profile(args, profile)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return EXIT_USAGE
+
+    if args.command in ("flash", "flash-and-test"):
+        if not args.file:
+            print("a firmware file or a profile is required", file=sys.stderr)
+            return EXIT_USAGE
+        if not os.path.isfile(args.file):
+            print(f"no such file: {args.file}", file=sys.stderr)
+            return EXIT_USAGE
+
+    if profile:
+        flash_ports = []
+        if args.command == "flash":
+            flash_ports = args.port
+        elif args.command == "flash-and-test":
+            flash_ports = [flash_port for flash_port, _, _ in args.dut]
+        try:
+            profile.prepare(flash_ports)
+        except profiles.ProfileError as error:
+            print(error, file=sys.stderr)
+            return EXIT_USAGE
+
+    result_store = None
+    if args.results:
+        result_store = results.ResultStore(args.results)
+
+    # stdout is reserved to the json results, errors are printed to stderr
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            run_results = _run(args, flash_options, test_options, result_store)
+    finally:
+        if result_store:
+            result_store.close()
+        if args.metrics:
+            metrics.cycle_metrics.export(args.metrics)
+
+    success = all(result["success"] for result in run_results)
+    json.dump(
+        {"command": args.command, "success": success, "results": run_results},
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+
+    return EXIT_SUCCESS if success else EXIT_FAILURE
+
+
+if __name__ == "__main__":
+    sys.exit(main())
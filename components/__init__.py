@@ -1,3 +1,4 @@
+from .dashboard import *
 from .flasharg import *
 from .output import *
 from .testarg import *
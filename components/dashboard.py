@@ -0,0 +1,132 @@
+import tkinter as tk
+from tkinter import ttk
+from tkinter import filedialog
+
+import metrics
+
+# milliseconds between two refreshes of the table
+DASHBOARD_REFRESH_INTERVAL = 1000
+
+
+def _format_seconds(seconds):
+    return "-" if seconds is None else f"{seconds:.2f}s"
+
+
+class Dashboard(ttk.Labelframe):
+    COLUMNS = (
+        ("operation", "Operation", 70),
+        ("station", "Station", 110),
+        ("units", "Units", 50),
+        ("yield", "Yield", 60),
+        ("rate", "Units/h", 60),
+        ("p50", "Cycle p50", 70),
+        ("p95", "Cycle p95", 70),
+        ("slowest", "Slowest phase (p95)", 130),
+    )
+
+    def __init__(self, root, parent):
+        self.root = root
+        self.parent = parent
+
+        # container
+        super().__init__(
+            self.parent,
+            text="Throughput",
+            style="custom.TLabelframe",
+            padding=(12, 2, 12, 15),
+        )
+
+        # one row per operation and station
+        self.table = ttk.Treeview(
+            self,
+            columns=[name for name, _, _ in self.COLUMNS],
+            show="headings",
+            height=4,
+        )
+        for name, text, width in self.COLUMNS:
+            self.table.heading(name, text=text)
+            self.table.column(name, width=width, stretch=True)
+        self.table_scrollbar = ttk.Scrollbar(
+            self, orient=tk.VERTICAL, command=self.table.yview
+        )
+        self.table.config(yscrollcommand=self.table_scrollbar.set)
+
+        # actions
+        self.buttons_frame = ttk.Frame(self, padding=(0, 6, 0, 0))
+        self.export_button = ttk.Button(
+            self.buttons_frame, text="Export", command=self.handle_export_click
+        )
+        self.reset_button = ttk.Button(
+            self.buttons_frame, text="Reset", command=self.handle_reset_click
+        )
+
+        #
+        self.table.grid(row=0, column=0, sticky="nswe")
+        self.table_scrollbar.grid(row=0, column=1, sticky="ns")
+        self.buttons_frame.grid(row=1, column=0, columnspan=2, sticky="e")
+        self.export_button.grid(row=0, column=0, padx=(0, 6))
+        self.reset_button.grid(row=0, column=1)
+
+        #
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+
+        self.after(DASHBOARD_REFRESH_INTERVAL, self.handle_refresh_timer)
+
+    """
+    Actions
+    """
+
+    def refresh(self):
+        rows = {}
+        for (
+            operation,
+            station,
+            units,
+            passed,
+            units_per_hour,
+            p50,
+            p95,
+            slowest,
+        ) in metrics.cycle_metrics.summary():
+            rows[f"{operation}:{station}"] = (
+                operation,
+                station,
+                units,
+                f"{100 * passed / units:.1f}%" if units else "-",
+                f"{units_per_hour:.0f}",
+                _format_seconds(p50),
+                _format_seconds(p95),
+                slowest or "-",
+            )
+
+        # update the rows in place, the selection and scroll are kept
+        for item in self.table.get_children():
+            if item not in rows:
+                self.table.delete(item)
+        for item, values in rows.items():
+            if self.table.exists(item):
+                self.table.item(item, values=values)
+            else:
+                self.table.insert("", "end", iid=item, values=values)
+
+    """
+    Handlers
+    """
+
+    def handle_refresh_timer(self):
+        self.refresh()
+        self.after(DASHBOARD_REFRESH_INTERVAL, self.handle_refresh_timer)
+
+    def handle_export_click(self):
+        filename = filedialog.asksaveasfilename(
+            title="Export metrics",
+            defaultextension=".json",
+            filetypes=(("JSON", "*.json"), ("All files", "*")),
+        )
+        if filename:
+            metrics.cycle_metrics.export(filename)
+
+    def handle_reset_click(self):
+        metrics.cycle_metrics.reset()
+        self.refresh()
@@ -3,20 +3,110 @@ from tkinter import ttk
 from tkinter import filedialog
 
 import os
-from threading import Thread
+import time
+import threading
+from functools import partial
 
 import utils
+import results
+import metrics
+import pipeline
+import jobs
+import profiles
 from .output import Output
+from .testarg import _queue_test_state
 
+# seconds each flash phase may last before the job is aborted, by first word of
+# the stage reported by utils.flash_file
+FLASH_PHASE_TIMEOUTS = {
+    "trying": 10,
+    "connecting": 10,
+    "reading": 30,
+    "erasing": 10,
+    "writing": 30,
+    "verifying": 30,
+    "rewriting": 30,
+}
+# a failed flash is attempted again this many times
+FLASH_RETRIES = 1
+# profile selector entry to set every argument by hand
+PROFILE_NONE = "(none)"
 
-def _flash_file_thread(*args):
-    objfilename, serial_port, output_queue_func = args  # unpack args
-    objbasename = os.path.basename(objfilename)
 
-    if utils.flash_file(objfilename, serial_port):
-        output_queue_func(f"\n{objbasename} flashed succesfully", Output.TAG_SUCCESS)
-    else:
-        output_queue_func(f"\n{objbasename} flash failed", Output.TAG_ERROR)
+def _flash_file_job(job, *args):
+    objfilename, serial_port, options, output_queue_func, report = args
+    # name the worker after its port, so log records can be told apart
+    threading.current_thread().name = serial_port
+
+    def handle_progress(stage):
+        job.phase(stage)
+        output_queue_func(f"[{serial_port}] {stage}")
+
+    # report keeps the last attempt, the unit is recorded once the job is done
+    report.clear()
+    success = utils.flash_file(
+        objfilename,
+        serial_port,
+        handle_progress,
+        report=report,
+        record_metrics=False,
+        **options,
+    )
+
+    if not success:
+        # a failure caused by the abort or the phase timeout
+        job.check()
+        error = report.get("error") or "flash failed"
+        if report.get("transient"):
+            # the job engine tries again
+            raise IOError(error)
+        raise jobs.JobFailed(error)
+    return report
+
+
+def _record_flash_job(serial_port, report, result_store, job):
+    if not report:
+        # cancelled before its first attempt
+        return
+    result_store.record(results.flash_row(serial_port, report))
+    metrics.cycle_metrics.record_unit(
+        metrics.OPERATION_FLASH,
+        serial_port,
+        time.monotonic() - job.started,
+        report["success"],
+        report["timings"],
+    )
+
+
+def _pipeline_job(job, *args):
+    flash_pipeline, duts = args  # unpack args
+
+    try:
+        for dut in duts:
+            job.check()
+            flash_pipeline.submit(dut)
+
+        # the next devices are flashed while these ones are tested, the job lasts
+        # until the last test so that an abort reaches every device
+        for dut in duts:
+            while not dut.done.wait(jobs.JOBS_WATCHDOG_INTERVAL):
+                job.check()
+    except Exception:
+        # aborted, the devices still queued or being tested stop too
+        for dut in duts:
+            dut.cancel()
+        raise
+
+
+def _prepare_profile_job(job, profile, serial_ports):
+    # parse the firmware away from the main loop
+    job.phase("preparing")
+    return profile.prepare(serial_ports)
+
+
+def _abort_flash(serial_ports):
+    for serial_port in serial_ports:
+        utils.updi_sessions.abort(serial_port)
 
 
 class FlashArg(ttk.Labelframe):
@@ -32,6 +122,21 @@ class FlashArg(ttk.Labelframe):
             padding=(12, 2, 12, 15),
         )
 
+        # profile input, fills every argument of the flash and test panels
+        self.profile_frame = ttk.Frame(self, padding=(0, 0, 0, 10))
+        self.profile_label = ttk.Label(self.profile_frame, text="Profile")
+        self.profile_textvar = tk.StringVar(value=PROFILE_NONE)
+        self.profile_select = ttk.Combobox(
+            self.profile_frame,
+            textvariable=self.profile_textvar,
+            values=[PROFILE_NONE],
+            state="readonly",
+            postcommand=self.handle_profile_list,
+        )
+        self.profile_select.bind("<<ComboboxSelected>>", self.handle_profile_select)
+        # label shown in the selector -> profile
+        self.profiles = {}
+
         # object file input
         self.objfile_frame = ttk.Frame(self, padding=(0, 0, 0, 10))
         self.objfile_label = ttk.Label(self.objfile_frame, text="Object File")
@@ -50,7 +155,7 @@ class FlashArg(ttk.Labelframe):
         )
 
         # device input
-        serial_ports = utils.get_formatted_serial_ports()
+        serial_ports = self.root.port_watcher.get_ports()
         self.device_frame = ttk.Frame(self, padding=(0, 0, 0, 15))
         self.device_label = ttk.Label(self.device_frame, text="Device")
         self.device_textvar = tk.StringVar()
@@ -62,6 +167,52 @@ class FlashArg(ttk.Labelframe):
         if serial_ports:
             self.device_select.current(0)
 
+        # batch input, flash all the selected ports concurrently
+        self.batch_var = tk.BooleanVar(value=False)
+        self.batch_check = ttk.Checkbutton(
+            self.device_frame,
+            text="Batch",
+            variable=self.batch_var,
+            command=self.handle_batch_toggle,
+        )
+        self.batch_select = tk.Listbox(
+            self.device_frame,
+            selectmode=tk.MULTIPLE,
+            exportselection=False,
+            height=4,
+        )
+        self.batch_select.insert("end", *serial_ports)
+
+        # incremental input, skip erase/write when the device is up to date
+        self.incremental_var = tk.BooleanVar(value=False)
+        self.incremental_check = ttk.Checkbutton(
+            self.device_frame, text="Incremental", variable=self.incremental_var
+        )
+
+        # crc verify input, the device checks its flash instead of a full read back
+        self.crc_verify_var = tk.BooleanVar(value=False)
+        self.crc_verify_check = ttk.Checkbutton(
+            self.device_frame, text="CRC verify", variable=self.crc_verify_var
+        )
+
+        # pipeline input, test each device on the test ports as soon as it is flashed
+        self.pipeline_var = tk.BooleanVar(value=False)
+        self.pipeline_check = ttk.Checkbutton(
+            self.device_frame, text="Then test", variable=self.pipeline_var
+        )
+        self.pipeline = pipeline.Pipeline(self.handle_pipeline_event)
+
+        # speed input, UPDI baud rate or auto negotiation
+        self.speed_frame = ttk.Frame(self, padding=(0, 0, 0, 15))
+        self.speed_label = ttk.Label(self.speed_frame, text="Speed")
+        self.speed_textvar = tk.StringVar(value=str(utils.UPDI_BAUDRATE_DEFAULT))
+        self.speed_select = ttk.Combobox(
+            self.speed_frame,
+            textvariable=self.speed_textvar,
+            values=[utils.UPDI_BAUDRATE_AUTO] + list(utils.UPDI_BAUDRATES),
+            state="readonly",
+        )
+
         # flash button
         self.submit_frame = ttk.Frame(self)
         self.submit_button = ttk.Button(
@@ -70,8 +221,21 @@ class FlashArg(ttk.Labelframe):
             style="submit.TButton",
             command=self.handle_submit_click,
         )
+        # abort button, cancels every flash job of this panel
+        self.abort_button = ttk.Button(
+            self.submit_frame,
+            text="Abort",
+            command=self.handle_abort_click,
+        )
+        self.abort_button.state(["disabled"])
+        # jobs started from this panel, and the groups started by each click
+        self.active_jobs = set()
+        self.job_groups = []
 
         #
+        self.profile_frame.grid(sticky="we")
+        self.profile_label.grid(sticky="w")
+        self.profile_select.grid(sticky="we")
         self.objfile_frame.grid(sticky="we")
         self.objfile_label.grid(sticky="w", columnspan=2)
         self.objfile_button.grid(row=1, column=0)
@@ -79,13 +243,23 @@ class FlashArg(ttk.Labelframe):
         self.device_frame.grid(sticky="we")
         self.device_label.grid(sticky="w")
         self.device_select.grid(sticky="we")
+        self.batch_check.grid(sticky="w", pady=(4, 0))
+        self.incremental_check.grid(sticky="w", row=4)
+        self.crc_verify_check.grid(sticky="w", row=5)
+        self.pipeline_check.grid(sticky="w", row=6)
+        self.speed_frame.grid(sticky="we")
+        self.speed_label.grid(sticky="w")
+        self.speed_select.grid(sticky="we")
         self.submit_frame.grid(sticky="we")
-        self.submit_button.grid()
+        self.submit_button.grid(row=0, column=0)
+        self.abort_button.grid(row=0, column=1, padx=(6, 0))
 
         #
         self.grid_columnconfigure(0, weight=1)
+        self.profile_frame.grid_columnconfigure(0, weight=1)
         self.objfile_frame.grid_columnconfigure(1, weight=1)
         self.device_frame.grid_columnconfigure(0, weight=1)
+        self.speed_frame.grid_columnconfigure(0, weight=1)
         self.submit_frame.grid_columnconfigure(0, weight=1)
 
         #
@@ -104,13 +278,104 @@ class FlashArg(ttk.Labelframe):
     def get_device_port(self):
         return utils.get_port_from_formatted_serial_port(self.device_textvar.get())
 
-    def set_available_formatted_serial_ports(self, serial_ports):
+    def get_batch_ports(self):
+        return [
+            utils.get_port_from_formatted_serial_port(self.batch_select.get(index))
+            for index in self.batch_select.curselection()
+        ]
+
+    def is_batch(self):
+        return self.batch_var.get()
+
+    def is_incremental(self):
+        return self.incremental_var.get()
+
+    def get_verify(self):
+        return utils.VERIFY_CRC if self.crc_verify_var.get() else utils.VERIFY_READBACK
+
+    def is_pipeline(self):
+        return self.pipeline_var.get()
+
+    def get_baudrate(self):
+        speed = self.speed_textvar.get()
+        return speed if speed == utils.UPDI_BAUDRATE_AUTO else int(speed)
+
+    def get_flash_options(self):
+        # keyword arguments of utils.flash_file
+        profile = self.root.profile
+        return {
+            "device": profile.device if profile else utils.UPDI_DEVICE_DEFAULT,
+            "incremental": self.is_incremental(),
+            "baudrate": self.get_baudrate(),
+            "verify": self.get_verify(),
+            "serializer": profile.serializer if profile else None,
+        }
+
+    def get_serial_ports(self):
+        if self.is_batch():
+            return self.get_batch_ports()
+        return [self.get_device_port()] if self.get_device_port() else []
+
+    def update_available_formatted_serial_ports(self, serial_ports, added, removed):
         self.device_select["values"] = serial_ports
 
+        # apply only the changes to the batch list, keeping the selection
+        for serial_port in removed:
+            index = self.batch_select.get(0, "end").index(serial_port)
+            self.batch_select.delete(index)
+        for serial_port in sorted(added, key=serial_ports.index):
+            self.batch_select.insert(serial_ports.index(serial_port), serial_port)
+
     """
     Event Handlers
     """
 
+    def handle_profile_list(self, *args):
+        # profile files are parsed again only when they changed on disk
+        loaded, errors = profiles.station_profiles.load()
+        self.profiles = {str(profile): profile for profile in loaded}
+        self.profile_select["values"] = [PROFILE_NONE] + list(self.profiles)
+        for error in errors:
+            self.root.flashoutput.print(str(error), Output.TAG_WARNING)
+
+    def handle_profile_select(self, *args):
+        profile = self.profiles.get(self.profile_textvar.get())
+        if profile is None:
+            self.root.profile = None
+            return
+
+        self.profile_select.state(["disabled"])
+        self.root.jobs.submit(
+            f"profile {profile}",
+            _prepare_profile_job,
+            profile,
+            self.get_serial_ports(),
+            done_func=self.handle_profile_job_done,
+        )
+
+    def handle_profile_job_done(self, job):
+        # called from the job worker
+        self.root.output_pump.post(partial(self.handle_profile_prepared, job))
+
+    def handle_profile_prepared(self, job):
+        self.profile_select.state(["!disabled"])
+        if job.state != jobs.JobState.SUCCESS:
+            self.root.flashoutput.print(str(job.error), Output.TAG_ERROR)
+            self.profile_textvar.set(PROFILE_NONE)
+            self.root.profile = None
+            return
+
+        profile = job.result
+        self.root.profile = profile
+        if profile.firmware:
+            self.objfilename = profile.firmware
+            self.objfile_desc_textvar.set(os.path.basename(profile.firmware))
+        self.speed_textvar.set(str(profile.baudrate))
+        self.incremental_var.set(profile.incremental)
+        self.crc_verify_var.set(profile.verify == utils.VERIFY_CRC)
+        self.root.testarg.apply_profile(profile)
+        self.root.flashoutput.print(f"profile {profile} ready", Output.TAG_INFO)
+
     def handle_choose_file_click(self, *args):
         self.objfilename = filedialog.askopenfilename(
             filetypes=(("Intel HEX File", "*.hex"),)
@@ -119,40 +384,190 @@ class FlashArg(ttk.Labelframe):
         if self.objfilename:
             self.objfile_desc_textvar.set(os.path.basename(self.objfilename))
 
+    def handle_batch_toggle(self, *args):
+        if self.is_batch():
+            self.device_select.state(["disabled"])
+            self.batch_select.grid(sticky="we", row=3, pady=(4, 0))
+        else:
+            self.device_select.state(["!disabled"])
+            self.batch_select.grid_remove()
+
     def handle_submit_click(self, *args):
-        self.root.flashoutput.clear()
+        # keep the lines of the jobs still running
+        if not self.active_jobs:
+            self.root.flashoutput.clear()
 
         # input validation
-        if not self.get_objfilename() or not self.get_device_port():
+        serial_ports = self.get_serial_ports()
+        if not self.get_objfilename() or not serial_ports:
             self.root.flashoutput.print("Invalid flash arguments", Output.TAG_ERROR)
             return
 
-        # disable submit button to avoid multiple threads / clicks
-        self.submit_button.state(["disabled"])
-
-        # create thread
-        self.flash_file_thread = Thread(
-            target=_flash_file_thread,
-            args=[
-                self.get_objfilename(),
-                self.get_device_port(),
-                self.root.flashoutput.queue,
-            ],
-        )
-        self.flash_file_thread.start()
+        if self.is_pipeline():
+            # the n-th flash port is tested on the n-th test port and address
+            try:
+                test_slots = self.root.testarg.get_test_slots()
+                deadline = self.root.testarg.get_deadline()
+            except ValueError:
+                test_slots = []
+            if len(test_slots) < len(serial_ports):
+                self.root.flashoutput.print(
+                    "Invalid test arguments, a probe is needed for every port",
+                    Output.TAG_ERROR,
+                )
+                return
+            duts = [
+                pipeline.Dut(
+                    serial_port,
+                    test_port,
+                    slave_address,
+                    self.get_objfilename(),
+                    self.get_flash_options(),
+                    deadline,
+                    self.root.testarg.get_test_options(),
+                )
+                for serial_port, (test_port, slave_address) in zip(
+                    serial_ports, test_slots
+                )
+            ]
 
-        # start timer for handling queued output lines
-        self.root.after(100, self.handle_submit_timer)
+        # every click starts its own jobs, a port is used by one job at a time
+        objfilename = self.get_objfilename()
+        objbasename = os.path.basename(objfilename)
+        options = self.get_flash_options()
+        if self.is_pipeline():
+            group = [
+                self.root.jobs.submit(
+                    f"pipeline {objbasename}",
+                    _pipeline_job,
+                    self.pipeline,
+                    duts,
+                    ports=serial_ports,
+                    abort_func=partial(_abort_flash, serial_ports),
+                    done_func=partial(self.handle_job_done, objbasename, None),
+                )
+            ]
+        else:
+            group = []
+            for serial_port in serial_ports:
+                report = {}
+                group.append(
+                    self.root.jobs.submit(
+                        f"flash {serial_port}",
+                        _flash_file_job,
+                        objfilename,
+                        serial_port,
+                        options,
+                        self.root.flashoutput.queue,
+                        report,
+                        ports=[serial_port],
+                        retries=FLASH_RETRIES,
+                        phase_timeouts=FLASH_PHASE_TIMEOUTS,
+                        abort_func=partial(utils.updi_sessions.abort, serial_port),
+                        done_func=partial(
+                            self.handle_flash_job_done, objbasename, serial_port, report
+                        ),
+                    )
+                )
+        self.active_jobs.update(group)
+        self.job_groups.append(group)
+        self.abort_button.state(["!disabled"])
 
-    def handle_submit_timer(self, *args):
-        # saving the result here to avoid race conditions
-        is_thread_alive = self.flash_file_thread.is_alive()
+    def handle_abort_click(self, *args):
+        for job in self.active_jobs:
+            job.cancel()
 
-        self.root.flashoutput.dequeue()
+    def handle_flash_job_done(self, objbasename, serial_port, report, job):
+        # called from the job worker, one row for all the attempts
+        _record_flash_job(serial_port, report, self.root.result_store, job)
+        self.handle_job_done(objbasename, serial_port, job)
 
-        if is_thread_alive:
-            # there may be other output lines incoming
-            self.root.after(100, self.handle_submit_timer)
+    def handle_job_done(self, objbasename, serial_port, job):
+        # called from the job worker, lines are queued before the callback
+        output_queue_func = self.root.flashoutput.queue
+        prefix = f"[{serial_port}] " if serial_port else ""
+        if job.state == jobs.JobState.SUCCESS:
+            if serial_port:
+                output_queue_func(
+                    f"{prefix}{objbasename} flashed succesfully", Output.TAG_SUCCESS
+                )
+        elif job.state == jobs.JobState.CANCELLED:
+            output_queue_func(
+                f"{prefix}{objbasename} flash aborted", Output.TAG_WARNING
+            )
         else:
-            # re-enable submit button
-            self.submit_button.state(["!disabled"])
+            output_queue_func(
+                f"{prefix}{objbasename} flash failed after {job.attempts} attempts: "
+                f"{job.error}",
+                Output.TAG_ERROR,
+            )
+        self.root.output_pump.post(partial(self.handle_job_finished, job))
+
+    def handle_job_finished(self, job):
+        self.active_jobs.discard(job)
+
+        # summary of the clicks whose jobs are all done
+        for group in [group for group in self.job_groups if job in group]:
+            if not all(group_job.is_done() for group_job in group):
+                continue
+            self.job_groups.remove(group)
+            if len(group) > 1:
+                passed = sum(
+                    1 for group_job in group if group_job.state == jobs.JobState.SUCCESS
+                )
+                self.root.flashoutput.print(
+                    f"\nflashed on {passed}/{len(group)} ports",
+                    Output.TAG_SUCCESS if passed == len(group) else Output.TAG_ERROR,
+                )
+                stats = utils.get_hex_cache_stats()
+                self.root.flashoutput.print(
+                    f"hex cache: {stats['hits']} hits, {stats['misses']} misses",
+                    Output.TAG_INFO,
+                )
+
+        if not self.active_jobs:
+            self.abort_button.state(["disabled"])
+
+    def handle_pipeline_event(self, dut):
+        # called from the pipeline workers on every stage change
+        flash_queue_func = self.root.flashoutput.queue
+        test_queue_func = self.root.testoutput.queue
+        objbasename = os.path.basename(dut.filename)
+        prefix = f"[{dut.flash_port} > {dut.test_port}#{dut.slave_address}]"
+
+        if dut.stage == pipeline.DutStage.FLASHING:
+            flash_queue_func(f"{prefix} flashing {objbasename}")
+        elif dut.stage == pipeline.DutStage.FLASH_FAILED:
+            self.root.result_store.record(results.flash_row(dut.flash_port, dut.report))
+            flash_queue_func(f"{prefix} flash failed", Output.TAG_ERROR)
+        elif dut.stage == pipeline.DutStage.TEST_QUEUED:
+            self.root.result_store.record(results.flash_row(dut.flash_port, dut.report))
+            flash_queue_func(
+                f"{prefix} flashed succesfully, queued for test", Output.TAG_SUCCESS
+            )
+        elif dut.stage == pipeline.DutStage.TESTING:
+            test_queue_func(f"{prefix} testing")
+        elif dut.stage in pipeline.DutStage.DONE:
+            self.root.result_store.record(
+                results.test_row(
+                    dut.test_port,
+                    dut.slave_address,
+                    dut.result,
+                    dut.get_test_duration(),
+                    dut.transitions,
+                    device_id=dut.report.get("device_id"),
+                    firmware_file=dut.report.get("firmware_file"),
+                    firmware_sha256=dut.report.get("firmware_sha256"),
+                )
+            )
+            if isinstance(dut.result, utils.ProbeStatus):
+                _queue_test_state(test_queue_func, dut.result, f" {prefix}")
+            elif isinstance(dut.result, TimeoutError):
+                test_queue_func(
+                    f"{prefix} Test failed, no result after {dut.deadline}s",
+                    Output.TAG_ERROR,
+                )
+            else:
+                test_queue_func(
+                    f"{prefix} Test interrupted: {dut.result}", Output.TAG_ERROR
+                )
@@ -2,16 +2,115 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter import font
 
-import queue
+import logging
+import logging.handlers
+import os
+import threading
+from collections import deque
+
+# queued chunks waiting for the main loop, the newest are dropped beyond this
+OUTPUT_PENDING_MAX = 10000
+# lines kept in every output widget, the oldest are discarded
+OUTPUT_MAX_LINES = 5000
+# size of a spill file and number of rotated files kept
+OUTPUT_SPILL_MAX_BYTES = 5 * 1024 * 1024
+OUTPUT_SPILL_BACKUP_COUNT = 5
+
+
+class OutputPump:
+    # delivers the lines queued from any thread to their Output widgets, the main
+    # loop is woken up once per batch and every widget gets a single insert
+
+    def __init__(self, root, max_pending=OUTPUT_PENDING_MAX):
+        self.root = root
+        self.max_pending = max_pending
+        # (output, chunks) or (None, callable), in the order they were queued
+        self.pending = deque()
+        self.pending_chunks = 0
+        # output -> chunks dropped since the last batch
+        self.dropped = {}
+        self.lock = threading.Lock()
+        self.wakeup_pending = False
+
+        self.root.bind("<<OutputPending>>", self.handle_pending)
+
+    def put(self, output, chunks):
+        with self.lock:
+            if self.pending_chunks + len(chunks) > self.max_pending:
+                # the main loop can't keep up, never block the worker threads
+                self.dropped[output] = self.dropped.get(output, 0) + len(chunks)
+            else:
+                self.pending.append((output, chunks))
+                self.pending_chunks += len(chunks)
+        self._wakeup()
+
+    def post(self, func):
+        # run func on the main loop, after the lines queued before it
+        with self.lock:
+            self.pending.append((None, func))
+        self._wakeup()
+
+    def _wakeup(self):
+        with self.lock:
+            if self.wakeup_pending:
+                return
+            self.wakeup_pending = True
+
+        try:
+            self.root.event_generate("<<OutputPending>>", when="tail")
+        except (RuntimeError, tk.TclError):
+            # the window is being destroyed, the next put tries again
+            with self.lock:
+                self.wakeup_pending = False
+
+    def handle_pending(self, *args):
+        with self.lock:
+            self.wakeup_pending = False
+            pending, self.pending = self.pending, deque()
+            self.pending_chunks = 0
+            dropped, self.dropped = self.dropped, {}
+
+        # output -> chunks, dicts keep the order in which the outputs appear
+        batches = {}
+        for output, item in pending:
+            if output is None:
+                # deliver the lines queued before running the callback
+                self._flush(batches)
+                batches = {}
+                item()
+            else:
+                batches.setdefault(output, []).extend(item)
+
+        self._flush(batches)
+
+        # the dropped chunks were the newest ones
+        for output, count in dropped.items():
+            output.print_dropped(count)
+
+    def _flush(self, batches):
+        for output, chunks in batches.items():
+            output.insert_chunks(chunks)
 
 
 class Output(ttk.Labelframe):
-    def __init__(self, root, parent):
+    def __init__(self, root, parent, spill_filename=None, max_lines=OUTPUT_MAX_LINES):
         self.root = root
         self.parent = parent
-
-        # init output text queue
-        self.output_text_queue = queue.Queue()
+        self.max_lines = max_lines
+
+        # the full history goes to a rotating file, the widget keeps the tail
+        self.spill_handler = None
+        if spill_filename is not None:
+            os.makedirs(os.path.dirname(spill_filename) or ".", exist_ok=True)
+            self.spill_handler = logging.handlers.RotatingFileHandler(
+                spill_filename,
+                maxBytes=OUTPUT_SPILL_MAX_BYTES,
+                backupCount=OUTPUT_SPILL_BACKUP_COUNT,
+                encoding="utf-8",
+                delay=True,
+            )
+            # chunks carry their own line endings
+            self.spill_handler.terminator = ""
 
         # container
         super().__init__(
@@ -51,22 +150,59 @@ class Output(ttk.Labelframe):
         self.output_text.config(state="disabled")
 
     def print(self, msg, tags=(), end="\n"):
+        self.print_chunks(((msg + end, tags),))
+
+    def print_chunks(self, chunks):
+        self.spill(chunks)
+        self.insert_chunks(chunks)
+
+    def print_dropped(self, count):
+        # already in the spill file, only the widget missed them
+        self.insert_chunks(
+            ((f"... {count} lines dropped, output too fast\n", self.TAG_WARNING),)
+        )
+
+    def insert_chunks(self, chunks):
+        # chunks are (text, tags) pairs, inserted with a single call
+        args = []
+        for text, tags in chunks:
+            args += [text, tags]
+
         self.output_text.config(state="normal")
-        self.output_text.insert("end", msg + end, tags)
+        self.output_text.insert("end", *args)
+        self._trim()
         self.output_text.config(state="disabled")
         # always scroll to end
         self.output_text.yview_moveto("1.0")
 
+    def _trim(self):
+        # the text always ends with an empty line after the last newline
+        lines = int(self.output_text.index("end-1c").split(".")[0]) - 1
+        if lines > self.max_lines:
+            self.output_text.delete("1.0", f"{lines - self.max_lines + 1}.0")
+
+    def spill(self, chunks):
+        if self.spill_handler is None:
+            return
+
+        text = "".join(text for text, _ in chunks)
+        self.spill_handler.handle(
+            logging.makeLogRecord({"msg": text, "levelno": logging.INFO})
+        )
+
     def queue(self, msg, tags=(), end="\n"):
-        self.output_text_queue.put((msg, tags, end))
-
-    def dequeue(self):
-        while self.output_text_queue.qsize():
-            try:
-                msg, tags, end = self.output_text_queue.get_nowait()
-                self.print(msg, tags, end)
-            except queue.Empty:
-                pass
+        # thread safe print
+        self.queue_chunks(((msg + end, tags),))
+
+    def queue_chunks(self, chunks):
+        # thread safe print_chunks, written to the spill file right away so that
+        # nothing is lost if the widget drops the chunks
+        self.spill(chunks)
+        self.root.output_pump.put(self, chunks)
+
+    def close(self):
+        if self.spill_handler is not None:
+            self.spill_handler.close()
 
     """
     Tags
@@ -1,70 +1,112 @@
 import tkinter as tk
 from tkinter import ttk
 
-from threading import Thread
-from time import sleep
+import time
+import threading
+from functools import partial
 from datetime import datetime
 
 import utils
+import results
+import jobs
 from .output import Output
 
+TestState = utils.TestState
 
-class TestState:
-    INIT = 0
-    IN_PROGRESS = 1
-    FAILED = 2
-    SUCCESS = 3
 
+def _queue_test_state(output_queue_func, status, prefix=""):
+    timestamp = datetime.now().strftime("%H:%M:%S")
+    output_queue_func(f"[{timestamp}]{prefix}", end=" ")
 
-def _test_thread(*args):
-    serial_port, output_queue_func = args  # unpack args
-
-    # connection
-    try:
-        modbus_instrument = utils.modbus_connect(serial_port)
-    except IOError as error:
-        output_queue_func(
-            f"Connection failed with {serial_port}",
-            Output.TAG_ERROR,
+    # diagnostic registers are None when the probe firmware does not expose them
+    if status.state == TestState.INIT:
+        if status.firmware_version is not None:
+            firmware_version = utils.format_firmware_version(status.firmware_version)
+            output_queue_func(f"Test initialization (firmware {firmware_version})")
+        else:
+            output_queue_func("Test initialization")
+    elif status.state == TestState.IN_PROGRESS:
+        output_queue_func("Test in progress")
+    elif status.state == TestState.FAILED:
+        if status.error_code is not None:
+            output_queue_func(
+                f"Test failed (error code {status.error_code})", Output.TAG_ERROR
+            )
+        else:
+            output_queue_func("Test failed", Output.TAG_ERROR)
+    elif status.state == TestState.SUCCESS:
+        if status.measurement is not None:
+            output_queue_func(
+                f"Test success (measurement {status.measurement})", Output.TAG_SUCCESS
+            )
+        else:
+            output_queue_func("Test success", Output.TAG_SUCCESS)
+    else:
+        output_queue_func("Unknown test state", Output.TAG_CRITICAL)
+
+
+def _test_bus_job(
+    job,
+    serial_port,
+    slave_addresses,
+    deadline,
+    test_options,
+    prefixed,
+    output_queue_func,
+    result_store,
+):
+    # name the worker after its port, so log records can be told apart
+    threading.current_thread().name = serial_port
+    start = time.monotonic()
+    # slave address -> [(seconds since the start, state)]
+    transitions = {}
+
+    def get_prefix(slave_address):
+        return f" [{serial_port}#{slave_address}]" if prefixed else ""
+
+    def handle_state(slave_address, status):
+        transitions.setdefault(slave_address, []).append(
+            (time.monotonic() - start, status.state)
         )
-        print(error)
-        return
-
-    # start test
-    try:
-        utils.modbus_set_cmd(modbus_instrument, 1)
-    except IOError as error:
-        output_queue_func("Test start failed", Output.TAG_ERROR)
-        print(error)
-        return
-
-    # pool for test state
-    try:
-        modbus_state = last_modbus_state = -1
-        while modbus_state != TestState.FAILED and modbus_state != TestState.SUCCESS:
-            modbus_state = utils.modbus_get_state(modbus_instrument)
-
-            if modbus_state != last_modbus_state:
-                timestamp = datetime.now().strftime("%H:%M:%S")
-                output_queue_func(f"[{timestamp}]", end=" ")
-
-                if modbus_state == TestState.INIT:
-                    output_queue_func("Test initialization")
-                elif modbus_state == TestState.IN_PROGRESS:
-                    output_queue_func("Test in progress")
-                elif modbus_state == TestState.FAILED:
-                    output_queue_func("Test failed", Output.TAG_ERROR)
-                elif modbus_state == TestState.SUCCESS:
-                    output_queue_func("Test success", Output.TAG_SUCCESS)
-                else:
-                    output_queue_func("Unknown test state", Output.TAG_CRITICAL)
-
-                last_modbus_state = modbus_state
-
-            sleep(0.1)  # 100ms
-    except IOError as error:
-        output_queue_func("Test interrupted for an exception", Output.TAG_ERROR)
-        print(error)
+        _queue_test_state(output_queue_func, status, get_prefix(slave_address))
+
+    job.phase("testing")
+    # slave address -> seconds from the start of the probe to its result
+    durations = {}
+    test_results = utils.modbus_test_bus(
+        serial_port,
+        slave_addresses,
+        handle_state,
+        deadline,
+        job.sleep,
+        durations=durations,
+        **test_options,
+    )
+
+    for slave_address, result in test_results.items():
+        result_store.record(
+            results.test_row(
+                serial_port,
+                slave_address,
+                result,
+                durations[slave_address],
+                transitions.get(slave_address, ()),
+            )
+        )
+
+        # test results are already reported as state changes
+        prefix = get_prefix(slave_address).strip()
+        if isinstance(result, TimeoutError):
+            output_queue_func(
+                f"{prefix} Test failed, no result after {deadline}s".strip(),
+                Output.TAG_ERROR,
+            )
+        elif isinstance(result, Exception):
+            output_queue_func(
+                f"{prefix} Test interrupted: {result}".strip(), Output.TAG_ERROR
+            )
+
+    return test_results
 
 
 class TestArg(ttk.Labelframe):
@@ -81,7 +123,7 @@ class TestArg(ttk.Labelframe):
         )
 
         # device input
-        serial_ports = utils.get_formatted_serial_ports()
+        serial_ports = self.root.port_watcher.get_ports()
         self.device_frame = ttk.Frame(self, padding=(0, 0, 0, 15))
         self.device_label = ttk.Label(self.device_frame, text="Device")
         self.device_textvar = tk.StringVar()
@@ -93,6 +135,40 @@ class TestArg(ttk.Labelframe):
         if len(serial_ports) > 1:
             self.device_select.current(1)
 
+        # batch input, test all the selected ports concurrently
+        self.batch_var = tk.BooleanVar(value=False)
+        self.batch_check = ttk.Checkbutton(
+            self.device_frame,
+            text="Batch",
+            variable=self.batch_var,
+            command=self.handle_batch_toggle,
+        )
+        self.batch_select = tk.Listbox(
+            self.device_frame,
+            selectmode=tk.MULTIPLE,
+            exportselection=False,
+            height=4,
+        )
+        self.batch_select.insert("end", *serial_ports)
+
+        # slave addresses input, the probes sharing the bus of each port
+        self.address_frame = ttk.Frame(self, padding=(0, 0, 0, 15))
+        self.address_label = ttk.Label(self.address_frame, text="Addresses")
+        self.address_textvar = tk.StringVar(
+            value=str(utils.MODBUS_SLAVE_ADDRESS_DEFAULT)
+        )
+        self.address_entry = ttk.Entry(
+            self.address_frame, textvariable=self.address_textvar
+        )
+
+        # timeout input, empty to wait for the result forever
+        self.timeout_frame = ttk.Frame(self, padding=(0, 0, 0, 15))
+        self.timeout_label = ttk.Label(self.timeout_frame, text="Timeout (s)")
+        self.timeout_textvar = tk.StringVar()
+        self.timeout_entry = ttk.Entry(
+            self.timeout_frame, textvariable=self.timeout_textvar
+        )
+
         # test button
         self.submit_frame = ttk.Frame(self)
         self.submit_button = ttk.Button(
@@ -101,17 +177,37 @@ class TestArg(ttk.Labelframe):
             style="submit.TButton",
             command=self.handle_submit_click,
         )
+        # abort button, cancels every test job of this panel
+        self.abort_button = ttk.Button(
+            self.submit_frame,
+            text="Abort",
+            command=self.handle_abort_click,
+        )
+        self.abort_button.state(["disabled"])
+        # jobs started from this panel, and the groups started by each click
+        self.active_jobs = set()
+        self.job_groups = []
 
         #
         self.device_frame.grid(sticky="we")
         self.device_label.grid(sticky="w")
         self.device_select.grid(sticky="we")
+        self.batch_check.grid(sticky="w", pady=(4, 0))
+        self.address_frame.grid(sticky="we")
+        self.address_label.grid(sticky="w")
+        self.address_entry.grid(sticky="we")
+        self.timeout_frame.grid(sticky="we")
+        self.timeout_label.grid(sticky="w")
+        self.timeout_entry.grid(sticky="we")
         self.submit_frame.grid(sticky="we")
-        self.submit_button.grid()
+        self.submit_button.grid(row=0, column=0)
+        self.abort_button.grid(row=0, column=1, padx=(6, 0))
 
         #
         self.grid_columnconfigure(0, weight=1)
         self.device_frame.grid_columnconfigure(0, weight=1)
+        self.address_frame.grid_columnconfigure(0, weight=1)
+        self.timeout_frame.grid_columnconfigure(0, weight=1)
         self.submit_frame.grid_columnconfigure(0, weight=1)
 
         #
@@ -126,46 +222,161 @@ class TestArg(ttk.Labelframe):
     def get_device_port(self):
         return utils.get_port_from_formatted_serial_port(self.device_textvar.get())
 
-    def set_available_formatted_serial_ports(self, serial_ports):
+    def get_batch_ports(self):
+        return [
+            utils.get_port_from_formatted_serial_port(self.batch_select.get(index))
+            for index in self.batch_select.curselection()
+        ]
+
+    def is_batch(self):
+        return self.batch_var.get()
+
+    def get_slave_addresses(self):
+        # raises ValueError on invalid input
+        return utils.parse_slave_addresses(self.address_textvar.get())
+
+    def get_deadline(self):
+        # raises ValueError on invalid input
+        timeout = self.timeout_textvar.get().strip()
+        if not timeout:
+            return None
+        if float(timeout) <= 0:
+            raise ValueError(timeout)
+        return float(timeout)
+
+    def get_test_options(self):
+        # modbus settings and registers of the probes, from the profile
+        profile = self.root.profile
+        return profile.get_test_options() if profile else {}
+
+    def apply_profile(self, profile):
+        self.address_textvar.set(",".join(map(str, profile.slave_addresses)))
+        self.timeout_textvar.set(str(profile.deadline) if profile.deadline else "")
+
+    def get_test_slots(self):
+        # (serial port, slave address) of every probe, in order
+        # raises ValueError on invalid input
+        slave_addresses = self.get_slave_addresses()
+        if self.is_batch():
+            serial_ports = self.get_batch_ports()
+        else:
+            serial_ports = [self.get_device_port()] if self.get_device_port() else []
+        return [
+            (serial_port, slave_address)
+            for serial_port in serial_ports
+            for slave_address in slave_addresses
+        ]
+
+    def update_available_formatted_serial_ports(self, serial_ports, added, removed):
         self.device_select["values"] = serial_ports
 
+        # apply only the changes to the batch list, keeping the selection
+        for serial_port in removed:
+            index = self.batch_select.get(0, "end").index(serial_port)
+            self.batch_select.delete(index)
+        for serial_port in sorted(added, key=serial_ports.index):
+            self.batch_select.insert(serial_ports.index(serial_port), serial_port)
+
     """
     Handlers
     """
 
+    def handle_batch_toggle(self, *args):
+        if self.is_batch():
+            self.device_select.state(["disabled"])
+            self.batch_select.grid(sticky="we", row=3, pady=(4, 0))
+        else:
+            self.device_select.state(["!disabled"])
+            self.batch_select.grid_remove()
+
     def handle_submit_click(self):
-        self.root.testoutput.clear()
+        # keep the lines of the jobs still running
+        if not self.active_jobs:
+            self.root.testoutput.clear()
 
         # input validation
-        if not self.get_device_port():
+        try:
+            deadline = self.get_deadline()
+        except ValueError:
+            self.root.testoutput.print("Invalid test timeout", Output.TAG_ERROR)
+            return
+        try:
+            slave_addresses = self.get_slave_addresses()
+        except ValueError:
+            self.root.testoutput.print("Invalid slave addresses", Output.TAG_ERROR)
+            return
+        if self.is_batch():
+            serial_ports = self.get_batch_ports()
+        else:
+            serial_ports = [self.get_device_port()] if self.get_device_port() else []
+        if not serial_ports:
             self.root.testoutput.print("Invalid test arguments", Output.TAG_ERROR)
             return
 
-        # disable submit button to avoid multiple threads / clicks
-        self.submit_button.state(["disabled"])
-
-        # create thread
-        self.test_thread = Thread(
-            target=_test_thread,
-            args=[
-                self.get_device_port(),
+        # one job per bus, the probes of a bus are polled by a single thread
+        prefixed = len(serial_ports) > 1 or len(slave_addresses) > 1
+        group = [
+            self.root.jobs.submit(
+                f"test {serial_port}",
+                _test_bus_job,
+                serial_port,
+                slave_addresses,
+                deadline,
+                self.get_test_options(),
+                prefixed,
                 self.root.testoutput.queue,
-            ],
-        )
-        self.test_thread.start()
-
-        # start timer for handling queued output lines
-        self.root.after(100, self.handle_submit_timer)
-
-    def handle_submit_timer(self, *args):
-        # saving the result here to avoid race conditions
-        is_thread_alive = self.test_thread.is_alive()
-
-        self.root.testoutput.dequeue()
-
-        if is_thread_alive:
-            # there may be other output lines incoming
-            self.root.after(100, self.handle_submit_timer)
-        else:
-            # re-enable submit button
-            self.submit_button.state(["!disabled"])
+                self.root.result_store,
+                ports=[serial_port],
+                done_func=self.handle_job_done,
+            )
+            for serial_port in serial_ports
+        ]
+        self.active_jobs.update(group)
+        self.job_groups.append(group)
+        self.abort_button.state(["!disabled"])
+
+    def handle_abort_click(self, *args):
+        for job in self.active_jobs:
+            job.cancel()
+
+    def handle_job_done(self, job):
+        # called from the job worker, lines are queued before the callback
+        if job.state == jobs.JobState.CANCELLED:
+            self.root.testoutput.queue(f"{job.name} aborted", Output.TAG_WARNING)
+        elif job.state == jobs.JobState.FAILED:
+            self.root.testoutput.queue(
+                f"{job.name} failed: {job.error}", Output.TAG_ERROR
+            )
+        self.root.output_pump.post(partial(self.handle_job_finished, job))
+
+    def handle_job_finished(self, job):
+        self.active_jobs.discard(job)
+
+        # summary of the clicks whose jobs are all done
+        for group in [group for group in self.job_groups if job in group]:
+            if not all(group_job.is_done() for group_job in group):
+                continue
+            self.job_groups.remove(group)
+
+            test_results = []
+            for group_job in group:
+                if group_job.state == jobs.JobState.SUCCESS:
+                    test_results += group_job.result.values()
+            if len(test_results) > 1:
+                passed = sum(
+                    1
+                    for result in test_results
+                    if isinstance(result, utils.ProbeStatus)
+                    and result.state == TestState.SUCCESS
+                )
+                self.root.testoutput.print(
+                    f"\n{passed}/{len(test_results)} probes passed",
+                    (
+                        Output.TAG_SUCCESS
+                        if passed == len(test_results)
+                        else Output.TAG_ERROR
+                    ),
+                )
+
+        if not self.active_jobs:
+            self.abort_button.state(["disabled"])
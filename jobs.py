@@ -0,0 +1,229 @@
+import time
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# jobs running at the same time, the others wait in the executor queue
+JOBS_MAX_WORKERS = 16
+# jobs using the same serial port at the same time
+JOBS_PORT_LIMIT = 1
+# first delay between two attempts of a job, doubled on every retry
+JOBS_RETRY_BACKOFF = 0.5
+JOBS_RETRY_BACKOFF_MAX = 8.0
+# how often the watchdog looks for phases running past their timeout
+JOBS_WATCHDOG_INTERVAL = 0.1
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobTimeout(TimeoutError):
+    pass
+
+
+class JobFailed(Exception):
+    # a failure another attempt would not fix, the job is not retried
+    pass
+
+
+class JobState:
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCESS = "success"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    DONE = (SUCCESS, FAILED, CANCELLED)
+
+
+class Job:
+    # func(job, *args) runs in a worker thread, it calls job.phase(name) when a
+    # phase starts and job.sleep(seconds) instead of time.sleep so that it can
+    # be cancelled or timed out between blocking calls
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        name,
+        func,
+        args=(),
+        ports=(),
+        retries=0,
+        phase_timeouts=None,
+        abort_func=None,
+        done_func=None,
+    ):
+        self.id = next(Job._ids)
+        self.name = name
+        self.func = func
+        self.args = args
+        self.ports = tuple(sorted(set(ports)))
+        self.retries = retries
+        # phase name -> seconds, a phase matches the first word of a stage
+        self.phase_timeouts = phase_timeouts or {}
+        # called from the watchdog to unblock a blocking call, e.g. closing the port
+        self.abort_func = abort_func
+        # done_func(job) is called from the worker thread once the job is done
+        self.done_func = done_func
+
+        self.state = JobState.PENDING
+        self.result = None
+        self.error = None
+        self.attempts = 0
+        # monotonic time of the first attempt
+        self.started = None
+        self.phase_name = None
+        self.phase_deadline = None
+        self.cancel_event = threading.Event()
+        self.timed_out = False
+
+    def is_done(self):
+        return self.state in JobState.DONE
+
+    def cancel(self):
+        # thread safe, the job stops at its next phase, sleep or abort
+        self.cancel_event.set()
+        if self.state == JobState.RUNNING and self.abort_func:
+            self.abort_func()
+
+    def check(self):
+        if self.timed_out:
+            raise JobTimeout(f"{self.name}: {self.phase_name} timed out")
+        if self.cancel_event.is_set():
+            raise JobCancelled(f"{self.name} cancelled")
+
+    def sleep(self, seconds):
+        self.cancel_event.wait(seconds)
+        self.check()
+
+    def phase(self, name):
+        # also a progress_func for utils.flash_file
+        self.check()
+        self.phase_name = name
+        timeout = self.phase_timeouts.get(name.split()[0] if name else name)
+        self.phase_deadline = time.monotonic() + timeout if timeout else None
+
+    def _timeout(self):
+        self.timed_out = True
+        self.cancel_event.set()
+        if self.abort_func:
+            self.abort_func()
+
+
+class JobEngine:
+    # one executor for every flash and test job, a bounded number of jobs per port
+    # and a watchdog enforcing the phase timeouts
+
+    def __init__(self, max_workers=JOBS_MAX_WORKERS, port_limit=JOBS_PORT_LIMIT):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self.port_limit = port_limit
+        self.lock = threading.Lock()
+        self.port_semaphores = {}
+        self.jobs = set()
+        self.watchdog = None
+        self.stopped = threading.Event()
+
+    def submit(self, name, func, *args, **kwargs):
+        # kwargs are the ones of Job, returns the Job
+        job = Job(name, func, args, **kwargs)
+        with self.lock:
+            self.jobs.add(job)
+            if self.watchdog is None:
+                self.watchdog = threading.Thread(
+                    target=self._watch, name="job watchdog", daemon=True
+                )
+                self.watchdog.start()
+        self.executor.submit(self._run, job)
+        return job
+
+    def get_jobs(self):
+        with self.lock:
+            return list(self.jobs)
+
+    def cancel_all(self):
+        for job in self.get_jobs():
+            job.cancel()
+
+    def shutdown(self, wait=True):
+        self.cancel_all()
+        self.stopped.set()
+        self.executor.shutdown(wait=wait)
+
+    def _get_semaphores(self, ports):
+        with self.lock:
+            return [
+                self.port_semaphores.setdefault(
+                    port, threading.BoundedSemaphore(self.port_limit)
+                )
+                for port in ports
+            ]
+
+    def _run(self, job):
+        # ports are always acquired in the same order, jobs sharing two ports
+        # can't deadlock
+        acquired = []
+        try:
+            for semaphore in self._get_semaphores(job.ports):
+                while not semaphore.acquire(timeout=JOBS_WATCHDOG_INTERVAL):
+                    job.check()
+                acquired.append(semaphore)
+
+            job.state = JobState.RUNNING
+            job.started = time.monotonic()
+            job.result = self._attempt(job)
+            job.state = JobState.SUCCESS
+        except JobCancelled as error:
+            job.error = error
+            job.state = JobState.CANCELLED
+        except Exception as error:
+            job.error = error
+            job.state = JobState.FAILED
+        finally:
+            for semaphore in acquired:
+                semaphore.release()
+            with self.lock:
+                self.jobs.discard(job)
+
+        if job.done_func:
+            job.done_func(job)
+
+    def _attempt(self, job):
+        # only IOError is attempted again, a job raises JobFailed or any other
+        # exception for the failures a retry would not fix
+        backoff = JOBS_RETRY_BACKOFF
+        while True:
+            job.attempts += 1
+            try:
+                job.check()
+                return job.func(job, *job.args)
+            except (JobCancelled, JobTimeout, JobFailed):
+                raise
+            except TimeoutError:
+                raise
+            except IOError:
+                # serial errors are often transient, e.g. a loose contact, while a
+                # test that timed out never is
+                if job.cancel_event.is_set():
+                    # the error comes from the port closed by the abort
+                    job.check()
+                if job.attempts > job.retries:
+                    raise
+            job.phase(None)
+            job.sleep(backoff)
+            backoff = min(backoff * 2, JOBS_RETRY_BACKOFF_MAX)
+
+    def _watch(self):
+        while not self.stopped.wait(JOBS_WATCHDOG_INTERVAL):
+            now = time.monotonic()
+            for job in self.get_jobs():
+                deadline = job.phase_deadline
+                if (
+                    job.state == JobState.RUNNING
+                    and deadline is not None
+                    and now > deadline
+                    and not job.timed_out
+                ):
+                    job._timeout()
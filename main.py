@@ -4,9 +4,21 @@ from tkinter import ttk
 from tkinter import font
 
 import logging
+import os
+import queue
+import threading
 
 import utils
-from components import FlashArg, TestArg, Output
+import results
+import metrics
+import jobs
+from components import Dashboard, FlashArg, TestArg, Output, OutputPump
+
+# full history of the output widgets and the result of every unit
+LOG_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+RESULTS_DATABASE = os.path.join(LOG_DIRECTORY, "results.sqlite3")
+# phase timings of the session, written at exit
+METRICS_FILE = os.path.join(LOG_DIRECTORY, "metrics.json")
 
 
 class OutputLineHandlerSafe(logging.Handler):
@@ -17,15 +29,19 @@ class OutputLineHandlerSafe(logging.Handler):
         logging.INFO: Output.TAG_INFO,
     }
 
-    def __init__(self, output_queue_func, *args):
+    def __init__(self, output_queue_chunks_func, *args):
         super().__init__(*args)
-        self.output_queue_func = output_queue_func
-        self.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+        self.output_queue_chunks_func = output_queue_chunks_func
+        self.setFormatter(logging.Formatter("[%(threadName)s] %(message)s"))
 
     def emit(self, record):
-        levelname, *msg = self.format(record).split(":")
-        self.output_queue_func(levelname, self.LEVELNO_TAG_MAP[record.levelno], end="")
-        self.output_queue_func(":" + ":".join(msg))
+        # only the level name is tagged, queued together with the message
+        self.output_queue_chunks_func(
+            (
+                (record.levelname, self.LEVELNO_TAG_MAP[record.levelno]),
+                (": " + self.format(record) + "\n", ()),
+            )
+        )
 
 
 class App(tk.Tk):
@@ -34,19 +50,41 @@ class App(tk.Tk):
 
         self.title("coffe probe tester")
 
+        # one list of serial ports shared by every component
+        self.port_watcher = utils.SerialPortWatcher(self.handle_serial_ports_change)
+        self.serial_port_changes = queue.Queue()
+        # lines printed from worker threads
+        self.output_pump = OutputPump(self)
+        # every flash and test job
+        self.jobs = jobs.JobEngine()
+        os.makedirs(LOG_DIRECTORY, exist_ok=True)
+        self.result_store = results.open_result_store(RESULTS_DATABASE)
+        # station profile selected in the flash panel, None to set everything by hand
+        self.profile = None
+
         self.setup_style()
         self.setup_gui()
         self.setup_loggers()
 
-        self.after(1000, self.handle_periodic_check)
+        # start watching once the main loop runs, changes are posted to it
+        self.after_idle(self.port_watcher.start)
+        # the programming and modbus stacks are imported once the window is shown
+        self.after_idle(self.start_warm_up)
+        self.bind("<<SerialPortsChanged>>", self.handle_serial_ports_changed)
+        self.protocol("WM_DELETE_WINDOW", self.handle_close)
 
     def setup_gui(self):
         # set up widgets
         self.mainframe = ttk.Frame(self, padding=(15, 8, 15, 15))
         self.flasharg = FlashArg(self, self.mainframe)
-        self.flashoutput = Output(self, self.mainframe)
+        self.flashoutput = Output(
+            self, self.mainframe, os.path.join(LOG_DIRECTORY, "flash.log")
+        )
         self.testarg = TestArg(self, self.mainframe)
-        self.testoutput = Output(self, self.mainframe)
+        self.testoutput = Output(
+            self, self.mainframe, os.path.join(LOG_DIRECTORY, "test.log")
+        )
+        self.dashboard = Dashboard(self, self.mainframe)
 
         # set up layout
         self.mainframe.grid(sticky="nswe")
@@ -54,6 +92,7 @@ class App(tk.Tk):
         self.flashoutput.grid(sticky="nswe", row=0, column=1, pady=(0, 6))
         self.testarg.grid(sticky="nswe", row=1, column=0, padx=(0, 6))
         self.testoutput.grid(sticky="nswe", row=1, column=1)
+        self.dashboard.grid(sticky="nswe", row=2, column=0, columnspan=2, pady=(6, 0))
 
         # set up how extra space is used
         self.grid_rowconfigure(0, weight=1)
@@ -99,19 +138,59 @@ class App(tk.Tk):
         # redirect pymcuprog logs to output text widget
         pymcuprog_logger = logging.getLogger("pymcuprog")
         pymcuprog_logger.setLevel(logging.INFO)  # no debug logs
-        logger_handler = OutputLineHandlerSafe(self.flashoutput.queue)
+        logger_handler = OutputLineHandlerSafe(self.flashoutput.queue_chunks)
         pymcuprog_logger.addHandler(logger_handler)
+        # and the flash statistics logged by utils
+        utils.logger.setLevel(logging.INFO)
+        utils.logger.addHandler(logger_handler)
 
     """
-    Interval Handler
+    Event Handlers
     """
 
-    def handle_periodic_check(self):
-        # update available serial ports
-        serial_ports = utils.get_formatted_serial_ports()
-        self.flasharg.set_available_formatted_serial_ports(serial_ports)
-        self.testarg.set_available_formatted_serial_ports(serial_ports)
-        self.after(1000, self.handle_periodic_check)
+    def start_warm_up(self):
+        threading.Thread(target=utils.warm_up, name="warm up", daemon=True).start()
+
+    def handle_close(self):
+        # the jobs still running may wait for the main loop while holding a UPDI
+        # session, so it keeps running until they are released by another thread
+        self.withdraw()
+        self.port_watcher.stop()
+        self.jobs.cancel_all()
+        threading.Thread(target=self.release, name="close").start()
+
+    def release(self):
+        # release the UPDI adapters and modbus buses kept open between jobs
+        self.jobs.shutdown()
+        # the cancelled pipeline jobs waited for their devices, stop the workers
+        # before the ports and the result store go away
+        self.flasharg.pipeline.close()
+        utils.updi_sessions.close_all()
+        utils.modbus_pool.close_all()
+        self.flashoutput.close()
+        self.testoutput.close()
+        self.result_store.close()
+        metrics.cycle_metrics.export(METRICS_FILE)
+        self.output_pump.post(self.destroy)
+
+    def handle_serial_ports_change(self, serial_ports, added, removed):
+        # called from the port watcher thread, wake up the main loop
+        self.serial_port_changes.put((serial_ports, added, removed))
+        try:
+            self.event_generate("<<SerialPortsChanged>>", when="tail")
+        except (RuntimeError, tk.TclError):
+            # the window is being destroyed
+            pass
+
+    def handle_serial_ports_changed(self, *args):
+        while not self.serial_port_changes.empty():
+            serial_ports, added, removed = self.serial_port_changes.get_nowait()
+            self.flasharg.update_available_formatted_serial_ports(
+                serial_ports, added, removed
+            )
+            self.testarg.update_available_formatted_serial_ports(
+                serial_ports, added, removed
+            )
 
 
 if __name__ == "__main__":
@@ -1,15 +1,20 @@
 # -*- mode: python ; coding: utf-8 -*-
+from PyInstaller.utils.hooks import collect_submodules
 
 
 block_cipher = None
 
+# pymcuprog imports the module of the device by name, any profile may pick one
+device_modules = collect_submodules('pymcuprog.deviceinfo.devices')
+
 
 a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
-    datas=[],
-    hiddenimports=['pymcuprog.deviceinfo.devices.attiny202'],
+    # the station profiles, next to the modules like profiles.PROFILES_DIRECTORY
+    datas=[('profiles', 'profiles')],
+    hiddenimports=device_modules,
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -21,20 +26,18 @@ a = Analysis(
 )
 pyz = PYZ(a.pure, a.zipped_data, cipher=block_cipher)
 
+# one folder build: a one file build unpacks everything to a temporary folder, and
+# upx decompresses every library, on each launch
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.zipfiles,
-    a.datas,
     [],
+    exclude_binaries=True,
     name='coffe-probe-tester',
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
-    upx_exclude=[],
-    runtime_tmpdir=None,
+    upx=False,
     console=False,
     disable_windowed_traceback=False,
     argv_emulation=False,
@@ -42,3 +45,13 @@ exe = EXE(
     codesign_identity=None,
     entitlements_file=None,
 )
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.zipfiles,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='coffe-probe-tester',
+)
@@ -0,0 +1,199 @@
+import json
+import math
+import time
+import threading
+from collections import deque
+
+# histogram buckets grow by this factor, every percentile is within ~10%
+HISTOGRAM_BUCKET_GROWTH = 2**0.25
+# seconds of the smallest bucket, anything faster ends up in it
+HISTOGRAM_BUCKET_MIN = 0.001
+# throughput is measured on the units completed in the last hour
+THROUGHPUT_WINDOW = 3600
+# and never on less than a minute, a single unit is not a rate
+THROUGHPUT_MIN_SPAN = 60
+
+# the total time of a unit, from the first phase to the result
+CYCLE = "cycle"
+
+OPERATION_FLASH = "flash"
+OPERATION_TEST = "test"
+
+
+class Histogram:
+    # log spaced buckets, constant memory however many samples are added
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, value):
+        bucket = 0
+        if value > HISTOGRAM_BUCKET_MIN:
+            bucket = math.ceil(
+                math.log(value / HISTOGRAM_BUCKET_MIN, HISTOGRAM_BUCKET_GROWTH)
+            )
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        # q between 0 and 100, None without samples
+        if not self.count:
+            return None
+
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                break
+        # geometric middle of the bucket, never outside the samples
+        upper = HISTOGRAM_BUCKET_MIN * HISTOGRAM_BUCKET_GROWTH**bucket
+        value = upper / HISTOGRAM_BUCKET_GROWTH**0.5
+        return min(max(value, self.min), self.max)
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "mean": self.mean(),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            # upper bound in seconds -> samples
+            "buckets": {
+                f"{HISTOGRAM_BUCKET_MIN * HISTOGRAM_BUCKET_GROWTH**bucket:.6g}": count
+                for bucket, count in sorted(self.buckets.items())
+            },
+        }
+
+
+class StationMetrics:
+    # phase timings and throughput of one operation on one station
+
+    def __init__(self):
+        self.phases = {}
+        self.completed = deque()
+        self.units = 0
+        self.passed = 0
+
+    def add_phase(self, phase, seconds):
+        self.phases.setdefault(phase, Histogram()).add(seconds)
+
+    def add_unit(self, success, now):
+        self.units += 1
+        self.passed += bool(success)
+        self.completed.append(now)
+
+    def units_per_hour(self, now):
+        while self.completed and self.completed[0] < now - THROUGHPUT_WINDOW:
+            self.completed.popleft()
+        if not self.completed:
+            return 0.0
+        span = max(now - self.completed[0], THROUGHPUT_MIN_SPAN)
+        return len(self.completed) * 3600 / span
+
+
+class Metrics:
+    # thread safe registry of the timings of every station, a station being a
+    # UPDI adapter for the flash and a modbus bus for the test
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stations = {}
+        self.started = time.time()
+
+    def _get(self, operation, station):
+        key = (operation, station)
+        station_metrics = self.stations.get(key)
+        if station_metrics is None:
+            station_metrics = self.stations[key] = StationMetrics()
+        return station_metrics
+
+    def record_unit(self, operation, station, cycle, success, phases=None):
+        # one completed unit, cycle is its total time and phases maps the name
+        # of every phase to its seconds
+        now = time.monotonic()
+        with self.lock:
+            station_metrics = self._get(operation, station)
+            for phase, seconds in (phases or {}).items():
+                station_metrics.add_phase(phase, seconds)
+            station_metrics.add_phase(CYCLE, cycle)
+            station_metrics.add_unit(success, now)
+
+    def reset(self):
+        with self.lock:
+            self.stations.clear()
+            self.started = time.time()
+
+    def summary(self):
+        # [(operation, station, units, passed, units per hour, p50 and p95 of the
+        # cycle, slowest phase by p95)] for the dashboard
+        now = time.monotonic()
+        rows = []
+        with self.lock:
+            for (operation, station), station_metrics in sorted(self.stations.items()):
+                cycle = station_metrics.phases.get(CYCLE, Histogram())
+                phases = {
+                    phase: histogram.percentile(95)
+                    for phase, histogram in station_metrics.phases.items()
+                    if phase != CYCLE
+                }
+                slowest = max(phases, key=phases.get) if phases else None
+                rows.append(
+                    (
+                        operation,
+                        station,
+                        station_metrics.units,
+                        station_metrics.passed,
+                        station_metrics.units_per_hour(now),
+                        cycle.percentile(50),
+                        cycle.percentile(95),
+                        slowest,
+                    )
+                )
+        return rows
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "started": self.started,
+                "timestamp": time.time(),
+                "stations": [
+                    {
+                        "operation": operation,
+                        "station": station,
+                        "units": station_metrics.units,
+                        "passed": station_metrics.passed,
+                        "units_per_hour": station_metrics.units_per_hour(now),
+                        "phases": {
+                            phase: histogram.to_dict()
+                            for phase, histogram in station_metrics.phases.items()
+                        },
+                    }
+                    for (operation, station), station_metrics in sorted(
+                        self.stations.items()
+                    )
+                ],
+            }
+
+    def export(self, filename):
+        snapshot = self.snapshot()
+        with open(filename, "w") as metrics_file:
+            json.dump(snapshot, metrics_file, indent=2)
+
+
+# every flash and test of this process
+cycle_metrics = Metrics()
@@ -0,0 +1,275 @@
+import time
+import queue
+import heapq
+import itertools
+import threading
+
+import utils
+
+# devices waiting for each UPDI adapter, submit blocks beyond this
+PIPELINE_FLASH_QUEUE_SIZE = 4
+# flashed devices waiting for each modbus bus, the adapter waits beyond this
+PIPELINE_TEST_QUEUE_SIZE = 16
+
+
+class DutStage:
+    QUEUED = "queued"
+    FLASHING = "flashing"
+    FLASH_FAILED = "flash failed"
+    TEST_QUEUED = "test queued"
+    TESTING = "testing"
+    PASSED = "passed"
+    FAILED = "failed"
+
+    DONE = (FLASH_FAILED, PASSED, FAILED)
+
+
+class DutCancelled(Exception):
+    pass
+
+
+class Dut:
+    # one device under test, tracked through the flash and the test stage
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        flash_port,
+        test_port,
+        slave_address,
+        filename,
+        flash_options=None,
+        deadline=None,
+        test_options=None,
+    ):
+        self.id = next(Dut._ids)
+        self.flash_port = flash_port
+        self.test_port = test_port
+        self.slave_address = slave_address
+        self.filename = filename
+        self.flash_options = flash_options or {}
+        self.deadline = deadline
+        # modbus settings and registers, keyword arguments of utils.modbus_connect
+        self.test_options = test_options or {}
+
+        self.stage = None
+        # monotonic time each stage was entered
+        self.times = {}
+        # filled by utils.flash_file
+        self.report = {}
+        # final ProbeStatus, or the exception that stopped the test
+        self.result = None
+        # (seconds since the start of the test, state)
+        self.transitions = []
+        # set once the device left the flash stage, its adapter is free
+        self.flashed = threading.Event()
+        self.done = threading.Event()
+        self.cancelled = False
+
+    def cancel(self):
+        # thread safe, a queued device is never flashed, one being tested stops at
+        # its next poll
+        self.cancelled = True
+
+    def get_stage_duration(self, stage, next_stage):
+        if stage not in self.times or next_stage not in self.times:
+            return None
+        return self.times[next_stage] - self.times[stage]
+
+    def get_flash_duration(self):
+        if DutStage.FLASH_FAILED in self.times:
+            return self.get_stage_duration(DutStage.FLASHING, DutStage.FLASH_FAILED)
+        return self.get_stage_duration(DutStage.FLASHING, DutStage.TEST_QUEUED)
+
+    def get_test_duration(self):
+        return self.get_stage_duration(DutStage.TESTING, self.stage)
+
+
+class Pipeline:
+    # the flash of a device overlaps the test of the ones flashed before it: every
+    # UPDI adapter and every modbus bus has its own worker, fed by a bounded queue
+    # event_func(dut) is called from the workers on every stage change
+
+    def __init__(
+        self,
+        event_func=None,
+        flash_queue_size=PIPELINE_FLASH_QUEUE_SIZE,
+        test_queue_size=PIPELINE_TEST_QUEUE_SIZE,
+    ):
+        self.event_func = event_func
+        self.flash_queue_size = flash_queue_size
+        self.test_queue_size = test_queue_size
+        self.lock = threading.Lock()
+        # port -> (queue, worker thread)
+        self.flash_workers = {}
+        self.test_workers = {}
+
+    def submit(self, dut):
+        # blocks while the queue of the adapter is full
+        self._set_stage(dut, DutStage.QUEUED)
+        self._get_queue(
+            self.flash_workers, dut.flash_port, self.flash_queue_size, self._flash
+        ).put(dut)
+
+    def close(self):
+        # wait for every submitted device, then stop the workers
+        with self.lock:
+            flash_workers = list(self.flash_workers.values())
+            self.flash_workers.clear()
+        self._stop(flash_workers)
+
+        with self.lock:
+            test_workers = list(self.test_workers.values())
+            self.test_workers.clear()
+        self._stop(test_workers)
+
+    def _stop(self, workers):
+        for worker_queue, _ in workers:
+            worker_queue.put(None)
+        for _, thread in workers:
+            thread.join()
+
+    def _get_queue(self, workers, serial_port, size, target):
+        with self.lock:
+            worker = workers.get(serial_port)
+            if worker is None:
+                worker_queue = queue.Queue(maxsize=size)
+                # the worker is named after its port, like its log records
+                thread = threading.Thread(
+                    target=target,
+                    args=[worker_queue],
+                    name=serial_port,
+                    daemon=True,
+                )
+                worker = workers[serial_port] = (worker_queue, thread)
+                thread.start()
+        return worker[0]
+
+    def _set_stage(self, dut, stage):
+        dut.stage = stage
+        dut.times[stage] = time.monotonic()
+        if stage not in (DutStage.QUEUED, DutStage.FLASHING):
+            dut.flashed.set()
+
+        if self.event_func:
+            try:
+                self.event_func(dut)
+            except Exception:
+                # the device still goes through its stages
+                utils.logger.exception("%s: stage %s", dut.flash_port, stage)
+
+        if stage in DutStage.DONE:
+            dut.done.set()
+
+    """
+    Flash stage
+    """
+
+    def _flash(self, flash_queue):
+        while True:
+            dut = flash_queue.get()
+            if dut is None:
+                return
+
+            if dut.cancelled:
+                dut.report.update(success=False, error="cancelled")
+                self._set_stage(dut, DutStage.FLASH_FAILED)
+                continue
+
+            self._set_stage(dut, DutStage.FLASHING)
+            try:
+                success = utils.flash_file(
+                    dut.filename, dut.flash_port, report=dut.report, **dut.flash_options
+                )
+            except Exception as error:
+                # the worker keeps serving its adapter
+                utils.logger.exception("%s: flash failed", dut.flash_port)
+                dut.report.update(success=False, error=str(error))
+                success = False
+            if not success:
+                self._set_stage(dut, DutStage.FLASH_FAILED)
+                continue
+
+            # the next device is flashed while this one is tested, this blocks
+            # only when the test stage is far behind
+            self._set_stage(dut, DutStage.TEST_QUEUED)
+            self._get_queue(
+                self.test_workers, dut.test_port, self.test_queue_size, self._test
+            ).put(dut)
+
+    """
+    Test stage
+    """
+
+    def _test(self, test_queue):
+        # one thread owns the bus, probes joining while others are being tested
+        # are polled together, like utils.modbus_test_bus does
+        pending = []
+        running = True
+
+        while running or pending:
+            now = time.monotonic()
+            if pending and pending[0][0] <= now:
+                _, _, dut, probe_test = heapq.heappop(pending)
+                self._poll(pending, dut, probe_test)
+                continue
+
+            timeout = pending[0][0] - now if pending else None
+            if not running:
+                time.sleep(timeout)
+                continue
+
+            # wait for the next probe due or for a new device
+            try:
+                dut = test_queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+
+            if dut is None:
+                running = False
+            else:
+                self._start_test(pending, dut)
+
+    def _start_test(self, pending, dut):
+        self._set_stage(dut, DutStage.TESTING)
+        start = time.monotonic()
+
+        def handle_state(status):
+            dut.transitions.append((time.monotonic() - start, status.state))
+
+        try:
+            if dut.cancelled:
+                raise DutCancelled("test cancelled")
+            instr = utils.modbus_connect(
+                dut.test_port, dut.slave_address, **dut.test_options
+            )
+            utils.modbus_set_cmd(instr, 1)
+        except Exception as error:
+            # any error fails this device only, the worker keeps owning the bus
+            dut.result = error
+            self._set_stage(dut, DutStage.FAILED)
+            return
+
+        probe_test = utils.ProbeTest(instr, handle_state, dut.deadline)
+        heapq.heappush(pending, (time.monotonic(), dut.id, dut, probe_test))
+
+    def _poll(self, pending, dut, probe_test):
+        try:
+            if dut.cancelled:
+                raise DutCancelled("test cancelled")
+            interval = probe_test.poll()
+        except Exception as error:
+            dut.result = error
+            self._set_stage(dut, DutStage.FAILED)
+            return
+
+        if interval is None:
+            dut.result = probe_test.result
+            if probe_test.result.state == utils.TestState.SUCCESS:
+                self._set_stage(dut, DutStage.PASSED)
+            else:
+                self._set_stage(dut, DutStage.FAILED)
+        else:
+            heapq.heappush(
+                pending, (time.monotonic() + interval, dut.id, dut, probe_test)
+            )
@@ -0,0 +1,247 @@
+import os
+import json
+import threading
+
+import utils
+import serialization
+
+# one JSON file per profile, next to main.py
+PROFILES_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "profiles"
+)
+PROFILE_EXTENSION = ".json"
+# serialization source of the profiles pushed to a station, the coordinator owns
+# the counter or the csv file and gives the record of each unit
+PROFILE_SOURCE_UNIT = "unit"
+
+# {
+#   "name": "probe-v2",
+#   "version": 3,
+#   "device": "attiny202",
+#   "firmware": "firmware/probe-v2.hex",      relative to the profile file
+#   "updi": {"baudrate": 230400, "incremental": true, "verify": "crc"},
+#   "modbus": {"baudrate": 115200, "timeout": 0.05, "addresses": "1-8",
+#              "command_coil": 0, "status_register": 1, "status_registers": 4,
+#              "transport": "rtu"},
+#   "test": {"deadline": 20},
+#   "serialization": {
+#     "fields": [{"name": "serial_number", "memory": "user_row", "offset": 0,
+#                 "format": "<I"}],
+#     "counter": {"field": "serial_number", "start": 1000, "state": "probe-v2.serial"}
+#   }                                       or "csv": "units.csv", relative as well
+#                                           or "source": "unit", records given with
+#                                           each unit, see station.py
+# }
+
+
+class ProfileError(ValueError):
+    pass
+
+
+class Profile:
+    # everything a station needs to flash and test one probe variant
+
+    def __init__(self, data, filename=None):
+        self.filename = filename
+        try:
+            self.name = str(data["name"])
+            self.version = int(data.get("version", 1))
+            self.device = str(data.get("device", utils.UPDI_DEVICE_DEFAULT)).lower()
+
+            firmware = data.get("firmware")
+            self.firmware = self._get_path(firmware) if firmware else None
+
+            updi = data.get("updi", {})
+            self.baudrate = updi.get("baudrate", utils.UPDI_BAUDRATE_DEFAULT)
+            if self.baudrate != utils.UPDI_BAUDRATE_AUTO:
+                self.baudrate = int(self.baudrate)
+            self.incremental = bool(updi.get("incremental", False))
+            self.verify = updi.get("verify", utils.VERIFY_READBACK)
+            if self.verify not in utils.VERIFY_MODES:
+                raise ValueError(f"unknown verify {self.verify}")
+
+            modbus = data.get("modbus", {})
+            self.modbus_settings = utils.ModbusSettings(
+                baudrate=int(
+                    modbus.get("baudrate", utils.MODBUS_SETTINGS_DEFAULT.baudrate)
+                ),
+                timeout=float(
+                    modbus.get("timeout", utils.MODBUS_SETTINGS_DEFAULT.timeout)
+                ),
+                transport=modbus.get(
+                    "transport", utils.MODBUS_SETTINGS_DEFAULT.transport
+                ),
+            )
+            if self.modbus_settings.transport not in utils.MODBUS_TRANSPORTS:
+                raise ValueError(f"unknown transport {self.modbus_settings.transport}")
+            self.modbus_registers = utils.ModbusRegisters(
+                command=int(modbus.get("command_coil", utils.MODBUS_COMMAND_COIL)),
+                status=int(modbus.get("status_register", utils.MODBUS_STATUS_REGISTER)),
+                status_count=int(
+                    modbus.get("status_registers", utils.MODBUS_STATUS_REGISTERS)
+                ),
+            )
+            self.slave_addresses = utils.parse_slave_addresses(
+                str(modbus.get("addresses", utils.MODBUS_SLAVE_ADDRESS_DEFAULT))
+            )
+
+            deadline = data.get("test", {}).get("deadline")
+            self.deadline = float(deadline) if deadline else None
+
+            self.serializer = None
+            if data.get("serialization"):
+                self.serializer = self._get_serializer(data["serialization"])
+        except (KeyError, TypeError, ValueError, AttributeError, OSError) as error:
+            raise ProfileError(f"{filename or 'profile'}: invalid profile, {error}")
+
+        # filled by prepare
+        self.device_memory_info = None
+        self.firmware_sha256 = None
+
+    def _get_path(self, path):
+        if self.filename:
+            return os.path.join(os.path.dirname(self.filename), path)
+        return path
+
+    def _get_serializer(self, data):
+        fields = [
+            serialization.Field(
+                str(field["name"]),
+                str(field["memory"]),
+                int(field["offset"]),
+                str(field["format"]),
+            )
+            for field in data["fields"]
+        ]
+        if data.get("source") == PROFILE_SOURCE_UNIT:
+            source = serialization.GivenSource()
+        elif "csv" in data:
+            source = serialization.CsvSource(self._get_path(data["csv"]))
+        else:
+            counter = data.get("counter", {})
+            state = counter.get("state")
+            source = serialization.CounterSource(
+                counter.get("field", fields[0].name),
+                int(counter.get("start", 1)),
+                int(counter.get("step", 1)),
+                self._get_path(state) if state else None,
+            )
+        return serialization.Serializer(fields, source)
+
+    def __str__(self):
+        return f"{self.name} v{self.version}"
+
+    def get_flash_options(self):
+        # keyword arguments of utils.flash_file
+        return {
+            "device": self.device,
+            "baudrate": self.baudrate,
+            "incremental": self.incremental,
+            "verify": self.verify,
+            "serializer": self.serializer,
+        }
+
+    def get_test_options(self):
+        # keyword arguments of utils.modbus_connect and utils.modbus_test_bus
+        return {"settings": self.modbus_settings, "registers": self.modbus_registers}
+
+    def prepare(self, flash_ports=()):
+        # load the device description and parse the firmware ahead of the first
+        # device, so that the first flash finds everything in the caches
+        from pymcuprog.deviceinfo import deviceinfo
+        from pymcuprog.deviceinfo.deviceinfo import DeviceMemoryInfo
+
+        if self.device_memory_info is None:
+            try:
+                self.device_memory_info = DeviceMemoryInfo(
+                    deviceinfo.getdeviceinfo(self.device)
+                )
+            except ImportError:
+                raise ProfileError(f"{self}: unknown device {self.device}")
+
+        if self.firmware:
+            try:
+                utils.read_memories_from_hex_cached(
+                    self.firmware, self.device_memory_info
+                )
+            except Exception as error:
+                # missing file, or a hex file not fitting the memories of the device
+                raise ProfileError(f"{self}: invalid firmware, {error}")
+            self.firmware_sha256 = utils.get_hex_file_sha256(self.firmware)
+
+        # sessions of another device or speed are closed now rather than on the
+        # first flash, the auto speed is negotiated on the first device
+        if self.baudrate != utils.UPDI_BAUDRATE_AUTO:
+            for serial_port in flash_ports:
+                utils.updi_sessions.get(serial_port, self.device, self.baudrate)
+
+        return self
+
+
+def load_profile(filename):
+    try:
+        with open(filename) as profile_file:
+            data = json.load(profile_file)
+    except (OSError, ValueError) as error:
+        raise ProfileError(f"{filename}: {error}")
+    return Profile(data, filename)
+
+
+class ProfileRegistry:
+    # the profiles of a directory, a file is parsed again only once it changed
+
+    def __init__(self, directory=PROFILES_DIRECTORY):
+        self.directory = directory
+        # filename -> (mtime, Profile or ProfileError)
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        # returns the profiles and the errors of the invalid files
+        try:
+            filenames = sorted(
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(PROFILE_EXTENSION)
+            )
+        except FileNotFoundError:
+            filenames = []
+
+        with self.lock:
+            for filename in set(self.files) - set(filenames):
+                del self.files[filename]
+
+            for filename in filenames:
+                mtime = os.stat(filename).st_mtime_ns
+                cached = self.files.get(filename)
+                if cached and cached[0] == mtime:
+                    continue
+                try:
+                    profile = load_profile(filename)
+                except ProfileError as error:
+                    profile = error
+                self.files[filename] = (mtime, profile)
+
+            loaded = [profile for _, profile in self.files.values()]
+
+        profiles = [item for item in loaded if isinstance(item, Profile)]
+        errors = [item for item in loaded if isinstance(item, ProfileError)]
+        return sorted(profiles, key=lambda p: (p.name, p.version)), errors
+
+    def get(self, name, version=None):
+        # the latest version, unless one is asked for
+        profiles, _ = self.load()
+        matches = [
+            profile
+            for profile in profiles
+            if profile.name == name and version in (None, profile.version)
+        ]
+        if not matches:
+            if version is None:
+                raise ProfileError(f"no such profile: {name}")
+            raise ProfileError(f"no such profile: {name} v{version}")
+        return matches[-1]
+
+
+# profiles of the station, prepared profiles are kept until their file changes
+station_profiles = ProfileRegistry()
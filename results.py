@@ -0,0 +1,303 @@
+import sqlite3
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+# rows written in a single transaction, and the longest a row waits for one
+RESULTS_BATCH_SIZE = 200
+RESULTS_FLUSH_INTERVAL = 1.0
+
+OPERATION_FLASH = "flash"
+OPERATION_TEST = "test"
+
+# phases timed on every unit, a column each
+PHASES = ("connect", "erase", "write", "verify", "test")
+
+COLUMNS = (
+    "timestamp",
+    "operation",
+    "port",
+    "slave_address",
+    "firmware_file",
+    "firmware_sha256",
+    "device_id",
+    "success",
+    "error",
+    "state",
+    "error_code",
+    "measurement",
+    "firmware_version",
+    "transitions",
+    "unit_data",
+) + tuple(f"{phase}_time" for phase in PHASES)
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    operation TEXT NOT NULL,
+    port TEXT,
+    slave_address INTEGER,
+    firmware_file TEXT,
+    firmware_sha256 TEXT,
+    device_id TEXT,
+    success INTEGER NOT NULL,
+    error TEXT,
+    state INTEGER,
+    error_code INTEGER,
+    measurement INTEGER,
+    firmware_version INTEGER,
+    transitions TEXT,
+    unit_data TEXT,
+    {", ".join(f"{phase}_time REAL" for phase in PHASES)}
+);
+-- yield and timings over a time range, answered from the index alone
+CREATE INDEX IF NOT EXISTS units_operation_timestamp
+    ON units (operation, timestamp, success);
+CREATE INDEX IF NOT EXISTS units_firmware
+    ON units (firmware_sha256, operation, timestamp, success);
+CREATE INDEX IF NOT EXISTS units_device_id ON units (device_id, timestamp);
+"""
+
+# columns added after the first release, to databases created before them
+ADDED_COLUMNS = {"unit_data": "TEXT"}
+
+
+def flash_row(serial_port, report, timestamp=None):
+    # report is the dict filled by utils.flash_file
+    timings = report.get("timings", {})
+    row = {
+        "timestamp": timestamp or time.time(),
+        "operation": OPERATION_FLASH,
+        "port": serial_port,
+        "firmware_file": report.get("firmware_file"),
+        "firmware_sha256": report.get("firmware_sha256"),
+        "device_id": report.get("device_id"),
+        "success": report.get("success", False),
+        "error": report.get("error"),
+    }
+    if report.get("unit_data") is not None:
+        # serial number and calibration written to the unit
+        row["unit_data"] = json.dumps(report["unit_data"], default=str)
+    for phase in PHASES:
+        row[f"{phase}_time"] = timings.get(phase)
+    # the tool connection and the ping of the device
+    if "session" in timings or "device_id" in timings:
+        row["connect_time"] = timings.get("session", 0) + timings.get("device_id", 0)
+    return row
+
+
+def test_row(serial_port, slave_address, result, duration, transitions=(), **kwargs):
+    # result is the ProbeStatus or the exception returned by utils.modbus_test_bus
+    # transitions are (seconds since the start, state) pairs, kwargs are other
+    # columns such as the firmware hash when the probe was flashed just before
+    row = {
+        "timestamp": time.time(),
+        "operation": OPERATION_TEST,
+        "port": serial_port,
+        "slave_address": slave_address,
+        "test_time": duration,
+        "transitions": json.dumps([[round(t, 3), state] for t, state in transitions]),
+    }
+    if isinstance(result, Exception):
+        row.update(success=False, error=str(result) or type(result).__name__)
+    else:
+        row.update(result._asdict())
+        row["success"] = result.state == utils.TestState.SUCCESS
+    row.update(kwargs)
+    return row
+
+
+class ResultStore:
+    # one row per unit and operation, written by a background thread in batches
+    # so that recording a result never waits on the disk
+
+    def __init__(
+        self,
+        filename,
+        batch_size=RESULTS_BATCH_SIZE,
+        flush_interval=RESULTS_FLUSH_INTERVAL,
+    ):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows = queue.Queue()
+        self.closed = False
+
+        # create the schema before any query
+        connection = self._connect()
+        with connection:
+            connection.executescript(SCHEMA)
+            existing = {
+                row[1] for row in connection.execute("PRAGMA table_info(units)")
+            }
+            for column, column_type in ADDED_COLUMNS.items():
+                if column not in existing:
+                    connection.execute(
+                        f"ALTER TABLE units ADD COLUMN {column} {column_type}"
+                    )
+        connection.close()
+
+        self.thread = threading.Thread(target=self._run, name="results", daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.filename, timeout=10)
+        # readers never block the writer
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    """
+    Writing
+    """
+
+    def record(self, row):
+        # thread safe, returns immediately
+        if self.closed:
+            raise RuntimeError("result store closed")
+        self.rows.put(row)
+
+    def flush(self):
+        # wait until every recorded row is on disk
+        self.rows.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.rows.put(None)
+        self.thread.join()
+
+    def _run(self):
+        connection = self._connect()
+        sql = (
+            f"INSERT INTO units ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join(':' + column for column in COLUMNS)})"
+        )
+
+        stopped = False
+        while not stopped:
+            batch = [self.rows.get()]
+            batch_end = time.monotonic() + self.flush_interval
+            # collect whatever else arrives in the meantime, up to the close
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                timeout = batch_end - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.rows.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            rows = [row for row in batch if row is not None]
+            stopped = len(rows) < len(batch)
+            try:
+                with connection:
+                    connection.executemany(
+                        sql, [{**dict.fromkeys(COLUMNS), **row} for row in rows]
+                    )
+            except sqlite3.Error as error:
+                logger.error("Lost %d results: %s", len(rows), error)
+            finally:
+                for _ in batch:
+                    self.rows.task_done()
+
+        connection.close()
+
+    """
+    Queries
+    """
+
+    def query(self, sql, parameters=()):
+        # a connection per query, safe from any thread
+        connection = self._connect()
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        finally:
+            connection.close()
+
+    def yield_per_shift(
+        self,
+        since,
+        until=None,
+        operation=OPERATION_TEST,
+        shift_hours=8,
+        first_shift_hour=6,
+    ):
+        # [(shift start, units, passed)] for the units between the unix times
+        # since and until, shifts start at first_shift_hour local time
+        utc_offset = time.localtime(since).tm_gmtoff
+        shift_seconds = shift_hours * 3600
+        origin = first_shift_hour * 3600 - utc_offset
+        return self.query(
+            """
+            SELECT
+                CAST((timestamp - :origin) / :shift AS INTEGER) * :shift + :origin,
+                COUNT(*),
+                SUM(success)
+            FROM units
+            WHERE operation = :operation AND timestamp >= :since AND timestamp < :until
+            GROUP BY 1
+            ORDER BY 1
+            """,
+            {
+                "origin": origin,
+                "shift": shift_seconds,
+                "operation": operation,
+                "since": since,
+                "until": until if until is not None else time.time() + 1,
+            },
+        )
+
+    def yield_per_firmware(self, operation=OPERATION_FLASH, since=0):
+        # [(firmware sha256, units, passed, first unit, last unit)]
+        return self.query(
+            """
+            SELECT firmware_sha256, COUNT(*), SUM(success), MIN(timestamp), MAX(timestamp)
+            FROM units
+            WHERE firmware_sha256 IS NOT NULL AND operation = ? AND timestamp >= ?
+            GROUP BY firmware_sha256
+            ORDER BY MAX(timestamp) DESC
+            """,
+            (operation, since),
+        )
+
+    def timings(self, since, until=None, firmware_sha256=None):
+        # average and maximum seconds of every phase, only on succesful units
+        columns = ", ".join(f"AVG({phase}_time), MAX({phase}_time)" for phase in PHASES)
+        sql = f"SELECT COUNT(*), {columns} FROM units WHERE success AND timestamp >= ?"
+        parameters = [since]
+        if until is not None:
+            sql += " AND timestamp < ?"
+            parameters.append(until)
+        if firmware_sha256 is not None:
+            sql += " AND firmware_sha256 = ?"
+            parameters.append(firmware_sha256)
+
+        count, *values = self.query(sql, parameters)[0]
+        result = {"units": count}
+        for index, phase in enumerate(PHASES):
+            result[phase] = (values[2 * index], values[2 * index + 1])
+        return result
+
+    def device_history(self, device_id):
+        # every operation on one device, oldest first
+        return self.query(
+            "SELECT * FROM units WHERE device_id = ? ORDER BY timestamp",
+            (device_id,),
+        )
+
+
+def open_result_store(filename):
+    # the store is closed, and its last batch written, at exit
+    store = ResultStore(filename)
+    atexit.register(store.close)
+    return store
@@ -0,0 +1,173 @@
+import time
+import struct
+
+import minimalmodbus
+
+# the requests of the probe register set
+RTU_READ_HOLDING_REGISTERS = 3
+RTU_WRITE_SINGLE_COIL = 5
+RTU_COIL_ON = 0xFF00
+RTU_COIL_OFF = 0x0000
+
+RTU_EXCEPTION_BIT = 0x80
+# address, function code, exception code and crc, also the first bytes of any answer
+RTU_EXCEPTION_LENGTH = 5
+RTU_CRC_LENGTH = 2
+
+# frames are separated by 3.5 characters of silence
+RTU_SILENT_CHARACTERS = 3.5
+
+RTU_SLAVE_ERRORS = {
+    1: (minimalmodbus.IllegalRequestError, "illegal function"),
+    2: (minimalmodbus.IllegalRequestError, "illegal data address"),
+    3: (minimalmodbus.IllegalRequestError, "illegal data value"),
+    4: (minimalmodbus.SlaveReportedException, "device failure"),
+    6: (minimalmodbus.SlaveDeviceBusyError, "device busy"),
+}
+
+
+def _build_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+RTU_CRC_TABLE = _build_crc_table()
+
+
+def rtu_crc(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ RTU_CRC_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def get_character_bits(port):
+    # start bit, data bits, parity bit and stop bits of the port settings
+    parity = getattr(port, "parity", "N")
+    return (
+        1
+        + getattr(port, "bytesize", 8)
+        + (0 if parity in (None, "N") else 1)
+        + getattr(port, "stopbits", 1)
+    )
+
+
+def get_silent_interval(port):
+    return RTU_SILENT_CHARACTERS * get_character_bits(port) / port.baudrate
+
+
+def set_low_latency(port):
+    # USB adapters hold the received bytes for their latency timer, up to 16 ms on
+    # FTDI, before passing them on. Linux only, and not every driver supports it
+    try:
+        port.set_low_latency_mode(True)
+    except (AttributeError, NotImplementedError, ValueError):
+        return False
+    return True
+
+
+class RtuBus:
+    # the frames of one serial port, the silent interval is kept across slaves
+
+    def __init__(self, port):
+        self.port = port
+        self.silent_interval = get_silent_interval(port)
+        # end of the last frame received
+        self.last_frame = 0.0
+
+    def transaction(self, request, response_length):
+        # sends request, without crc, and reads exactly the response_length bytes of
+        # the answer, or the exception frame. Returns the answer without address,
+        # function code and crc
+        delay = self.last_frame + self.silent_interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        # a late answer to a previous request
+        self.port.reset_input_buffer()
+        crc = rtu_crc(request)
+        self.port.write(request + struct.pack("<H", crc))
+
+        response = self.port.read(RTU_EXCEPTION_LENGTH)
+        if len(response) == RTU_EXCEPTION_LENGTH and not (
+            response[1] & RTU_EXCEPTION_BIT
+        ):
+            response += self.port.read(response_length - RTU_EXCEPTION_LENGTH)
+        self.last_frame = time.monotonic()
+
+        if not response:
+            raise minimalmodbus.NoResponseError(
+                "No communication with the instrument (no answer)"
+            )
+        if len(response) < RTU_EXCEPTION_LENGTH or rtu_crc(response) != 0:
+            raise minimalmodbus.InvalidResponseError(
+                f"Invalid response {response.hex()} to {request.hex()}"
+            )
+        if response[0] != request[0]:
+            raise minimalmodbus.InvalidResponseError(
+                f"Wrong slave address {response[0]} instead of {request[0]}"
+            )
+        if response[1] == request[1] | RTU_EXCEPTION_BIT:
+            error_type, message = RTU_SLAVE_ERRORS.get(
+                response[2], (minimalmodbus.SlaveReportedException, "error")
+            )
+            raise error_type(f"Slave reported {message}, code {response[2]}")
+        if response[1] != request[1]:
+            raise minimalmodbus.InvalidResponseError(
+                f"Wrong function code {response[1]} instead of {request[1]}"
+            )
+        if len(response) != response_length:
+            raise minimalmodbus.InvalidResponseError(
+                f"Response of {len(response)} bytes instead of {response_length}"
+            )
+        return response[2:-RTU_CRC_LENGTH]
+
+
+class RtuInstrument:
+    # the minimalmodbus.Instrument calls of utils, with the same exceptions
+
+    def __init__(self, bus, slave_address):
+        self.bus = bus
+        self.address = slave_address
+        self.serial = bus.port
+
+    def write_bit(self, registeraddress, value):
+        request = struct.pack(
+            ">BBHH",
+            self.address,
+            RTU_WRITE_SINGLE_COIL,
+            registeraddress,
+            RTU_COIL_ON if value else RTU_COIL_OFF,
+        )
+        # the request is echoed
+        payload = self.bus.transaction(request, len(request) + RTU_CRC_LENGTH)
+        if payload != request[2:]:
+            raise minimalmodbus.InvalidResponseError(
+                f"Wrong echo {payload.hex()} of {request.hex()}"
+            )
+
+    def read_registers(self, registeraddress, number_of_registers):
+        request = struct.pack(
+            ">BBHH",
+            self.address,
+            RTU_READ_HOLDING_REGISTERS,
+            registeraddress,
+            number_of_registers,
+        )
+        # address, function code, byte count, registers and crc
+        payload = self.bus.transaction(
+            request, 3 + 2 * number_of_registers + RTU_CRC_LENGTH
+        )
+        if payload[0] != 2 * number_of_registers:
+            raise minimalmodbus.InvalidResponseError(
+                f"Wrong byte count {payload[0]} for {number_of_registers} registers"
+            )
+        return list(struct.unpack(f">{number_of_registers}H", payload[1:]))
+
+    def read_register(self, registeraddress):
+        return self.read_registers(registeraddress, 1)[0]
@@ -0,0 +1,253 @@
+import os
+import csv
+import heapq
+import struct
+import threading
+from collections import namedtuple
+
+# same fields as the segments returned by pymcuprog read_memories_from_hex
+MemorySegment = namedtuple("MemorySegment", ["data", "offset", "memory_info"])
+
+# a per-unit value at a fixed place of a memory, packed with a struct format,
+# e.g. Field("serial_number", "user_row", 0, "<I")
+Field = namedtuple("Field", ["name", "memory", "offset", "format"])
+
+# the flash is covered by the cached image checksum, patch the other memories
+SERIALIZATION_MEMORIES = ("eeprom", "user_row")
+
+
+class SerializationError(ValueError):
+    pass
+
+
+def _parse_value(field, value):
+    # csv cells are strings, convert them to what the struct format packs
+    if not isinstance(value, str):
+        return value
+    kind = field.format[-1]
+    if kind in "sp":
+        return value.encode("ascii")
+    if kind in "efd":
+        return float(value)
+    return int(value, 0)
+
+
+def encode_field(field, value):
+    try:
+        return struct.pack(field.format, _parse_value(field, value))
+    except (struct.error, ValueError) as error:
+        raise SerializationError(f"{field.name}: can't encode {value!r}, {error}")
+
+
+"""
+Record sources
+"""
+
+
+class CounterSource:
+    # consecutive numbers, the number of a failed flash goes to the next unit
+    # the next number is kept in state_filename, if given, across restarts, the
+    # numbers given back are lost on a restart
+
+    def __init__(self, field="serial_number", start=1, step=1, state_filename=None):
+        self.field = field
+        self.step = step
+        self.state_filename = state_filename
+        self.lock = threading.Lock()
+        # numbers given back, the lowest one is used first
+        self.released = []
+
+        self.next_value = start
+        if state_filename and os.path.exists(state_filename):
+            with open(state_filename) as state_file:
+                self.next_value = max(start, int(state_file.read().strip() or start))
+
+    def next_record(self, report):
+        with self.lock:
+            if self.released:
+                return {self.field: heapq.heappop(self.released)}
+            value = self.next_value
+            self.next_value += self.step
+            if self.state_filename:
+                # written before the number is used, replaced atomically
+                temporary = self.state_filename + ".tmp"
+                with open(temporary, "w") as state_file:
+                    state_file.write(str(self.next_value))
+                os.replace(temporary, self.state_filename)
+        return {self.field: value}
+
+    def release(self, record):
+        with self.lock:
+            heapq.heappush(self.released, record[self.field])
+
+
+class CsvSource:
+    # one row per unit, in file order, the header names the fields
+
+    def __init__(self, filename, skip=0):
+        self.filename = filename
+        with open(filename, newline="") as csv_file:
+            self.rows = list(csv.DictReader(csv_file))
+        self.index = skip
+        self.lock = threading.Lock()
+        # indexes of the rows given back, the first row of the file is used first
+        self.released = []
+
+    def next_record(self, report):
+        with self.lock:
+            if self.released:
+                return dict(self.rows[heapq.heappop(self.released)])
+            if self.index >= len(self.rows):
+                raise SerializationError(f"{self.filename}: no rows left")
+            row = self.rows[self.index]
+            self.index += 1
+        return dict(row)
+
+    def release(self, record):
+        with self.lock:
+            heapq.heappush(self.released, self.rows.index(record))
+
+
+class CallbackSource:
+    # func(report) returns the record, the report already holds the device id,
+    # e.g. to look up the calibration of that device
+
+    def __init__(self, func):
+        self.func = func
+
+    def next_record(self, report):
+        return self.func(report)
+
+    def release(self, record):
+        # the record is looked up again for the next device
+        pass
+
+
+class GivenSource:
+    # the record of one unit, taken by whoever owns the real source, e.g. the
+    # coordinator of a station line
+
+    def __init__(self, record=None):
+        self.record = record
+
+    def next_record(self, report):
+        if self.record is None:
+            raise SerializationError("no record was given for this unit")
+        return dict(self.record)
+
+    def release(self, record):
+        # the owner of the source gets it back
+        pass
+
+
+class Serializer:
+    # per-unit data patched over the cached image of the hex file
+
+    def __init__(self, fields, source):
+        for field in fields:
+            if field.memory not in SERIALIZATION_MEMORIES:
+                raise SerializationError(
+                    f"{field.name}: can't patch the {field.memory} memory"
+                )
+        self.fields = list(fields)
+        self.source = source
+
+    def next_record(self, report):
+        return self.source.next_record(report)
+
+    def next_unit(self, report):
+        # returns the record of the next unit and its (memory, offset, bytes)
+        record = self.next_record(report)
+        patches = []
+        for field in self.fields:
+            if field.name not in record:
+                raise SerializationError(f"{field.name}: missing from the record")
+            patches.append(
+                (field.memory, field.offset, encode_field(field, record[field.name]))
+            )
+        return record, patches
+
+    def release(self, record):
+        # the flash of the unit failed, its record goes to the next unit
+        self.source.release(record)
+
+
+def _find_segment(segments, memory_name, offset, length, skip=None):
+    from pymcuprog.deviceinfo.deviceinfokeys import DeviceMemoryInfoKeys
+
+    for index, segment in enumerate(segments):
+        if (
+            index != skip
+            and segment.memory_info[DeviceMemoryInfoKeys.NAME] == memory_name
+            and segment.offset < offset + length
+            and offset < segment.offset + len(segment.data)
+        ):
+            return index
+    return None
+
+
+def apply_patches(memory_segments, patches, device_memory_info):
+    # copy on write: the segments holding a patch are copied, every other one is
+    # still the segment shared through the hex cache
+    from pymcuprog.deviceinfo.deviceinfokeys import DeviceMemoryInfoKeys
+
+    if not patches:
+        return memory_segments
+
+    segments = list(memory_segments)
+    copied = set()
+    # memory name -> index of the last segment made of patches only
+    created = {}
+    for memory_name, offset, data in patches:
+        memory_info = device_memory_info.mem_by_name.get(memory_name)
+        if memory_info is None:
+            raise SerializationError(f"no {memory_name} memory on this device")
+        if offset + len(data) > memory_info[DeviceMemoryInfoKeys.SIZE]:
+            raise SerializationError(
+                f"{len(data)} bytes at {offset} are outside the {memory_name} memory"
+            )
+
+        index = _find_segment(segments, memory_name, offset, len(data))
+        if index is None:
+            segment = MemorySegment(bytearray(data), offset, memory_info)
+            index = created.get(memory_name)
+            if index is not None:
+                # merge the patches of a memory, a page is written once, unless
+                # the gap between them holds content of the hex file
+                first = min(segments[index].offset, offset)
+                last = max(
+                    segments[index].offset + len(segments[index].data),
+                    offset + len(data),
+                )
+                if (
+                    _find_segment(segments, memory_name, first, last - first, index)
+                    is None
+                ):
+                    merged = bytearray([0xFF]) * (last - first)
+                    for part in (segments[index], segment):
+                        start = part.offset - first
+                        merged[start : start + len(part.data)] = part.data
+                    segments[index] = MemorySegment(merged, first, memory_info)
+                    continue
+            segments.append(segment)
+            created[memory_name] = len(segments) - 1
+            copied.add(len(segments) - 1)
+            continue
+
+        segment = segments[index]
+        if offset < segment.offset or offset + len(data) > segment.offset + len(
+            segment.data
+        ):
+            raise SerializationError(
+                f"{len(data)} bytes at {offset} cross the end of the hex file "
+                f"content of the {memory_name} memory"
+            )
+        if index not in copied:
+            segment = segments[index] = MemorySegment(
+                bytearray(segment.data), segment.offset, memory_info
+            )
+            copied.add(index)
+        start = offset - segment.offset
+        segment.data[start : start + len(data)] = data
+
+    return segments
@@ -0,0 +1,586 @@
+#!/usr/bin/python3
+# capture of the serial traffic of the modbus buses and UPDI adapters, to see where
+# the time of a slow test or flash goes
+#
+#   python cli.py --trace logs/trace test -p /dev/ttyUSB2 -a 1-4
+#   python serialtrace.py analyze logs/trace/*.trace
+#   python serialtrace.py replay logs/trace/modbus-ttyUSB2-*.trace -a 1-4
+#
+# a trace file is TRACE_MAGIC followed by records of kind, microseconds since the
+# previous record and payload length (TRACE_RECORD), then the payload
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import struct
+import argparse
+import itertools
+import threading
+from collections import namedtuple, deque
+
+import utils
+
+TRACE_MAGIC = b"CPTRACE\x01"
+TRACE_RECORD = struct.Struct("<BIH")
+TRACE_EXTENSION = ".trace"
+
+# the port settings, JSON
+TRACE_OPEN = 0
+TRACE_WRITE = 1
+# a read of every byte asked for
+TRACE_READ = 2
+# a read that returned less than asked for, after the port timeout
+TRACE_TIMEOUT = 3
+TRACE_CLOSE = 4
+
+TRACE_KIND_NAMES = {
+    TRACE_OPEN: "open",
+    TRACE_WRITE: "write",
+    TRACE_READ: "read",
+    TRACE_TIMEOUT: "timeout",
+    TRACE_CLOSE: "close",
+}
+
+# silences longer than this are reported as idle gaps
+TRACE_IDLE_GAP = 0.1
+
+# serial port prefix of a recorded trace fed back as a modbus bus,
+# e.g. replay:logs/trace/modbus-ttyUSB2-20240101-120000-1.trace
+TRACE_REPLAY_PREFIX = "replay:"
+
+# answer speed of the replayed ports, 2 answers twice as fast, 0 right away
+replay_speed = 1.0
+
+TraceRecord = namedtuple("TraceRecord", ["kind", "time", "data"])
+
+
+class TraceError(ValueError):
+    pass
+
+
+"""
+Recording
+"""
+
+
+class TraceWriter:
+    def __init__(self, filename, info):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.file = open(filename, "wb")
+        self.file.write(TRACE_MAGIC)
+        self.last = time.monotonic_ns() // 1000
+        self.record(TRACE_OPEN, json.dumps(info).encode())
+
+    def record(self, kind, data=b""):
+        with self.lock:
+            # the port may be closed from another thread, e.g. by an abort
+            if self.file is None:
+                return
+            now = time.monotonic_ns() // 1000
+            delta = min(now - self.last, 0xFFFFFFFF)
+            self.last = now
+            # longer payloads are split, the next parts at the same time
+            for start in range(0, max(len(data), 1), 0xFFFF):
+                chunk = data[start : start + 0xFFFF]
+                self.file.write(TRACE_RECORD.pack(kind, delta, len(chunk)))
+                self.file.write(chunk)
+                delta = 0
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class TracingSerial:
+    # a serial port recording its traffic, every other attribute is the port's
+
+    def __init__(self, serial, writer):
+        self.__dict__["serial"] = serial
+        self.__dict__["writer"] = writer
+
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.serial, name, value)
+
+    def write(self, data):
+        written = self.serial.write(data)
+        self.writer.record(TRACE_WRITE, bytes(data))
+        return written
+
+    def read(self, size=1):
+        data = self.serial.read(size)
+        self.writer.record(TRACE_READ if len(data) == size else TRACE_TIMEOUT, data)
+        return data
+
+    def readline(self):
+        data = self.serial.readline()
+        complete = data.endswith(b"\n")
+        self.writer.record(TRACE_READ if complete else TRACE_TIMEOUT, data)
+        return data
+
+    def close(self):
+        self.writer.record(TRACE_CLOSE)
+        self.writer.close()
+        self.serial.close()
+
+
+def _get_safe_name(serial_port):
+    if serial_port.startswith("/dev/"):
+        serial_port = serial_port[len("/dev/") :]
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", serial_port)
+
+
+class TraceCapture:
+    # opt-in: ports are wrapped only while a capture directory is set
+
+    def __init__(self):
+        self.directory = None
+        self.writers = []
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def start(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def stop(self):
+        with self.lock:
+            self.directory = None
+            writers, self.writers = self.writers, []
+        for writer in writers:
+            writer.close()
+
+    def wrap(self, serial, serial_port, kind):
+        # one file every time a port is opened
+        with self.lock:
+            if self.directory is None:
+                return serial
+            filename = os.path.join(
+                self.directory,
+                f"{kind}-{_get_safe_name(serial_port)}-"
+                f"{time.strftime('%Y%m%d-%H%M%S')}-{next(self.counter)}"
+                f"{TRACE_EXTENSION}",
+            )
+            writer = TraceWriter(
+                filename,
+                {
+                    "port": serial_port,
+                    "kind": kind,
+                    "baudrate": getattr(serial, "baudrate", None),
+                    "timeout": getattr(serial, "timeout", None),
+                    "time": time.time(),
+                },
+            )
+            self.writers = [item for item in self.writers if item.file is not None]
+            self.writers.append(writer)
+        return TracingSerial(serial, writer)
+
+
+serial_capture = TraceCapture()
+atexit.register(serial_capture.stop)
+
+
+"""
+Reading
+"""
+
+
+def read_trace(filename):
+    # returns the port settings and the records, with their time since the open
+    with open(filename, "rb") as trace_file:
+        content = trace_file.read()
+    if not content.startswith(TRACE_MAGIC):
+        raise TraceError(f"{filename}: not a trace file")
+
+    records = []
+    position = len(TRACE_MAGIC)
+    now = 0
+    while position + TRACE_RECORD.size <= len(content):
+        kind, delta, length = TRACE_RECORD.unpack_from(content, position)
+        position += TRACE_RECORD.size
+        data = content[position : position + length]
+        position += length
+        # a trace cut short by a crash ends on its last complete record
+        if len(data) < length:
+            break
+        now += delta
+        records.append(TraceRecord(kind, now / 1e6, data))
+
+    if not records or records[0].kind != TRACE_OPEN:
+        raise TraceError(f"{filename}: no port settings")
+    return json.loads(records[0].data), records[1:]
+
+
+"""
+Analysis
+"""
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def analyze_trace(filename, idle_gap=TRACE_IDLE_GAP):
+    info, records = read_trace(filename)
+
+    # a transaction is a write and the reads until the next write
+    transactions = []
+    transaction = None
+    timeouts = []
+    gaps = []
+    previous = 0.0
+    for record in records:
+        delta = record.time - previous
+        previous = record.time
+        if record.kind == TRACE_WRITE:
+            transaction = {
+                "request": record.data,
+                "time": record.time,
+                "first_byte": None,
+                "last_byte": None,
+                "timed_out": False,
+            }
+            transactions.append(transaction)
+        elif record.kind in (TRACE_READ, TRACE_TIMEOUT):
+            if record.kind == TRACE_TIMEOUT:
+                # the read blocked since the previous record
+                timeouts.append(delta)
+            if transaction:
+                if record.data:
+                    if transaction["first_byte"] is None:
+                        transaction["first_byte"] = record.time
+                    transaction["last_byte"] = record.time
+                transaction["timed_out"] |= record.kind == TRACE_TIMEOUT
+            continue
+        if delta > idle_gap:
+            gaps.append(delta)
+
+    latencies = [
+        item["last_byte"] - item["time"]
+        for item in transactions
+        if item["last_byte"] is not None and not item["timed_out"]
+    ]
+    first_bytes = [
+        item["first_byte"] - item["time"]
+        for item in transactions
+        if item["first_byte"] is not None
+    ]
+    # the same request again, after one that timed out
+    retries = sum(
+        1
+        for previous, item in zip(transactions, transactions[1:])
+        if previous["timed_out"] and previous["request"] == item["request"]
+    )
+
+    return {
+        "filename": filename,
+        "port": info.get("port"),
+        "kind": info.get("kind"),
+        "duration": records[-1].time if records else 0.0,
+        "bytes_written": sum(
+            len(record.data) for record in records if record.kind == TRACE_WRITE
+        ),
+        "bytes_read": sum(
+            len(record.data)
+            for record in records
+            if record.kind in (TRACE_READ, TRACE_TIMEOUT)
+        ),
+        "transactions": len(transactions),
+        "latency_p50": _percentile(latencies, 0.5),
+        "latency_p95": _percentile(latencies, 0.95),
+        "latency_max": max(latencies, default=None),
+        "first_byte_p50": _percentile(first_bytes, 0.5),
+        "timeouts": len(timeouts),
+        "timeout_time": sum(timeouts),
+        "retries": retries,
+        "idle_gaps": len(gaps),
+        "idle_time": sum(gaps),
+        "idle_gap_max": max(gaps, default=None),
+    }
+
+
+def _format_seconds(value):
+    return "-" if value is None else f"{value * 1000:.1f} ms"
+
+
+def format_analysis(analysis):
+    return "\n".join(
+        [
+            f"{analysis['filename']}: {analysis['kind']} {analysis['port']}, "
+            f"{analysis['duration']:.3f} s",
+            f"  {analysis['transactions']} transactions, "
+            f"{analysis['bytes_written']} bytes written, "
+            f"{analysis['bytes_read']} bytes read",
+            f"  latency p50 {_format_seconds(analysis['latency_p50'])} "
+            f"p95 {_format_seconds(analysis['latency_p95'])} "
+            f"max {_format_seconds(analysis['latency_max'])}, "
+            f"first byte p50 {_format_seconds(analysis['first_byte_p50'])}",
+            f"  {analysis['timeouts']} timeouts, "
+            f"{_format_seconds(analysis['timeout_time'])} waited, "
+            f"{analysis['retries']} retries",
+            f"  {analysis['idle_gaps']} idle gaps over "
+            f"{_format_seconds(TRACE_IDLE_GAP)}, "
+            f"{_format_seconds(analysis['idle_time'])} in total, "
+            f"max {_format_seconds(analysis['idle_gap_max'])}",
+        ]
+    )
+
+
+"""
+Replay
+"""
+
+
+class ReplaySerial:
+    # a fake port answering with a recorded trace, at the recorded latency. The
+    # writes must be the recorded ones: the replay of a test is deterministic, the
+    # time left is the time spent by the tester itself. On a modbus trace every
+    # slave answers its own recorded requests in order, the requests to different
+    # slaves may come in another order than recorded. The answers are bytes, read
+    # in any split, e.g. by another modbus transport than the recorded one
+
+    def __init__(self, filename, speed=1.0):
+        self.filename = filename
+        self.speed = speed
+        info, records = read_trace(filename)
+        self.kind = info.get("kind")
+        self.port = f"{TRACE_REPLAY_PREFIX}{filename}"
+        self.baudrate = info.get("baudrate") or utils.MODBUS_SETTINGS_DEFAULT.baudrate
+        self.timeout = info.get("timeout") or 0.0
+        self.is_open = True
+        self.in_waiting = 0
+
+        # slave address -> (record number, record) of its requests and answers,
+        # None for the reads before the first request
+        self.queues = {None: deque()}
+        queue = self.queues[None]
+        for number, record in enumerate(records, 2):
+            if record.kind == TRACE_WRITE:
+                queue = self.queues.setdefault(self._get_key(record.data), deque())
+            if record.kind != TRACE_CLOSE:
+                queue.append((number, record))
+        self.queue = self.queues[None]
+        # recorded time and monotonic time of the last write, the answers follow it
+        self.anchor = (0.0, time.monotonic())
+
+    def _get_key(self, data):
+        if self.kind == "modbus" and data:
+            return data[0]
+        return None
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def remaining(self):
+        # records not replayed yet
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _sleep_until(self, recorded_time):
+        if not self.speed:
+            return
+        recorded, started = self.anchor
+        delay = started + (recorded_time - recorded) / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def write(self, data):
+        data = bytes(data)
+        queue = self.queues.get(self._get_key(data), deque())
+        # the answer left unread, dropped like by reset_input_buffer
+        while queue and queue[0][1].kind in (TRACE_READ, TRACE_TIMEOUT):
+            queue.popleft()
+        if not queue:
+            raise TraceError(f"{self.filename}: write of {data.hex()} after the end")
+        number, record = queue.popleft()
+        if data != record.data:
+            raise TraceError(
+                f"{self.filename}: write of {data.hex()}, the trace has "
+                f"{record.data.hex()} at record {number}"
+            )
+        self.queue = queue
+        self.anchor = (record.time, time.monotonic())
+        return len(data)
+
+    def _read(self, size, end=None):
+        data = bytearray()
+        record = None
+        timed_out = False
+        while (
+            len(data) < size
+            and self.queue
+            and self.queue[0][1].kind in (TRACE_READ, TRACE_TIMEOUT)
+        ):
+            number, record = self.queue.popleft()
+            take = size - len(data)
+            if end is not None and end in record.data[:take]:
+                take = record.data.index(end) + 1
+            data += record.data[:take]
+            if len(record.data) > take:
+                self.queue.appendleft(
+                    (number, record._replace(data=record.data[take:]))
+                )
+            elif record.kind == TRACE_TIMEOUT:
+                timed_out = True
+                break
+            if end is not None and data.endswith(end):
+                break
+
+        if record:
+            self._sleep_until(record.time)
+        complete = len(data) == size or (end is not None and data.endswith(end))
+        if not complete and not timed_out:
+            # more than the recorded answer, the port times out
+            if self.speed:
+                time.sleep(self.timeout / self.speed)
+        return bytes(data)
+
+    def read(self, size=1):
+        return self._read(size)
+
+    def readline(self):
+        return self._read(sys.maxsize, b"\n")
+
+
+def open_replay_port(serial_port, settings):
+    return ReplaySerial(serial_port[len(TRACE_REPLAY_PREFIX) :], replay_speed)
+
+
+utils.modbus_port_factories[TRACE_REPLAY_PREFIX] = open_replay_port
+
+
+def replay_test(filename, slave_addresses, **kwargs):
+    # the modbus test of slave_addresses against a recorded bus, returns the
+    # results, the time it took and the records the test did not get to
+    serial_port = f"{TRACE_REPLAY_PREFIX}{filename}"
+    start = time.monotonic()
+    try:
+        probe_results = utils.modbus_test_bus(serial_port, slave_addresses, **kwargs)
+        remaining = utils.modbus_pool.connections[serial_port].serial.remaining()
+    finally:
+        utils.modbus_pool.close_all()
+    elapsed = time.monotonic() - start
+    return probe_results, elapsed, remaining
+
+
+"""
+Command line
+"""
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(description="serial traffic traces")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    analyze_parser = commands.add_parser(
+        "analyze", help="latency, timeouts, retries and idle gaps of traces"
+    )
+    analyze_parser.add_argument("files", nargs="+", metavar="FILE")
+    analyze_parser.add_argument("--json", action="store_true", help="print JSON")
+
+    replay_parser = commands.add_parser(
+        "replay", help="test against a recorded modbus bus"
+    )
+    replay_parser.add_argument("file", metavar="FILE")
+    replay_parser.add_argument(
+        "-a",
+        "--addresses",
+        type=utils.parse_slave_addresses,
+        required=True,
+        help="slave addresses of the recorded test, e.g. 1-4",
+    )
+    replay_parser.add_argument(
+        "--speed", type=float, default=1.0, help="answer speed, 0 right away"
+    )
+    replay_parser.add_argument(
+        "--transport",
+        choices=utils.MODBUS_TRANSPORTS,
+        default=utils.MODBUS_SETTINGS_DEFAULT.transport,
+        help="modbus transport of the tester, the trace may have another one",
+    )
+    replay_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed slowdown against the recorded duration, 0.2 is 20%%",
+    )
+    return parser
+
+
+def _replay(args):
+    global replay_speed
+
+    _, records = read_trace(args.file)
+    recorded = records[-1].time if records else 0.0
+
+    replay_speed = args.speed
+    try:
+        probe_results, elapsed, remaining = replay_test(
+            args.file,
+            args.addresses,
+            settings=utils.MODBUS_SETTINGS_DEFAULT._replace(transport=args.transport),
+        )
+    except TraceError as error:
+        print(f"diverged from the trace, {error}", file=sys.stderr)
+        return 1
+
+    for slave_address, result in sorted(probe_results.items()):
+        print(f"{slave_address}: {result}")
+    print(
+        f"replayed in {elapsed:.3f} s, recorded {recorded:.3f} s, "
+        f"{remaining} records left"
+    )
+    if remaining:
+        print("the test ended before the trace", file=sys.stderr)
+        return 1
+    if args.speed == 1.0 and elapsed > recorded * (1 + args.tolerance):
+        print("regression: slower than the recorded test", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    args = _build_parser().parse_args(argv)
+
+    if args.command == "replay":
+        return _replay(args)
+
+    try:
+        analyses = [analyze_trace(filename) for filename in args.files]
+    except (OSError, TraceError) as error:
+        print(error, file=sys.stderr)
+        return 2
+    if args.json:
+        json.dump(analyses, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        print("\n".join(format_analysis(analysis) for analysis in analyses))
+    return 0
+
+
+if __name__ == "__main__":
+    # the module utils wraps the ports with, not a second copy of it
+    import serialtrace
+
+    sys.exit(serialtrace.main())
@@ -0,0 +1,455 @@
+import os
+import tty
+import time
+import random
+import select
+import threading
+from collections import namedtuple
+
+import utils
+
+# serial ports starting with this are simulated UPDI targets, e.g. "sim:updi0"
+SIMULATOR_PORT_PREFIX = "sim:"
+
+# bits of a modbus RTU character, 8N1
+MODBUS_CHARACTER_BITS = 10
+# bits of a UPDI character, 8E2
+UPDI_CHARACTER_BITS = 12
+
+SIMULATED_DEVICE_ID = bytearray([0x1E, 0x91, 0x23])
+
+
+def crc16_modbus(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+
+def _append_crc(frame):
+    crc = crc16_modbus(frame)
+    return bytes(frame) + bytes([crc & 0xFF, crc >> 8])
+
+
+"""
+Modbus probe
+"""
+
+
+class SimulatedProbe:
+    # the test sequence of a probe: INIT, IN_PROGRESS and SUCCESS or FAILED
+    # durations are in seconds, jitter is the relative random variation
+
+    def __init__(
+        self,
+        init_time=0.2,
+        test_time=1.0,
+        failure_rate=0.0,
+        jitter=0.1,
+        firmware_version=0x0102,
+        status_registers=utils.MODBUS_STATUS_REGISTERS,
+        rng=None,
+    ):
+        self.init_time = init_time
+        self.test_time = test_time
+        self.failure_rate = failure_rate
+        self.jitter = jitter
+        self.firmware_version = firmware_version
+        # older firmware only exposes the state register
+        self.status_registers = status_registers
+        self.rng = rng or random.Random()
+
+        self.started = None
+        self.fails = False
+        self.init_end = 0
+        self.test_end = 0
+        # number of completed tests
+        self.tests = 0
+
+    def _vary(self, duration):
+        return duration * (1 + self.rng.uniform(-self.jitter, self.jitter))
+
+    def start(self, now):
+        self.started = now
+        self.fails = self.rng.random() < self.failure_rate
+        self.init_end = now + self._vary(self.init_time)
+        self.test_end = self.init_end + self._vary(self.test_time)
+        self.tests += 1
+
+    def get_registers(self, now):
+        if self.started is None or now < self.init_end:
+            state, error_code, measurement = utils.TestState.INIT, 0, 0
+        elif now < self.test_end:
+            state, error_code, measurement = utils.TestState.IN_PROGRESS, 0, 0
+        elif self.fails:
+            state, error_code, measurement = utils.TestState.FAILED, 1, 0
+        else:
+            state, error_code, measurement = utils.TestState.SUCCESS, 0, 1000
+        return [state, error_code, measurement, self.firmware_version]
+
+
+class ModbusBusSimulator:
+    # modbus RTU slaves answering on a pseudo terminal, its port can be opened
+    # like any other serial port. Answers are delayed by the time the frames take
+    # on a real bus at the given baud rate
+
+    def __init__(self, probes=None, baudrate=115200, response_delay=0.002):
+        # slave address -> SimulatedProbe
+        self.probes = probes if probes is not None else {1: SimulatedProbe()}
+        self.baudrate = baudrate
+        self.response_delay = response_delay
+
+        self.master_fd = None
+        self.slave_fd = None
+        self.port = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+        # statistics
+        self.requests = 0
+        self.busy_time = 0.0
+        self.started = None
+
+    def start(self):
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+        self.started = time.monotonic()
+        self.thread = threading.Thread(
+            target=self._run, name=f"modbus simulator {self.port}", daemon=True
+        )
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = self.slave_fd = None
+
+    def get_utilization(self):
+        # share of the time the bus carried a frame
+        elapsed = time.monotonic() - self.started if self.started else 0
+        return self.busy_time / elapsed if elapsed else 0.0
+
+    def _get_frame_time(self, length):
+        return length * MODBUS_CHARACTER_BITS / self.baudrate
+
+    def _run(self):
+        buffer = b""
+        while not self.stopped.is_set():
+            readable, _, _ = select.select([self.master_fd], [], [], 0.1)
+            if not readable:
+                # a silent interval ends any partial frame
+                buffer = b""
+                continue
+            try:
+                buffer += os.read(self.master_fd, 256)
+            except OSError:
+                return
+
+            while True:
+                length = self._get_request_length(buffer)
+                if length == 0:
+                    buffer = b""
+                if not length or len(buffer) < length:
+                    break
+                request, buffer = buffer[:length], buffer[length:]
+                if crc16_modbus(request) != 0:
+                    # corrupted frame, wait for the bus to be silent again
+                    buffer = b""
+                    break
+                self._handle_request(request[:-2])
+
+    def _get_request_length(self, buffer):
+        if len(buffer) < 2:
+            return None
+        function_code = buffer[1]
+        if function_code in (1, 2, 3, 4, 5, 6):
+            return 8
+        if function_code in (15, 16):
+            return 9 + buffer[6] if len(buffer) >= 7 else None
+        # unsupported, the whole buffer is dropped
+        return 0
+
+    def _handle_request(self, request):
+        self.requests += 1
+        self.busy_time += self._get_frame_time(len(request) + 2)
+
+        slave_address, function_code = request[0], request[1]
+        probe = self.probes.get(slave_address)
+        if probe is None:
+            # nobody answers, the master times out
+            return
+
+        now = time.monotonic()
+        register = int.from_bytes(request[2:4], "big")
+        if function_code == 5:
+            # write single coil, coil 0 starts the test
+            if register == 0 and request[4] == 0xFF:
+                probe.start(now)
+            response = request
+        elif function_code == 3:
+            count = int.from_bytes(request[4:6], "big")
+            first = register - utils.MODBUS_STATUS_REGISTER
+            if first < 0 or first + count > probe.status_registers:
+                # illegal data address
+                response = bytes([slave_address, function_code | 0x80, 2])
+            else:
+                registers = probe.get_registers(now)[first : first + count]
+                response = bytes([slave_address, function_code, 2 * count]) + b"".join(
+                    value.to_bytes(2, "big") for value in registers
+                )
+        else:
+            # illegal function
+            response = bytes([slave_address, function_code | 0x80, 1])
+
+        response = _append_crc(response)
+        frame_time = self._get_frame_time(len(response))
+        time.sleep(self.response_delay + frame_time)
+        self.busy_time += frame_time
+        try:
+            os.write(self.master_fd, response)
+        except OSError:
+            pass
+
+
+"""
+UPDI target
+"""
+
+
+class SimulatedUpdiTarget:
+    # timing model of an attiny202 behind a serial UPDI adapter
+
+    def __init__(
+        self,
+        max_baudrate=460800,
+        page_write_time=0.002,
+        chip_erase_time=0.004,
+        command_latency=0.001,
+        crcscan_time=0.0005,
+        failure_rate=0.0,
+        rng=None,
+    ):
+        self.max_baudrate = max_baudrate
+        self.page_write_time = page_write_time
+        self.chip_erase_time = chip_erase_time
+        self.command_latency = command_latency
+        self.crcscan_time = crcscan_time
+        self.failure_rate = failure_rate
+        self.rng = rng or random.Random()
+
+
+# serial port -> SimulatedUpdiTarget, the default target is used for the others
+simulated_updi_targets = {}
+
+
+class _SimulatedSerial:
+    def __init__(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+
+class _SimulatedProgrammer:
+    # pymcuprog Programmer: programming mode, without the session housekeeping
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def start(self):
+        self.backend._transfer(0)
+        self.backend.in_progmode = True
+
+    def stop(self):
+        self.release_from_reset()
+
+    def release_from_reset(self):
+        self.backend._transfer(0)
+        self.backend.in_progmode = False
+
+    def get_device_model(self):
+        return self.backend
+
+
+class SimulatedUpdiBackend:
+    # the part of the pymcuprog Backend used by utils, programming the memories of
+    # a simulated target and taking the time a real adapter takes. Like the
+    # Backend, every call fails once the session ended, e.g. by release_from_reset
+
+    def __init__(self, serial_port, device, baudrate, target):
+        from pymcuprog.deviceinfo import deviceinfo
+        from pymcuprog.deviceinfo.deviceinfo import DeviceMemoryInfo
+        from pymcuprog.deviceinfo.deviceinfokeys import DeviceMemoryInfoKeys
+
+        self.serial_port = serial_port
+        self.baudrate = baudrate
+        self.target = target
+        self.device_memory_info = DeviceMemoryInfo(deviceinfo.getdeviceinfo(device))
+        self.memories = {
+            name: bytearray([0xFF]) * info[DeviceMemoryInfoKeys.SIZE]
+            for name, info in self.device_memory_info.mem_by_name.items()
+        }
+        self.ser = _SimulatedSerial()
+        self.programmer = _SimulatedProgrammer(self)
+        self.in_progmode = False
+        self.session_active = False
+        self.crcscan_status = 0
+
+        if baudrate > target.max_baudrate:
+            raise IOError(f"{serial_port}: no answer at {baudrate} baud")
+        self.programmer.start()
+        self.session_active = True
+
+    def _check_session(self):
+        from pymcuprog.pymcuprog_errors import PymcuprogSessionError
+
+        if not self.session_active:
+            raise PymcuprogSessionError("No programming session active")
+
+    def _transfer(self, length, extra_time=0.0):
+        # fails like a loose contact, and takes the time of the characters
+        if not self.ser.is_open:
+            raise IOError(f"{self.serial_port}: port closed")
+        if self.target.failure_rate and self.target.rng.random() < (
+            self.target.failure_rate
+        ):
+            raise IOError(f"{self.serial_port}: UPDI transmission error")
+        time.sleep(
+            self.target.command_latency
+            + length * UPDI_CHARACTER_BITS / self.baudrate
+            + extra_time
+        )
+
+    def _get_page_size(self, memory_name):
+        from pymcuprog.deviceinfo.deviceinfokeys import DeviceMemoryInfoKeys
+
+        info = self.device_memory_info.mem_by_name[memory_name]
+        return max(info[DeviceMemoryInfoKeys.PAGE_SIZE], 1)
+
+    """
+    Backend
+    """
+
+    def read_device_id(self):
+        self._check_session()
+        self._transfer(len(SIMULATED_DEVICE_ID))
+        return bytearray(SIMULATED_DEVICE_ID)
+
+    def erase(self, memory_name=None, address=None):
+        self._check_session()
+        self._transfer(0, self.target.chip_erase_time)
+        for memory_name in ("flash", "eeprom", "lockbits"):
+            memory = self.memories[memory_name]
+            memory[:] = bytearray([0xFF]) * len(memory)
+
+    def write_memory(self, data, memory_name="flash", offset_byte=0):
+        self._check_session()
+        pages = -(-len(data) // self._get_page_size(memory_name))
+        self._transfer(len(data), pages * self.target.page_write_time)
+        self.memories[memory_name][offset_byte : offset_byte + len(data)] = data
+
+    def read_memory(self, memory_name="flash", offset_byte=0, numbytes=0):
+        self._check_session()
+        numbytes = numbytes or len(self.memories[memory_name]) - offset_byte
+        self._transfer(numbytes)
+        memory_info = self.device_memory_info.mem_by_name[memory_name]
+        data = self.memories[memory_name][offset_byte : offset_byte + numbytes]
+        return [SimulatedMemory(bytearray(data), memory_info)]
+
+    def verify_memory(self, data, memory_name="flash", offset_byte=0):
+        read = self.read_memory(memory_name, offset_byte, len(data))[0].data
+        return bytes(read) == bytes(data)
+
+    def release_from_reset(self):
+        # also ends the session, like pymcuprog
+        self._check_session()
+        self.programmer.release_from_reset()
+        self.end_session()
+
+    def end_session(self):
+        if self.session_active:
+            self.session_active = False
+            self.programmer.stop()
+
+    def disconnect_from_tool(self):
+        self.ser.close()
+
+    """
+    Device model
+    """
+
+    @property
+    def avr(self):
+        return self
+
+    @property
+    def phy(self):
+        return self
+
+    @property
+    def readwrite(self):
+        return self
+
+    @property
+    def datalink(self):
+        return self
+
+    @property
+    def nvm(self):
+        return self
+
+    def init_datalink(self):
+        self._transfer(0)
+
+    def read_device_info(self):
+        self._transfer(len(SIMULATED_DEVICE_ID))
+
+    def read_byte(self, address):
+        self._transfer(1)
+        if address == utils.CRCSCAN_STATUS:
+            return self.crcscan_status
+        return 0xFF
+
+    def write_byte(self, address, value):
+        self._transfer(1)
+        if address == utils.CRCSCAN_CTRLA and value & utils.CRCSCAN_CTRLA_ENABLE:
+            # the scan runs on the device, while the UPDI link is idle
+            time.sleep(self.target.crcscan_time)
+            crc_ok = utils.crc16_ccitt(self.memories["flash"]) == 0
+            self.crcscan_status = utils.CRCSCAN_STATUS_OK if crc_ok else 0
+
+    def erase_flash_page(self, address):
+        from pymcuprog.deviceinfo.deviceinfokeys import DeviceMemoryInfoKeys
+
+        flash_info = self.device_memory_info.mem_by_name["flash"]
+        page_size = flash_info[DeviceMemoryInfoKeys.PAGE_SIZE]
+        offset = address - flash_info[DeviceMemoryInfoKeys.ADDRESS]
+        self._transfer(0, self.target.page_write_time)
+        self.memories["flash"][offset : offset + page_size] = (
+            bytearray([0xFF]) * page_size
+        )
+
+
+SimulatedMemory = namedtuple("SimulatedMemory", ["data", "memory_info"])
+
+
+def open_simulated_updi_backend(serial_port, device, baudrate, timeout):
+    target = simulated_updi_targets.get(
+        serial_port
+    ) or simulated_updi_targets.setdefault(None, SimulatedUpdiTarget())
+    return SimulatedUpdiBackend(serial_port, device, baudrate, target)
+
+
+# sessions on "sim:" ports program a simulated target
+utils.updi_backend_factories[SIMULATOR_PORT_PREFIX] = open_simulated_updi_backend
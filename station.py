@@ -0,0 +1,711 @@
+#!/usr/bin/python3
+# several tester PCs run as one line: every station runs an agent owning its UPDI
+# adapters and modbus buses, a coordinator pushes the profile and the firmware to
+# them and hands out the units to flash and test
+#
+# the protocol is one JSON object per line over TCP
+#   request   {"id": 1, "method": "unit", "params": {"slot": 0}}
+#   event     {"id": 1, "event": {...}}       zero or more, while the call runs
+#   response  {"id": 1, "result": ...}        or {"id": 1, "error": "..."}
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import queue
+import re
+import socket
+import socketserver
+import sys
+import threading
+
+import utils
+import results
+import metrics
+import pipeline
+import profiles
+import serialization
+import cli
+
+STATION_PORT = 7300
+# pushed profiles and firmware, next to main.py
+STATION_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "station")
+# units in flight on each slot, a device stays in its fixture until it is tested
+STATION_SLOT_CAPACITY = 1
+STATION_CONNECT_TIMEOUT = 10
+# how often an idle slot looks for a unit given back by a station that went away
+STATION_POLL_INTERVAL = 0.5
+
+# pushed names become file names, agents have no authentication
+STATION_NAME_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,63}")
+STATION_SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class StationError(Exception):
+    pass
+
+
+def _parse_address(text, default_host="127.0.0.1"):
+    # "host:port", ":port" or "host"
+    host, _, port = text.rpartition(":") if ":" in text else (text, "", "")
+    try:
+        return host or default_host, int(port) if port else STATION_PORT
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid address: {text}")
+
+
+def _get_unit_result(dut):
+    # the json sent back for a unit, the report without its python objects
+    unit_result = {
+        "flash": cli.get_flash_result(
+            dut.flash_port, dut.report.get("success", False), dut.get_flash_duration()
+        ),
+        "report": {
+            key: value
+            for key, value in dut.report.items()
+            if key in ("timings", "device_id", "firmware_sha256", "verify", "error")
+        },
+        "unit_data": dut.report.get("unit_data"),
+        "test": None,
+        # the ProbeStatus fields, the coordinator rebuilds its result row from them
+        "status": None,
+        "transitions": dut.transitions,
+    }
+    if dut.report.get("success"):
+        unit_result["test"] = cli.get_test_result(
+            dut.test_port, dut.slave_address, dut.result, dut.get_test_duration()
+        )
+        if isinstance(dut.result, utils.ProbeStatus):
+            unit_result["status"] = list(dut.result)
+    return unit_result
+
+
+"""
+Agent
+"""
+
+
+class StationAgent:
+    # serves the operations of one station, every call runs in its own thread
+
+    def __init__(self, name, slots, directory=STATION_DIRECTORY):
+        self.name = name
+        # [(flash port, test port, slave address)], the fixture positions
+        self.slots = slots
+        self.directory = directory
+        self.firmware_directory = os.path.join(directory, "firmware")
+        os.makedirs(self.firmware_directory, exist_ok=True)
+        self.profile = None
+
+        self.pipeline = pipeline.Pipeline(self.handle_pipeline_event)
+        # dut id -> event_func of the call waiting for it
+        self.dut_events = {}
+
+    def dispatch(self, request, send_func):
+        call_id = request.get("id")
+        method = getattr(self, f"rpc_{request.get('method')}", None)
+        if method is None:
+            send_func(
+                {"id": call_id, "error": f"unknown method {request.get('method')}"}
+            )
+            return
+
+        def handle_event(event):
+            send_func({"id": call_id, "event": event})
+
+        try:
+            result = method(handle_event, **request.get("params", {}))
+        except Exception as error:
+            send_func({"id": call_id, "error": str(error) or type(error).__name__})
+        else:
+            send_func({"id": call_id, "result": result})
+
+    def _get_profile(self):
+        if self.profile is None:
+            raise StationError(f"{self.name}: no profile, push one first")
+        return self.profile
+
+    def _get_path(self, path, directory=None):
+        # refuses anything resolving outside the station directory
+        directory = os.path.realpath(directory or self.directory)
+        resolved = os.path.realpath(os.path.join(directory, path))
+        if os.path.commonpath([directory, resolved]) != directory:
+            raise StationError(f"{path}: outside of {directory}")
+        return resolved
+
+    def _get_flash_options(self, profile, record):
+        # the serialization record of the unit comes from the coordinator
+        options = profile.get_flash_options()
+        if profile.serializer:
+            options["serializer"] = serialization.Serializer(
+                profile.serializer.fields, serialization.GivenSource(record)
+            )
+        return options
+
+    def _get_firmware_filename(self, sha256):
+        if not isinstance(sha256, str) or not STATION_SHA256_PATTERN.fullmatch(sha256):
+            raise StationError(f"invalid firmware sha256 {sha256!r}")
+        return self._get_path(f"{sha256}.hex", self.firmware_directory)
+
+    def handle_pipeline_event(self, dut):
+        event_func = self.dut_events.get(dut.id)
+        if event_func:
+            event_func({"stage": dut.stage, "flash_port": dut.flash_port})
+
+    """
+    Operations
+    """
+
+    def rpc_hello(self, event_func):
+        return {
+            "station": self.name,
+            "slots": self.slots,
+            "profile": str(self.profile) if self.profile else None,
+        }
+
+    def rpc_has_firmware(self, event_func, sha256):
+        return os.path.isfile(self._get_firmware_filename(sha256))
+
+    def rpc_put_firmware(self, event_func, sha256, content):
+        filename = self._get_firmware_filename(sha256)
+        if hashlib.sha256(content.encode("ascii")).hexdigest() != sha256:
+            raise StationError("firmware corrupted in transfer")
+        # written aside and renamed, a flash never reads half a file
+        with open(filename + ".tmp", "w", newline="") as hex_file:
+            hex_file.write(content)
+        os.replace(filename + ".tmp", filename)
+        return sha256
+
+    def rpc_put_profile(self, event_func, profile):
+        # the firmware of the profile is the sha256 of a firmware already pushed
+        sha256 = profile.get("firmware")
+        if sha256 and not self.rpc_has_firmware(event_func, sha256):
+            raise StationError(f"missing firmware {sha256}")
+        data = dict(profile)
+        if sha256:
+            data["firmware"] = os.path.relpath(
+                self._get_firmware_filename(sha256), self.directory
+            )
+
+        name = data.get("name")
+        if not isinstance(name, str) or not STATION_NAME_PATTERN.fullmatch(name):
+            raise StationError(f"invalid profile name {name!r}")
+        try:
+            version = int(data.get("version", 1))
+        except (TypeError, ValueError):
+            raise StationError(f"invalid profile version {data.get('version')!r}")
+        # a counter or a csv file of its own would repeat the records of the other
+        # stations, and the csv file is not here
+        serialization_data = data.get("serialization")
+        if serialization_data and (
+            serialization_data.get("source") != profiles.PROFILE_SOURCE_UNIT
+        ):
+            raise StationError(
+                "serialization records are given by the coordinator with each unit"
+            )
+
+        filename = self._get_path(f"{name}-v{version}.json")
+        with open(filename, "w") as profile_file:
+            json.dump(data, profile_file, indent=2)
+
+        event_func({"stage": "preparing"})
+        self.profile = profiles.load_profile(filename).prepare(
+            [flash_port for flash_port, _, _ in self.slots]
+        )
+        return {"profile": str(self.profile), "firmware_sha256": sha256}
+
+    def rpc_flash(self, event_func, port, record=None):
+        profile = self._get_profile()
+        report = {}
+        utils.flash_file(
+            profile.firmware,
+            port,
+            lambda stage: event_func({"stage": stage}),
+            report=report,
+            **self._get_flash_options(profile, record),
+        )
+        report.pop("firmware_file", None)
+        return report
+
+    def rpc_test(self, event_func, port, addresses=None, deadline=None):
+        profile = self._get_profile()
+        durations = {}
+
+        def handle_state(slave_address, status):
+            event_func({"address": slave_address, "state": status.state})
+
+        test_results = utils.modbus_test_bus(
+            port,
+            addresses or profile.slave_addresses,
+            handle_state,
+            deadline or profile.deadline,
+            durations=durations,
+            **profile.get_test_options(),
+        )
+        return [
+            cli.get_test_result(port, slave_address, result, durations[slave_address])
+            for slave_address, result in test_results.items()
+        ]
+
+    def rpc_unit(self, event_func, slot, record=None):
+        # flash and test the device in a fixture slot, like the "Then test" mode
+        profile = self._get_profile()
+        flash_port, test_port, slave_address = self.slots[slot]
+        dut = pipeline.Dut(
+            flash_port,
+            test_port,
+            slave_address,
+            profile.firmware,
+            self._get_flash_options(profile, record),
+            profile.deadline,
+            profile.get_test_options(),
+        )
+        self.dut_events[dut.id] = event_func
+        try:
+            self.pipeline.submit(dut)
+            dut.done.wait()
+        finally:
+            self.dut_events.pop(dut.id, None)
+        return _get_unit_result(dut)
+
+    def rpc_metrics(self, event_func):
+        return metrics.cycle_metrics.snapshot()
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        send_lock = threading.Lock()
+
+        def send(message):
+            data = (json.dumps(message) + "\n").encode()
+            try:
+                with send_lock:
+                    self.wfile.write(data)
+                    self.wfile.flush()
+            except OSError:
+                # the coordinator went away, its calls still run to the end
+                pass
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                send({"id": None, "error": "invalid request"})
+                continue
+            threading.Thread(
+                target=self.server.agent.dispatch,
+                args=(request, send),
+                name=f"rpc {request.get('method')}",
+                daemon=True,
+            ).start()
+
+
+class StationServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, agent):
+        self.agent = agent
+        super().__init__(address, _AgentHandler)
+
+
+"""
+Coordinator
+"""
+
+
+class StationClient:
+    # one connection to an agent, calls from several threads share it
+
+    def __init__(self, address, timeout=STATION_CONNECT_TIMEOUT):
+        self.address = address
+        self.socket = socket.create_connection(address, timeout)
+        self.socket.settimeout(None)
+        self.rfile = self.socket.makefile("rb")
+        self.send_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # call id -> queue of its events and response
+        self.calls = {}
+        self.closed = False
+        self.reader = threading.Thread(
+            target=self._read, name=f"station {address[0]}:{address[1]}", daemon=True
+        )
+        self.reader.start()
+
+    def call(self, method, event_func=None, **params):
+        # blocks until the response, event_func(event) is called meanwhile
+        call_id = next(self.ids)
+        responses = self.calls[call_id] = queue.Queue()
+        data = json.dumps({"id": call_id, "method": method, "params": params})
+        try:
+            if self.closed:
+                raise OSError("connection closed")
+            with self.send_lock:
+                self.socket.sendall((data + "\n").encode())
+
+            while True:
+                message = responses.get()
+                if "event" in message:
+                    if event_func:
+                        event_func(message["event"])
+                    continue
+                if "error" in message:
+                    raise StationError(message["error"])
+                return message["result"]
+        except OSError as error:
+            raise StationError(f"{self.address[0]}:{self.address[1]}: {error}")
+        finally:
+            self.calls.pop(call_id, None)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def _read(self):
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                responses = self.calls.get(message.get("id"))
+                if responses:
+                    responses.put(message)
+        except (OSError, ValueError):
+            pass
+
+        # the pending calls fail, their units go to another station
+        self.closed = True
+        for responses in list(self.calls.values()):
+            responses.put({"error": "connection closed"})
+
+
+class Coordinator:
+    # event_func(station, slot, event) is called from the dispatch threads
+
+    def __init__(self, addresses, result_store=None, event_func=None):
+        self.result_store = result_store
+        self.event_func = event_func
+        # the serialization of the pushed profile, one counter or csv file for the
+        # whole line
+        self.serializer = None
+        # station name -> (client, slots)
+        self.stations = {}
+        for address in addresses:
+            client = StationClient(address)
+            hello = client.call("hello")
+            self.stations[hello["station"]] = (client, hello["slots"])
+
+    def push_profile(self, filename):
+        # the firmware is sent only to the stations missing it
+        with open(filename) as profile_file:
+            data = json.load(profile_file)
+
+        # the records are taken here and given with each unit, the stations get
+        # only the fields. The csv file is read here, it is never pushed
+        try:
+            self.serializer = profiles.load_profile(filename).serializer
+        except profiles.ProfileError as error:
+            raise StationError(str(error))
+        if self.serializer:
+            data["serialization"] = {
+                "fields": data["serialization"]["fields"],
+                "source": profiles.PROFILE_SOURCE_UNIT,
+            }
+
+        firmware = data.get("firmware")
+        content = sha256 = None
+        if firmware:
+            path = os.path.join(os.path.dirname(filename), firmware)
+            with open(path, newline="") as hex_file:
+                content = hex_file.read()
+            sha256 = hashlib.sha256(content.encode("ascii")).hexdigest()
+            data["firmware"] = sha256
+
+        prepared = {}
+        for name, (client, _) in self.stations.items():
+            if sha256 and not client.call("has_firmware", sha256=sha256):
+                client.call("put_firmware", sha256=sha256, content=content)
+            prepared[name] = client.call("put_profile", profile=data)
+        return prepared
+
+    def run(self, units, slot_capacity=STATION_SLOT_CAPACITY):
+        # every slot pulls the next unit as soon as it can take one, faster
+        # stations end up with more units
+        pending = queue.Queue()
+        for unit in range(units):
+            pending.put(unit)
+        # unit -> result, the run is over once every unit has one
+        unit_results = {}
+        lock = threading.Lock()
+        finished = threading.Event()
+        if not units:
+            finished.set()
+
+        def work(name, client, slot):
+            while not finished.is_set():
+                try:
+                    # a unit may still come back from a station that went away
+                    unit = pending.get(timeout=STATION_POLL_INTERVAL)
+                except queue.Empty:
+                    if client.closed:
+                        return
+                    continue
+
+                def handle_event(event):
+                    if self.event_func:
+                        self.event_func(name, slot, event)
+
+                try:
+                    record = self._next_record()
+                    unit_result = client.call(
+                        "unit", handle_event, slot=slot, record=record
+                    )
+                except serialization.SerializationError as error:
+                    unit_result = {"error": str(error)}
+                except StationError as error:
+                    if client.closed:
+                        # the station is gone, another one takes its unit. The
+                        # device may hold the record already, it is not reused
+                        pending.put(unit)
+                        return
+                    unit_result = {"error": str(error)}
+                    self._release_record(record)
+                else:
+                    if not unit_result["flash"]["success"]:
+                        self._release_record(record)
+
+                unit_result.update(unit=unit, station=name, slot=slot)
+                self._record(unit_result)
+                with lock:
+                    unit_results[unit] = unit_result
+                    if len(unit_results) == units:
+                        finished.set()
+
+        threads = [
+            threading.Thread(
+                target=work, args=(name, client, slot), name=f"{name}#{slot}"
+            )
+            for name, (client, slots) in self.stations.items()
+            for slot in range(len(slots))
+            for _ in range(slot_capacity)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # every station went away before these units were run
+        return [
+            unit_results.get(unit) or {"unit": unit, "error": "no station left"}
+            for unit in range(units)
+        ]
+
+    def _next_record(self):
+        if self.serializer is None:
+            return None
+        return self.serializer.next_record({})
+
+    def _release_record(self, record):
+        if record is not None:
+            self.serializer.release(record)
+
+    def _record(self, unit_result):
+        if not self.result_store or "flash" not in unit_result:
+            return
+        # ports are named after their station, the same port exists on each PC
+        station = unit_result["station"]
+        report = dict(unit_result["report"], success=unit_result["flash"]["success"])
+        report["unit_data"] = unit_result.get("unit_data")
+        self.result_store.record(
+            results.flash_row(f"{station}/{unit_result['flash']['port']}", report)
+        )
+        test = unit_result["test"]
+        if test:
+            status = unit_result.get("status")
+            self.result_store.record(
+                results.test_row(
+                    f"{station}/{test['port']}",
+                    test["address"],
+                    (
+                        utils.ProbeStatus(*status)
+                        if status
+                        else StationError(test["error"])
+                    ),
+                    test["duration"],
+                    unit_result["transitions"],
+                    device_id=report.get("device_id"),
+                    firmware_sha256=report.get("firmware_sha256"),
+                )
+            )
+
+    def get_metrics(self):
+        return {
+            name: client.call("metrics") for name, (client, _) in self.stations.items()
+        }
+
+    def close(self):
+        for client, _ in self.stations.values():
+            client.close()
+
+
+"""
+Command line
+"""
+
+
+def _simulate_slots(slots):
+    # the test ports become simulated buses with a probe for each slot address
+    import simulator
+
+    addresses = {}
+    for _, test_port, slave_address in slots:
+        addresses.setdefault(test_port, set()).add(slave_address)
+
+    ports = {}
+    for test_port, slave_addresses in addresses.items():
+        bus = simulator.ModbusBusSimulator(
+            {
+                address: simulator.SimulatedProbe(init_time=0.1, test_time=0.5)
+                for address in slave_addresses
+            }
+        )
+        ports[test_port] = bus.start()
+
+    return [
+        (flash_port, ports[test_port], slave_address)
+        for flash_port, test_port, slave_address in slots
+    ]
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(description="coffe probe tester, station line")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    agent_parser = commands.add_parser("agent", help="serve the slots of this station")
+    agent_parser.add_argument(
+        "-l",
+        "--listen",
+        type=_parse_address,
+        default=("127.0.0.1", STATION_PORT),
+        help=f"HOST:PORT, default 127.0.0.1:{STATION_PORT}, the agent has no "
+        "authentication, listen on other interfaces only on a trusted network",
+    )
+    agent_parser.add_argument(
+        "-s",
+        "--slot",
+        type=cli.parse_dut,
+        action="append",
+        required=True,
+        help="FLASH_PORT,TEST_PORT[,SLAVE_ADDRESS] of a fixture position",
+    )
+    agent_parser.add_argument("-n", "--name", help="station name, default HOST:PORT")
+    agent_parser.add_argument(
+        "--directory",
+        default=STATION_DIRECTORY,
+        help="where the pushed profiles and firmware are kept",
+    )
+    agent_parser.add_argument(
+        "--simulate",
+        action="store_true",
+        help="simulated probes on the test ports, use sim: flash ports (linux)",
+    )
+
+    coordinator_parser = commands.add_parser(
+        "coordinator", help="flash and test units on the stations"
+    )
+    coordinator_parser.add_argument(
+        "-s",
+        "--station",
+        type=_parse_address,
+        action="append",
+        required=True,
+        help="HOST[:PORT] of a station agent",
+    )
+    coordinator_parser.add_argument(
+        "-p", "--profile", required=True, help="profile file pushed to the stations"
+    )
+    coordinator_parser.add_argument(
+        "-u", "--units", type=int, default=0, help="units to flash and test"
+    )
+    coordinator_parser.add_argument(
+        "--results", metavar="FILE", help="also store the results in this database"
+    )
+    coordinator_parser.add_argument(
+        "--metrics", metavar="FILE", help="write the metrics of every station"
+    )
+
+    return parser
+
+
+def _run_agent(args):
+    slots = [
+        (flash_port, test_port, slave_address or utils.MODBUS_SLAVE_ADDRESS_DEFAULT)
+        for flash_port, test_port, slave_address in args.slot
+    ]
+    if args.simulate:
+        slots = _simulate_slots(slots)
+
+    server = StationServer(args.listen, None)
+    host, port = server.server_address
+    name = args.name or f"{socket.gethostname()}:{port}"
+    server.agent = StationAgent(name, slots, args.directory)
+    print(f"station {name} listening on {host}:{port}", file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.agent.pipeline.close()
+    return cli.EXIT_SUCCESS
+
+
+def _run_coordinator(args):
+    def handle_event(station, slot, event):
+        print(f"[{station}#{slot}] {event.get('stage')}", file=sys.stderr)
+
+    result_store = results.ResultStore(args.results) if args.results else None
+    try:
+        coordinator = Coordinator(args.station, result_store, handle_event)
+    except (OSError, StationError) as error:
+        print(error, file=sys.stderr)
+        return cli.EXIT_USAGE
+
+    try:
+        prepared = coordinator.push_profile(args.profile)
+        unit_results = coordinator.run(args.units)
+        if args.metrics:
+            with open(args.metrics, "w") as metrics_file:
+                json.dump(coordinator.get_metrics(), metrics_file, indent=2)
+    except StationError as error:
+        print(error, file=sys.stderr)
+        return cli.EXIT_FAILURE
+    finally:
+        coordinator.close()
+        if result_store:
+            result_store.close()
+
+    success = all(
+        unit_result.get("test") and unit_result["test"]["success"]
+        for unit_result in unit_results
+    )
+    json.dump(
+        {"profiles": prepared, "success": success, "units": unit_results},
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+    return cli.EXIT_SUCCESS if success else cli.EXIT_FAILURE
+
+
+def main(argv=None):
+    args = _build_parser().parse_args(argv)
+    if args.command == "agent":
+        return _run_agent(args)
+    return _run_coordinator(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,35 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cli
+
+
+class SlaveAddressTest(unittest.TestCase):
+    def test_devices_take_the_profile_addresses_in_turn(self):
+        duts = [
+            ("sim:a", "/dev/ttyUSB2", None),
+            ("sim:b", "/dev/ttyUSB2", 1),
+            ("sim:c", "/dev/ttyUSB2", None),
+            ("sim:d", "/dev/ttyUSB3", None),
+        ]
+        self.assertEqual(
+            cli._assign_slave_addresses(duts, [1, 2, 3]),
+            [
+                ("sim:a", "/dev/ttyUSB2", 2),
+                ("sim:b", "/dev/ttyUSB2", 1),
+                ("sim:c", "/dev/ttyUSB2", 3),
+                ("sim:d", "/dev/ttyUSB3", 1),
+            ],
+        )
+
+    def test_more_devices_than_addresses(self):
+        duts = [("sim:a", "/dev/ttyUSB2", None), ("sim:b", "/dev/ttyUSB2", None)]
+        with self.assertRaises(ValueError):
+            cli._assign_slave_addresses(duts, [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+class HexCacheTest(unittest.TestCase):
+    def setUp(self):
+        from pymcuprog.deviceinfo.deviceinfo import getdeviceinfo
+        from pymcuprog.deviceinfo.deviceinfo import DeviceMemoryInfo
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.device_memory_info = DeviceMemoryInfo(getdeviceinfo("attiny202"))
+        utils.clear_hex_cache()
+
+    def tearDown(self):
+        utils.clear_hex_cache()
+        self.directory.cleanup()
+
+    def _write_hex(self, name, content):
+        from intelhex import IntelHex
+
+        filename = os.path.join(self.directory.name, name)
+        hexfile = IntelHex()
+        hexfile.frombytes(content)
+        hexfile.write_hex_file(filename)
+        return filename
+
+    def test_images_are_bounded(self):
+        # every firmware of a long shift, the first ones go first
+        filenames = [
+            self._write_hex(f"firmware{n}.hex", bytes([n] * 64))
+            for n in range(utils.HEX_CACHE_IMAGES + 3)
+        ]
+        for filename in filenames:
+            utils.read_memories_from_hex_cached(filename, self.device_memory_info)
+            utils.get_flash_checksum(filename, self.device_memory_info)
+
+        self.assertEqual(utils.get_hex_cache_stats()["images"], utils.HEX_CACHE_IMAGES)
+        self.assertLessEqual(len(utils._hex_flash_checksums), utils.HEX_CACHE_IMAGES)
+
+        # an evicted image is parsed again, a recent one is still a hit
+        misses = utils.get_hex_cache_stats()["misses"]
+        utils.read_memories_from_hex_cached(filenames[-1], self.device_memory_info)
+        self.assertEqual(utils.get_hex_cache_stats()["misses"], misses)
+        memory_segments = utils.read_memories_from_hex_cached(
+            filenames[0], self.device_memory_info
+        )
+        self.assertEqual(utils.get_hex_cache_stats()["misses"], misses + 1)
+        self.assertEqual(bytes(memory_segments[0].data[:64]), bytes(64))
+
+    def test_recently_used_image_is_kept(self):
+        first = self._write_hex("first.hex", bytes(64))
+        utils.read_memories_from_hex_cached(first, self.device_memory_info)
+        for n in range(utils.HEX_CACHE_IMAGES + 2):
+            filename = self._write_hex(f"firmware{n}.hex", bytes([n + 1] * 64))
+            utils.read_memories_from_hex_cached(filename, self.device_memory_info)
+            utils.read_memories_from_hex_cached(first, self.device_memory_info)
+
+        misses = utils.get_hex_cache_stats()["misses"]
+        utils.read_memories_from_hex_cached(first, self.device_memory_info)
+        self.assertEqual(utils.get_hex_cache_stats()["misses"], misses)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jobs
+
+
+class JobEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = jobs.JobEngine()
+        patcher = mock.patch.object(jobs, "JOBS_RETRY_BACKOFF", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.engine.shutdown()
+
+    def _run(self, func, **kwargs):
+        done = threading.Event()
+        job = self.engine.submit(
+            "job", func, done_func=lambda job: done.set(), **kwargs
+        )
+        self.assertTrue(done.wait(5))
+        return job
+
+    def test_io_error_is_retried(self):
+        def flaky(job):
+            if job.attempts < 3:
+                raise IOError("loose contact")
+            return "flashed"
+
+        job = self._run(flaky, retries=2)
+        self.assertEqual(job.state, jobs.JobState.SUCCESS)
+        self.assertEqual(job.result, "flashed")
+        self.assertEqual(job.attempts, 3)
+
+    def test_retries_run_out(self):
+        def broken(job):
+            raise IOError("no device")
+
+        job = self._run(broken, retries=1)
+        self.assertEqual(job.state, jobs.JobState.FAILED)
+        self.assertIsInstance(job.error, IOError)
+        self.assertEqual(job.attempts, 2)
+
+    def test_job_failed_is_not_retried(self):
+        def wrong_device(job):
+            raise jobs.JobFailed("wrong device")
+
+        job = self._run(wrong_device, retries=3)
+        self.assertEqual(job.state, jobs.JobState.FAILED)
+        self.assertEqual(job.attempts, 1)
+
+    def test_phase_timeout_aborts_the_job(self):
+        aborted = threading.Event()
+
+        def stuck(job):
+            job.phase("test")
+            job.sleep(5)
+
+        job = self._run(
+            stuck,
+            retries=3,
+            phase_timeouts={"test": 0.2},
+            abort_func=aborted.set,
+        )
+        self.assertEqual(job.state, jobs.JobState.FAILED)
+        self.assertIsInstance(job.error, jobs.JobTimeout)
+        self.assertTrue(aborted.is_set())
+        # a timeout is never retried
+        self.assertEqual(job.attempts, 1)
+
+    def test_cancel_stops_a_running_job(self):
+        running = threading.Event()
+        done = threading.Event()
+
+        def waiting(job):
+            running.set()
+            job.sleep(5)
+
+        job = self.engine.submit("job", waiting, done_func=lambda job: done.set())
+        self.assertTrue(running.wait(5))
+        job.cancel()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(job.state, jobs.JobState.CANCELLED)
+
+    def test_io_error_of_an_aborted_port_is_not_retried(self):
+        running = threading.Event()
+        port_closed = threading.Event()
+
+        def reading(job):
+            # the read fails once the abort closes the port
+            running.set()
+            port_closed.wait(5)
+            raise IOError("port closed")
+
+        done = threading.Event()
+        job = self.engine.submit(
+            "job",
+            reading,
+            retries=3,
+            abort_func=port_closed.set,
+            done_func=lambda job: done.set(),
+        )
+        self.assertTrue(running.wait(5))
+        job.cancel()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(job.state, jobs.JobState.CANCELLED)
+        self.assertEqual(job.attempts, 1)
+
+    def test_jobs_on_the_same_port_run_one_at_a_time(self):
+        lock = threading.Lock()
+        overlaps = []
+
+        def exclusive(job):
+            if not lock.acquire(blocking=False):
+                overlaps.append(job.name)
+                return
+            try:
+                job.sleep(0.05)
+            finally:
+                lock.release()
+
+        done = threading.Semaphore(0)
+        for _ in range(4):
+            self.engine.submit(
+                "job",
+                exclusive,
+                ports=["/dev/ttyUSB0"],
+                done_func=lambda job: done.release(),
+            )
+        for _ in range(4):
+            self.assertTrue(done.acquire(timeout=5))
+        self.assertEqual(overlaps, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
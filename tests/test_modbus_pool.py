@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+SLOW_PREFIX = "slow:"
+
+
+class _SlowPort:
+    # an adapter taking its time to answer the drain of a new connection
+    opened = threading.Event()
+    release = threading.Event()
+
+    def __init__(self, serial_port, settings):
+        self.port = serial_port
+        self.is_open = True
+
+    def reset_input_buffer(self):
+        pass
+
+    def readline(self):
+        if self.port.endswith("stuck"):
+            _SlowPort.opened.set()
+            _SlowPort.release.wait(5)
+        return b""
+
+    def close(self):
+        self.is_open = False
+
+
+class ModbusPoolTest(unittest.TestCase):
+    def setUp(self):
+        utils.modbus_port_factories[SLOW_PREFIX] = _SlowPort
+        _SlowPort.opened.clear()
+        _SlowPort.release.clear()
+        self.pool = utils.ModbusPool()
+
+    def tearDown(self):
+        _SlowPort.release.set()
+        self.pool.close_all()
+        del utils.modbus_port_factories[SLOW_PREFIX]
+
+    def test_slow_port_does_not_block_other_buses(self):
+        stuck = threading.Thread(target=self.pool.get, args=(f"{SLOW_PREFIX}stuck",))
+        stuck.start()
+        self.assertTrue(_SlowPort.opened.wait(5))
+
+        # served while the other port is still being opened
+        connection = self.pool.get(f"{SLOW_PREFIX}free")
+        self.assertTrue(stuck.is_alive())
+        self.assertIs(self.pool.get(f"{SLOW_PREFIX}free"), connection)
+
+        _SlowPort.release.set()
+        stuck.join(5)
+        self.assertIn(f"{SLOW_PREFIX}stuck", self.pool.connections)
+
+
+if __name__ == "__main__":
+    unittest.main()
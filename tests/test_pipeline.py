@@ -0,0 +1,125 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline
+import simulator
+import utils
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.bus = simulator.ModbusBusSimulator(
+            {
+                address: simulator.SimulatedProbe(init_time=0.05, test_time=0.3)
+                for address in (1, 2)
+            }
+        )
+        self.test_port = self.bus.start()
+        self.events = []
+        self.pipeline = pipeline.Pipeline(
+            lambda dut: self.events.append((dut.id, dut.stage))
+        )
+        # the flash of the device waits for this, set by default
+        self.flash_release = threading.Event()
+        self.flash_release.set()
+        self.flashing = threading.Event()
+
+        patcher = mock.patch.object(utils, "flash_file", side_effect=self._flash_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.flash_release.set()
+        self.pipeline.close()
+        utils.modbus_pool.close_all()
+        self.bus.stop()
+
+    def _flash_file(self, filename, serial_port, report=None, **options):
+        self.flashing.set()
+        self.flash_release.wait(5)
+        time.sleep(0.05)
+        success = filename != "broken.hex"
+        report.update(success=success)
+        return success
+
+    def _dut(self, slave_address, filename="firmware.hex"):
+        return pipeline.Dut(
+            "sim:pipeline",
+            self.test_port,
+            slave_address,
+            filename,
+            deadline=5,
+            test_options={"settings": utils.MODBUS_SETTINGS_DEFAULT},
+        )
+
+    def _stages(self, dut):
+        return [stage for dut_id, stage in self.events if dut_id == dut.id]
+
+    def test_next_device_is_flashed_while_the_first_is_tested(self):
+        duts = [self._dut(1), self._dut(2)]
+        for dut in duts:
+            self.pipeline.submit(dut)
+        self.pipeline.close()
+
+        for dut in duts:
+            self.assertEqual(
+                self._stages(dut),
+                [
+                    pipeline.DutStage.QUEUED,
+                    pipeline.DutStage.FLASHING,
+                    pipeline.DutStage.TEST_QUEUED,
+                    pipeline.DutStage.TESTING,
+                    pipeline.DutStage.PASSED,
+                ],
+            )
+            self.assertTrue(dut.done.is_set())
+        # the adapter was handed to the second device before the first one passed
+        self.assertLess(
+            duts[1].times[pipeline.DutStage.FLASHING],
+            duts[0].times[pipeline.DutStage.PASSED],
+        )
+
+    def test_failed_flash_is_not_tested(self):
+        dut = self._dut(1, "broken.hex")
+        self.pipeline.submit(dut)
+        self.pipeline.close()
+
+        self.assertEqual(dut.stage, pipeline.DutStage.FLASH_FAILED)
+        self.assertNotIn(pipeline.DutStage.TESTING, self._stages(dut))
+        self.assertTrue(dut.flashed.is_set())
+
+    def test_cancelled_queued_device_is_never_flashed(self):
+        self.flash_release.clear()
+        duts = [self._dut(1), self._dut(2)]
+        for dut in duts:
+            self.pipeline.submit(dut)
+        self.assertTrue(self.flashing.wait(5))
+        duts[1].cancel()
+        self.flash_release.set()
+        self.pipeline.close()
+
+        self.assertEqual(duts[0].stage, pipeline.DutStage.PASSED)
+        self.assertEqual(duts[1].stage, pipeline.DutStage.FLASH_FAILED)
+        self.assertEqual(duts[1].report["error"], "cancelled")
+        self.assertEqual(utils.flash_file.call_count, 1)
+
+    def test_cancel_stops_the_test(self):
+        dut = self._dut(1)
+        self.pipeline.submit(dut)
+        while dut.stage != pipeline.DutStage.TESTING:
+            self.assertFalse(dut.done.wait(0.01))
+        dut.cancel()
+
+        self.assertTrue(dut.done.wait(5))
+        self.assertEqual(dut.stage, pipeline.DutStage.FAILED)
+        self.assertIsInstance(dut.result, pipeline.DutCancelled)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import results
+
+
+class ResultStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "results.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _count(self, store):
+        return store.query("SELECT COUNT(*) FROM units")[0][0]
+
+    def _flash_row(self, **report):
+        return results.flash_row("/dev/ttyUSB0", dict(report, success=True))
+
+    def test_full_batch_is_written_without_waiting(self):
+        store = results.ResultStore(self.filename, batch_size=3, flush_interval=10)
+        try:
+            start = time.monotonic()
+            for _ in range(6):
+                store.record(self._flash_row())
+            store.flush()
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertEqual(self._count(store), 6)
+        finally:
+            store.close()
+
+    def test_partial_batch_is_written_after_the_flush_interval(self):
+        store = results.ResultStore(self.filename, batch_size=100, flush_interval=0.2)
+        try:
+            store.record(self._flash_row())
+            self.assertEqual(self._count(store), 0)
+            store.flush()
+            self.assertEqual(self._count(store), 1)
+        finally:
+            store.close()
+
+    def test_close_writes_the_last_batch(self):
+        store = results.ResultStore(self.filename, batch_size=100, flush_interval=10)
+        for _ in range(5):
+            store.record(self._flash_row())
+        start = time.monotonic()
+        store.close()
+
+        # the writer does not wait for the flush interval to stop
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self._count(store), 5)
+        with self.assertRaises(RuntimeError):
+            store.record(self._flash_row())
+
+    def test_added_columns_are_migrated(self):
+        # a database created before the added columns existed
+        old_schema = results.SCHEMA
+        for column, column_type in results.ADDED_COLUMNS.items():
+            old_schema = old_schema.replace(f"    {column} {column_type},\n", "")
+        connection = sqlite3.connect(self.filename)
+        with connection:
+            connection.executescript(old_schema)
+            connection.execute(
+                "INSERT INTO units (timestamp, operation, success) VALUES (1, 'flash', 1)"
+            )
+        connection.close()
+
+        store = results.ResultStore(self.filename)
+        try:
+            columns = {row[1] for row in store.query("PRAGMA table_info(units)")}
+            self.assertTrue(set(results.ADDED_COLUMNS) <= columns)
+
+            store.record(self._flash_row(unit_data={"serial_number": 1000}))
+            store.flush()
+            rows = store.query("SELECT unit_data FROM units ORDER BY id")
+            self.assertEqual(rows[0][0], None)
+            self.assertEqual(json.loads(rows[1][0]), {"serial_number": 1000})
+        finally:
+            store.close()
+
+        # opening it again does not add the columns twice
+        results.ResultStore(self.filename).close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import sys
+import struct
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import minimalmodbus
+
+import rtu
+
+
+def _frame(data):
+    return data + struct.pack("<H", rtu.rtu_crc(data))
+
+
+class _FakePort:
+    # answers every request with the next of the given responses
+    baudrate = 115200
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.written = []
+        self.input = b""
+
+    def reset_input_buffer(self):
+        self.input = b""
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        self.input += self.responses.pop(0)
+        return len(data)
+
+    def read(self, size=1):
+        data, self.input = self.input[:size], self.input[size:]
+        return data
+
+
+class RtuBusTest(unittest.TestCase):
+    def _read_registers(self, *responses):
+        port = _FakePort(*responses)
+        instr = rtu.RtuInstrument(rtu.RtuBus(port), 1)
+        return port, instr.read_registers(0, 2)
+
+    def test_crc(self):
+        self.assertEqual(
+            _frame(bytes.fromhex("01030000000a")), bytes.fromhex("01030000000ac5cd")
+        )
+
+    def test_read_registers(self):
+        port, registers = self._read_registers(_frame(bytes.fromhex("010304000203e8")))
+        self.assertEqual(port.written, [_frame(bytes.fromhex("010300000002"))])
+        self.assertEqual(registers, [2, 1000])
+
+    def test_write_bit_checks_the_echo(self):
+        request = bytes.fromhex("01050001ff00")
+        port = _FakePort(_frame(request), _frame(bytes.fromhex("010500010000")))
+        instr = rtu.RtuInstrument(rtu.RtuBus(port), 1)
+
+        instr.write_bit(1, 1)
+        self.assertEqual(port.written, [_frame(request)])
+        with self.assertRaises(minimalmodbus.InvalidResponseError):
+            instr.write_bit(1, 1)
+
+    def test_exception_frame(self):
+        for code, error_type in (
+            (2, minimalmodbus.IllegalRequestError),
+            (6, minimalmodbus.SlaveDeviceBusyError),
+            (11, minimalmodbus.SlaveReportedException),
+        ):
+            with self.subTest(code=code):
+                with self.assertRaises(error_type):
+                    self._read_registers(_frame(bytes([1, 0x83, code])))
+
+    def test_invalid_responses(self):
+        answer = _frame(bytes.fromhex("010304000203e8"))
+        for name, response, error_type in (
+            ("no answer", b"", minimalmodbus.NoResponseError),
+            ("bad crc", answer[:-1] + b"\x00", minimalmodbus.InvalidResponseError),
+            (
+                "wrong address",
+                _frame(bytes.fromhex("020304000203e8")),
+                minimalmodbus.InvalidResponseError,
+            ),
+            (
+                "wrong function",
+                _frame(bytes.fromhex("010404000203e8")),
+                minimalmodbus.InvalidResponseError,
+            ),
+            ("short", answer[:4], minimalmodbus.InvalidResponseError),
+            (
+                "short with a valid crc",
+                _frame(bytes.fromhex("0103020002")),
+                minimalmodbus.InvalidResponseError,
+            ),
+        ):
+            with self.subTest(name):
+                with self.assertRaises(error_type):
+                    self._read_registers(response)
+
+    def test_late_answer_is_dropped(self):
+        port = _FakePort(_frame(bytes.fromhex("010304000203e8")))
+        bus = rtu.RtuBus(port)
+        # left on the port by a slave answering after the timeout
+        port.input = b"\x01\x03"
+        self.assertEqual(
+            bus.transaction(bytes.fromhex("010300000002"), 9),
+            bytes.fromhex("04000203e8"),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serialization
+import simulator
+import utils
+
+SERIAL_NUMBER = serialization.Field("serial_number", "user_row", 0, "<I")
+
+
+class RecordSequenceTest(unittest.TestCase):
+    def setUp(self):
+        from intelhex import IntelHex
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "firmware.hex")
+        hexfile = IntelHex()
+        hexfile.frombytes(bytes(range(256)))
+        hexfile.write_hex_file(self.filename)
+
+        self.csv_filename = os.path.join(self.directory.name, "units.csv")
+        with open(self.csv_filename, "w") as csv_file:
+            csv_file.write("serial_number\n100\n101\n102\n")
+
+        self.serial_port = f"{simulator.SIMULATOR_PORT_PREFIX}serialization"
+        simulator.simulated_updi_targets[self.serial_port] = (
+            simulator.SimulatedUpdiTarget()
+        )
+
+    def tearDown(self):
+        utils.updi_sessions.close(self.serial_port)
+        simulator.simulated_updi_targets.pop(self.serial_port, None)
+        utils.clear_hex_cache()
+        self.directory.cleanup()
+
+    def _flash(self, serializer):
+        report = {}
+        utils.flash_file(
+            self.filename, self.serial_port, report=report, serializer=serializer
+        )
+        return report
+
+    def _flash_failing(self, serializer):
+        # the attempt fails once the record was taken, like a loose contact
+        with mock.patch.object(
+            simulator.SimulatedUpdiBackend,
+            "write_memory",
+            side_effect=IOError("UPDI transmission error"),
+        ):
+            return self._flash(serializer)
+
+    def test_csv_row_survives_a_failed_attempt(self):
+        serializer = serialization.Serializer(
+            [SERIAL_NUMBER], serialization.CsvSource(self.csv_filename)
+        )
+        reports = [
+            self._flash(serializer),
+            self._flash_failing(serializer),
+            self._flash(serializer),
+            self._flash(serializer),
+        ]
+
+        self.assertEqual(
+            [report["success"] for report in reports], [True, False, True, True]
+        )
+        self.assertEqual(
+            [report["unit_data"]["serial_number"] for report in reports],
+            ["100", "101", "101", "102"],
+        )
+
+    def test_counter_has_no_gap_after_a_failed_attempt(self):
+        serializer = serialization.Serializer(
+            [SERIAL_NUMBER], serialization.CounterSource(start=1000)
+        )
+        self._flash(serializer)
+        self._flash_failing(serializer)
+        reports = [self._flash(serializer), self._flash(serializer)]
+
+        self.assertEqual(
+            [report["unit_data"]["serial_number"] for report in reports],
+            [1001, 1002],
+        )
+
+
+class ApplyPatchesTest(unittest.TestCase):
+    def setUp(self):
+        from pymcuprog.deviceinfo.deviceinfo import getdeviceinfo
+        from pymcuprog.deviceinfo.deviceinfo import DeviceMemoryInfo
+
+        self.device_memory_info = DeviceMemoryInfo(getdeviceinfo("attiny202"))
+        memories = self.device_memory_info.mem_by_name
+        # the image of a hex file with flash and a part of the eeprom
+        self.flash = serialization.MemorySegment(
+            bytearray(range(64)), 0, memories["flash"]
+        )
+        self.eeprom = serialization.MemorySegment(
+            bytearray(b"\xaa" * 8), 8, memories["eeprom"]
+        )
+        self.segments = [self.flash, self.eeprom]
+
+    def _apply(self, patches):
+        return serialization.apply_patches(
+            self.segments, patches, self.device_memory_info
+        )
+
+    def _segments_of(self, segments, memory_name):
+        return [
+            (segment.offset, bytes(segment.data))
+            for segment in segments
+            if segment.memory_info["name"] == memory_name
+        ]
+
+    def test_no_patches_keeps_the_cached_segments(self):
+        self.assertIs(self._apply([]), self.segments)
+
+    def test_patched_segment_is_a_copy(self):
+        segments = self._apply([("eeprom", 10, b"\x01\x02")])
+
+        self.assertEqual(
+            self._segments_of(segments, "eeprom"),
+            [(8, b"\xaa\xaa\x01\x02\xaa\xaa\xaa\xaa")],
+        )
+        # the cached image is never modified, the other segments are shared
+        self.assertEqual(bytes(self.eeprom.data), b"\xaa" * 8)
+        self.assertIs(segments[0], self.flash)
+
+    def test_patches_outside_the_image_are_merged(self):
+        segments = self._apply(
+            [("user_row", 0, b"\x01\x02\x03\x04"), ("user_row", 6, b"\x05\x06")]
+        )
+        self.assertEqual(
+            self._segments_of(segments, "user_row"),
+            [(0, b"\x01\x02\x03\x04\xff\xff\x05\x06")],
+        )
+
+    def test_patches_around_hex_content_are_not_merged(self):
+        segments = self._apply([("eeprom", 0, b"\x01"), ("eeprom", 20, b"\x02")])
+        self.assertEqual(
+            self._segments_of(segments, "eeprom"),
+            [(8, b"\xaa" * 8), (0, b"\x01"), (20, b"\x02")],
+        )
+
+    def test_invalid_patches(self):
+        for patch in (
+            # crosses the end of the eeprom content of the hex file
+            ("eeprom", 14, b"\x01\x02\x03\x04"),
+            # beyond the 32 bytes of the user row
+            ("user_row", 30, b"\x01\x02\x03\x04"),
+            ("bootrow", 0, b"\x01"),
+        ):
+            with self.subTest(patch=patch):
+                with self.assertRaises(serialization.SerializationError):
+                    self._apply([patch])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import glob
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serialtrace
+import simulator
+import utils
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.bus = simulator.ModbusBusSimulator(
+            {
+                address: simulator.SimulatedProbe(init_time=0.05, test_time=0.1)
+                for address in (1, 2)
+            }
+        )
+        test_port = self.bus.start()
+
+        # a recorded test of the two probes
+        serialtrace.serial_capture.start(self.directory.name)
+        try:
+            self.recorded = utils.modbus_test_bus(test_port, [1, 2], deadline=5)
+        finally:
+            utils.modbus_pool.close_all()
+            serialtrace.serial_capture.stop()
+        (self.filename,) = glob.glob(
+            os.path.join(self.directory.name, f"modbus-*{serialtrace.TRACE_EXTENSION}")
+        )
+
+        patcher = mock.patch.object(serialtrace, "replay_speed", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        utils.modbus_pool.close_all()
+        self.bus.stop()
+        self.directory.cleanup()
+
+    def test_analyze(self):
+        info, records = serialtrace.read_trace(self.filename)
+        analysis = serialtrace.analyze_trace(self.filename)
+
+        self.assertEqual(info["kind"], "modbus")
+        self.assertEqual(analysis["kind"], "modbus")
+        writes = [
+            record for record in records if record.kind == serialtrace.TRACE_WRITE
+        ]
+        self.assertEqual(analysis["transactions"], len(writes))
+        self.assertEqual(
+            analysis["bytes_written"], sum(len(record.data) for record in writes)
+        )
+        # only the drain of the port when the connection is created
+        self.assertEqual(analysis["timeouts"], 1)
+        self.assertEqual(analysis["retries"], 0)
+        self.assertGreater(analysis["latency_p50"], 0)
+        self.assertIn(self.filename, serialtrace.format_analysis(analysis))
+
+    def test_replay_gives_the_recorded_results(self):
+        probe_results, _, remaining = serialtrace.replay_test(
+            self.filename, [1, 2], deadline=5
+        )
+
+        self.assertEqual(remaining, 0)
+        self.assertEqual(
+            {address: result.state for address, result in probe_results.items()},
+            {address: result.state for address, result in self.recorded.items()},
+        )
+        self.assertEqual(probe_results[1].state, utils.TestState.SUCCESS)
+
+    def test_replay_of_another_test_diverges(self):
+        with self.assertRaises(serialtrace.TraceError):
+            serialtrace.replay_test(self.filename, [3], deadline=5)
+
+    def test_truncated_trace_ends_on_its_last_record(self):
+        with open(self.filename, "rb") as trace_file:
+            content = trace_file.read()
+        truncated = os.path.join(self.directory.name, "truncated.trace")
+        with open(truncated, "wb") as trace_file:
+            trace_file.write(content[:-1])
+
+        _, records = serialtrace.read_trace(self.filename)
+        _, truncated_records = serialtrace.read_trace(truncated)
+        self.assertEqual(truncated_records, records[:-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simulator
+import utils
+
+
+class PooledUpdiSessionTest(unittest.TestCase):
+    def setUp(self):
+        from intelhex import IntelHex
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "firmware.hex")
+        hexfile = IntelHex()
+        hexfile.frombytes(bytes(range(256)) * 2)
+        hexfile.write_hex_file(self.filename)
+
+        self.serial_port = f"{simulator.SIMULATOR_PORT_PREFIX}test"
+        simulator.simulated_updi_targets[self.serial_port] = (
+            simulator.SimulatedUpdiTarget()
+        )
+
+    def tearDown(self):
+        utils.updi_sessions.close(self.serial_port)
+        simulator.simulated_updi_targets.pop(self.serial_port, None)
+        utils.clear_hex_cache()
+        self.directory.cleanup()
+
+    def test_flash_twice_on_one_session(self):
+        reports = [{}, {}]
+        self.assertTrue(
+            utils.flash_file(self.filename, self.serial_port, report=reports[0])
+        )
+        backend = utils.updi_sessions.get(
+            self.serial_port, utils.UPDI_DEVICE_DEFAULT, utils.UPDI_BAUDRATE_DEFAULT
+        ).backend
+        self.assertTrue(backend.session_active)
+
+        self.assertTrue(
+            utils.flash_file(self.filename, self.serial_port, report=reports[1]),
+            reports[1].get("error"),
+        )
+        session = utils.updi_sessions.get(
+            self.serial_port, utils.UPDI_DEVICE_DEFAULT, utils.UPDI_BAUDRATE_DEFAULT
+        )
+        self.assertIs(session.backend, backend)
+
+    def test_backend_release_from_reset_ends_the_session(self):
+        from pymcuprog.pymcuprog_errors import PymcuprogSessionError
+
+        backend = simulator.open_simulated_updi_backend(
+            self.serial_port,
+            utils.UPDI_DEVICE_DEFAULT,
+            utils.UPDI_BAUDRATE_DEFAULT,
+            1.0,
+        )
+        backend.release_from_reset()
+        with self.assertRaises(PymcuprogSessionError):
+            backend.read_device_id()
+
+
+if __name__ == "__main__":
+    unittest.main()
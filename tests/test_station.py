@@ -0,0 +1,134 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simulator
+import station
+import utils
+
+
+class StationLineTest(unittest.TestCase):
+    def setUp(self):
+        from intelhex import IntelHex
+
+        self.directory = tempfile.TemporaryDirectory()
+        hexfile = IntelHex()
+        hexfile.frombytes(bytes(range(256)))
+        hexfile.write_hex_file(os.path.join(self.directory.name, "firmware.hex"))
+
+        self.buses = []
+        self.servers = []
+        for name in ("a", "b"):
+            bus = simulator.ModbusBusSimulator(
+                {1: simulator.SimulatedProbe(init_time=0.05, test_time=0.1)}
+            )
+            self.buses.append(bus)
+            slots = [(f"{simulator.SIMULATOR_PORT_PREFIX}{name}", bus.start(), 1)]
+            server = station.StationServer(
+                ("127.0.0.1", 0),
+                station.StationAgent(
+                    name, slots, os.path.join(self.directory.name, name)
+                ),
+            )
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+
+    def _write_profile(self, source):
+        # source is the counter or the csv of the serialization
+        filename = os.path.join(self.directory.name, "line.json")
+        with open(filename, "w") as profile_file:
+            json.dump(
+                {
+                    "name": "line",
+                    "firmware": "firmware.hex",
+                    "test": {"deadline": 5},
+                    "serialization": dict(
+                        source,
+                        fields=[
+                            {
+                                "name": "serial_number",
+                                "memory": "user_row",
+                                "offset": 0,
+                                "format": "<I",
+                            }
+                        ],
+                    ),
+                },
+                profile_file,
+            )
+        return filename
+
+    def _run(self, profile_filename, units):
+        coordinator = station.Coordinator(
+            [server.server_address for server in self.servers]
+        )
+        try:
+            coordinator.push_profile(profile_filename)
+            return coordinator.run(units)
+        finally:
+            coordinator.close()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+            server.agent.pipeline.close()
+        utils.updi_sessions.close_all()
+        utils.modbus_pool.close_all()
+        for bus in self.buses:
+            bus.stop()
+        utils.clear_hex_cache()
+        self.directory.cleanup()
+
+    def test_serial_numbers_are_unique_across_stations(self):
+        profile_filename = self._write_profile(
+            {"counter": {"start": 1000, "state": "line.serial"}}
+        )
+        unit_results = self._run(profile_filename, 6)
+
+        self.assertEqual(
+            {unit_result["station"] for unit_result in unit_results}, {"a", "b"}
+        )
+        serial_numbers = sorted(
+            unit_result["unit_data"]["serial_number"] for unit_result in unit_results
+        )
+        self.assertEqual(serial_numbers, list(range(1000, 1006)))
+        # the counter is kept by the coordinator, next to its profile
+        with open(os.path.join(self.directory.name, "line.serial")) as state_file:
+            self.assertEqual(state_file.read(), "1006")
+
+    def test_csv_rows_are_read_by_the_coordinator(self):
+        with open(os.path.join(self.directory.name, "units.csv"), "w") as csv_file:
+            csv_file.write("serial_number\n" + "".join(f"{n}\n" for n in range(7, 11)))
+        unit_results = self._run(self._write_profile({"csv": "units.csv"}), 4)
+
+        self.assertTrue(
+            all(unit_result["test"]["success"] for unit_result in unit_results)
+        )
+        self.assertEqual(
+            sorted(
+                unit_result["unit_data"]["serial_number"]
+                for unit_result in unit_results
+            ),
+            ["10", "7", "8", "9"],
+        )
+
+    def test_station_refuses_a_serialization_source_of_its_own(self):
+        agent = self.servers[0].agent
+        with self.assertRaises(station.StationError):
+            agent.rpc_put_profile(
+                lambda event: None,
+                {
+                    "name": "line",
+                    "serialization": {"fields": [], "csv": "units.csv"},
+                },
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
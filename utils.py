@@ -1,39 +1,641 @@
-from pymcuprog.backend import Backend, SessionConfig
-from pymcuprog.toolconnection import ToolSerialConnection
-from pymcuprog.hexfileutils import read_memories_from_hex
-from pymcuprog.deviceinfo.memorynames import MemoryNameAliases
-from pymcuprog.deviceinfo.deviceinfokeys import DeviceMemoryInfoKeys
+# pymcuprog and minimalmodbus are imported on first use, or by warm_up, to show
+# the window sooner
+import serial
 import serial.tools.list_ports
-import minimalmodbus
 
+import metrics
 
-def modbus_connect(serial_port):
-    if (
-        not hasattr(modbus_connect, "instr")
-        or modbus_connect.instr.serial.port != serial_port
+import io
+import time
+import atexit
+import logging
+import os
+import hashlib
+import heapq
+import threading
+from functools import partial
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+# upper bound of concurrent flash sessions, one per UPDI adapter
+FLASH_MAX_WORKERS = 8
+
+UPDI_DEVICE_DEFAULT = "attiny202"
+UPDI_BAUDRATE_DEFAULT = 115200
+UPDI_BAUDRATE_AUTO = "auto"
+# tried in order by the auto negotiation, slowest first
+UPDI_BAUDRATES = (115200, 230400, 345600, 460800)
+# port -> fastest stable baud rate found by the auto negotiation
+_updi_baudrates = {}
+_updi_baudrates_lock = threading.Lock()
+
+# parsed hex images, shared by every flash session
+# path -> (mtime_ns, size, sha256 of the content)
+_hex_file_digests = {}
+# (sha256 of the content, device memory layout) -> memory segments, the least
+# recently used images go once there are more than HEX_CACHE_IMAGES, e.g. when a
+# shift swaps firmware or profiles
+HEX_CACHE_IMAGES = 4
+_hex_memory_segments = OrderedDict()
+# (sha256 of the content, device memory layout) -> (flash offset, checksum) or None
+_hex_flash_checksums = {}
+_hex_cache_lock = threading.Lock()
+_hex_cache_stats = {"hits": 0, "misses": 0}
+
+# flash verify, reading the whole image back or letting the device check the CRC
+# of its flash, other memories are always read back
+VERIFY_READBACK = "readback"
+VERIFY_CRC = "crc"
+VERIFY_MODES = (VERIFY_READBACK, VERIFY_CRC)
+# with the crc verify, every n-th device of an adapter is also read back
+VERIFY_AUDIT_INTERVAL = 50
+# port -> devices flashed with the crc verify
+_verify_counts = {}
+_verify_counts_lock = threading.Lock()
+
+# CRCSCAN of the tinyAVR 0/1 and megaAVR 0 series: CRC-16-CCITT of the whole
+# flash, OK when its last two bytes hold the checksum of the bytes before them
+CRCSCAN_CTRLA = 0x0120
+CRCSCAN_CTRLB = 0x0121
+CRCSCAN_STATUS = 0x0122
+CRCSCAN_CTRLA_ENABLE = 0x01
+CRCSCAN_CTRLB_SRC_FLASH = 0x00
+CRCSCAN_STATUS_BUSY = 0x01
+CRCSCAN_STATUS_OK = 0x02
+# the scan of a few KiB of flash takes well below a millisecond
+CRCSCAN_TIMEOUT = 0.1
+
+
+MODBUS_SLAVE_ADDRESS_DEFAULT = 1
+# connections unused for longer than this are closed, in seconds
+MODBUS_IDLE_TIMEOUT = 300
+
+# requests through minimalmodbus, or through rtu.py reading the exact length of
+# the answers and with the adapter in low latency mode
+MODBUS_TRANSPORT_MINIMALMODBUS = "minimalmodbus"
+MODBUS_TRANSPORT_RTU = "rtu"
+MODBUS_TRANSPORTS = (MODBUS_TRANSPORT_MINIMALMODBUS, MODBUS_TRANSPORT_RTU)
+
+# https://minimalmodbus.readthedocs.io/en/stable/usage.html#default-values
+ModbusSettings = namedtuple(
+    "ModbusSettings",
+    ["baudrate", "timeout", "transport"],
+    defaults=[MODBUS_TRANSPORT_MINIMALMODBUS],
+)
+MODBUS_SETTINGS_DEFAULT = ModbusSettings(baudrate=115200, timeout=0.05)
+
+# command coil, and the holding registers read with a single request, starting
+# from the state
+#   1 = state
+#   2 = error code of the last failed test
+#   3 = measurement of the last test
+#   4 = firmware version, major in the high byte and minor in the low byte
+MODBUS_COMMAND_COIL = 0
+MODBUS_STATUS_REGISTER = 1
+MODBUS_STATUS_REGISTERS = 4
+ModbusRegisters = namedtuple("ModbusRegisters", ["command", "status", "status_count"])
+MODBUS_REGISTERS_DEFAULT = ModbusRegisters(
+    command=MODBUS_COMMAND_COIL,
+    status=MODBUS_STATUS_REGISTER,
+    status_count=MODBUS_STATUS_REGISTERS,
+)
+
+
+# serial port prefix -> factory(serial_port, settings) of a serial port like object,
+# used instead of pyserial for those ports
+modbus_port_factories = {}
+
+
+class ModbusConnection:
+    # one open serial port, shared by the instruments of every slave on the bus
+
+    def __init__(self, serial_port, settings):
+        self.serial_port = serial_port
+        self.settings = settings
+        # held for the whole duration of a transaction on the bus
+        self.lock = threading.RLock()
+        self.instruments = {}
+        self.last_used = time.monotonic()
+        self.broken = False
+
+        import serialtrace
+
+        # ports served by something else, e.g. a recorded trace
+        for prefix, port_factory in modbus_port_factories.items():
+            if serial_port.startswith(prefix):
+                port = port_factory(serial_port, settings)
+                break
+        else:
+            port = serial.Serial(
+                port=serial_port,
+                baudrate=settings.baudrate,
+                parity=serial.PARITY_NONE,
+                bytesize=8,
+                stopbits=1,
+                timeout=settings.timeout,
+                write_timeout=2.0,
+            )
+        self.serial = serialtrace.serial_capture.wrap(port, serial_port, "modbus")
+        self.rtu_bus = None
+        if settings.transport == MODBUS_TRANSPORT_RTU:
+            import rtu
+
+            if not rtu.set_low_latency(port):
+                logger.info("no low latency mode on %s", serial_port)
+            self.rtu_bus = rtu.RtuBus(self.serial)
+
+        # consume input stream, once when the connection is created
+        self.serial.reset_input_buffer()
+        self.serial.readline()
+
+    def get_instrument(self, slave_address):
+        import minimalmodbus
+
+        instr = self.instruments.get(slave_address)
+        if instr is None:
+            if self.rtu_bus:
+                import rtu
+
+                instr = rtu.RtuInstrument(self.rtu_bus, slave_address)
+            else:
+                # port instance, slave address (in decimal)
+                instr = minimalmodbus.Instrument(self.serial, slave_address)
+            instr.connection = self
+            instr.registers = MODBUS_REGISTERS_DEFAULT
+            # older firmware only exposes the state register, detected on first read
+            instr.status_registers = instr.registers.status_count
+            self.instruments[slave_address] = instr
+        return instr
+
+    def is_healthy(self):
+        return not self.broken and self.serial.is_open
+
+    def close(self):
+        with self.lock:
+            self.serial.close()
+
+
+class ModbusPool:
+    def __init__(self, idle_timeout=MODBUS_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        # serial port -> connection, a port is open with a single setting at a time
+        self.connections = {}
+        self.lock = threading.Lock()
+        # serial port -> lock held while the port is opened, a slow or missing
+        # adapter only blocks the threads of its own bus
+        self.port_locks = {}
+
+    def _get_port_lock(self, serial_port):
+        with self.lock:
+            return self.port_locks.setdefault(serial_port, threading.Lock())
+
+    def get(self, serial_port, settings=MODBUS_SETTINGS_DEFAULT):
+        self.evict_idle()
+
+        with self._get_port_lock(serial_port):
+            with self.lock:
+                connection = self.connections.get(serial_port)
+                if connection and connection.settings == settings:
+                    if connection.is_healthy():
+                        return connection
+                if connection:
+                    del self.connections[serial_port]
+
+            if connection:
+                connection.close()
+
+            # opened and drained without the pool lock
+            connection = ModbusConnection(serial_port, settings)
+            with self.lock:
+                self.connections[serial_port] = connection
+            return connection
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            idle_connections = [
+                connection
+                for connection in self.connections.values()
+                if now - connection.last_used > self.idle_timeout
+            ]
+            for connection in idle_connections:
+                del self.connections[connection.serial_port]
+
+        for connection in idle_connections:
+            connection.close()
+
+    def close_all(self):
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+
+        for connection in connections:
+            connection.close()
+
+
+# open modbus buses, shared by every test
+modbus_pool = ModbusPool()
+atexit.register(modbus_pool.close_all)
+
+
+def modbus_connect(
+    serial_port,
+    slave_address=MODBUS_SLAVE_ADDRESS_DEFAULT,
+    settings=MODBUS_SETTINGS_DEFAULT,
+    registers=MODBUS_REGISTERS_DEFAULT,
+):
+    connection = modbus_pool.get(serial_port, settings)
+    with connection.lock:
+        instr = connection.get_instrument(slave_address)
+        if instr.registers != registers:
+            # another probe variant on the same address, detect its registers again
+            instr.registers = registers
+            instr.status_registers = registers.status_count
+        return instr
+
+
+@contextmanager
+def modbus_transaction(instr):
+    # serialize the requests of every thread sharing the bus of instr
+    connection = instr.connection
+    with connection.lock:
+        try:
+            yield instr
+        except serial.SerialException:
+            # the port itself failed, the pool reopens it on the next connect
+            connection.broken = True
+            raise
+        finally:
+            connection.last_used = time.monotonic()
+
+
+def parse_slave_addresses(text):
+    # "1-3, 7" -> [1, 2, 3, 7], raises ValueError on invalid input
+    slave_addresses = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if not 1 <= first <= last <= 247:
+            raise ValueError(f"Invalid slave address range: {part.strip()}")
+        slave_addresses.extend(
+            address
+            for address in range(first, last + 1)
+            if address not in slave_addresses
+        )
+    return slave_addresses
+
+
+class TestState:
+    INIT = 0
+    IN_PROGRESS = 1
+    FAILED = 2
+    SUCCESS = 3
+
+
+# state polling intervals, in seconds
+MODBUS_POLL_INTERVAL_MIN = 0.01
+MODBUS_POLL_INTERVAL_MAX = 0.5
+MODBUS_POLL_BACKOFF = 1.5
+
+
+class PollDurations:
+    # (bus, state) -> smoothed duration of that state on the previous tests of
+    # the bus, each bus has its own probes and is tested by its own thread
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+
+    def get(self, bus, state):
+        with self.lock:
+            return self.durations.get((bus, state))
+
+    def learn(self, bus, state, duration):
+        with self.lock:
+            previous = self.durations.get((bus, state))
+            self.durations[(bus, state)] = (
+                duration if previous is None else 0.8 * previous + 0.2 * duration
+            )
+
+
+# learned by every test, from every bus thread
+poll_durations = PollDurations()
+
+
+class PollScheduler:
+    # polls fast right after a command or a state change and around the time the
+    # current state ended on previous tests of the same bus, backs off while the
+    # state is stable
+
+    def __init__(
+        self,
+        bus=None,
+        interval_min=MODBUS_POLL_INTERVAL_MIN,
+        interval_max=MODBUS_POLL_INTERVAL_MAX,
+        backoff=MODBUS_POLL_BACKOFF,
+        durations=poll_durations,
     ):
-        # port name, slave address (in decimal)
-        modbus_connect.instr = minimalmodbus.Instrument(serial_port, 1)
-        # https://minimalmodbus.readthedocs.io/en/stable/usage.html#default-values
-        modbus_connect.instr.serial.baudrate = 115200
-        modbus_connect.instr.serial.timeout = 0.05  # 0.05
-        # modbus_connect.instr.close_port_after_each_call = True
+        self.bus = bus
+        self.durations = durations
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.backoff = backoff
+        self.interval = interval_min
+        self.state = None
+        self.state_since = time.monotonic()
+        self.last_poll = None
+
+    def transition(self, state, now):
+        # the change happened somewhere between the previous poll and this one
+        changed_at = (self.last_poll + now) / 2 if self.last_poll else now
+
+        # learn how long the previous state lasted
+        if self.state is not None:
+            self.durations.learn(self.bus, self.state, changed_at - self.state_since)
+
+        self.state = state
+        self.state_since = changed_at
+        self.interval = self.interval_min
 
-        # consume input stream
-        modbus_connect.instr.serial.reset_input_buffer()
-        modbus_connect.instr.serial.readline()
+    def next_interval(self, now):
+        self.last_poll = now
+        interval = self.interval
+        self.interval = min(self.interval * self.backoff, self.interval_max)
 
-    return modbus_connect.instr
+        expected = self.durations.get(self.bus, self.state)
+        if expected is not None:
+            # sleep until shortly before the expected end of the state, then
+            # stay fast until some time after it
+            window_start = self.state_since + expected * 0.8
+            window_end = self.state_since + expected * 1.5
+            if window_start - now > self.interval_min:
+                interval = min(interval, window_start - now)
+            elif now < window_end:
+                interval = self.interval_min
+
+        return interval
 
 
 def modbus_set_cmd(instr, v):
-    # register 0 = cmd
-    instr.write_bit(0, v)
+    with modbus_transaction(instr):
+        instr.write_bit(instr.registers.command, v)
 
 
 def modbus_get_state(instr):
-    # register 1 = state
-    return instr.read_register(1)
+    with modbus_transaction(instr):
+        return instr.read_register(instr.registers.status)
+
+
+ProbeStatus = namedtuple(
+    "ProbeStatus", ["state", "error_code", "measurement", "firmware_version"]
+)
+
+
+def decode_probe_status(registers):
+    # registers not exposed by the probe firmware are None
+    registers = list(registers[: len(ProbeStatus._fields)])
+    registers += [None] * (len(ProbeStatus._fields) - len(registers))
+    return ProbeStatus(*registers)
+
+
+def format_firmware_version(firmware_version):
+    return f"{firmware_version >> 8}.{firmware_version & 0xFF}"
+
+
+def modbus_get_status(instr):
+    import minimalmodbus
+
+    # older firmware only exposes the state register, remember it per instrument
+    status = instr.registers.status
+    count = instr.status_registers
+    with modbus_transaction(instr):
+        try:
+            registers = instr.read_registers(status, count)
+        except minimalmodbus.IllegalRequestError:
+            if count == 1:
+                raise
+            instr.status_registers = 1
+            registers = instr.read_registers(status, 1)
+    return decode_probe_status(registers)
+
+
+# phases of a probe test, timed from the first poll that sees each state
+TEST_STATE_PHASES = {
+    TestState.INIT: "init",
+    TestState.IN_PROGRESS: "self_test",
+}
+
+
+class ProbeTest:
+    # state machine of one probe under test, polled by whoever owns its bus
+
+    def __init__(self, instr, state_func=None, deadline=None):
+        self.instr = instr
+        self.state_func = state_func
+        self.deadline = deadline
+        self.scheduler = PollScheduler(instr.serial.port)
+        self.start = time.monotonic()
+        # seconds from the start to the result or the error of the probe
+        self.duration = None
+        self.state = -1
+        self.status = None
+        self.result = None
+        # (seconds since the start, state) of every state change
+        self.transitions = []
+
+    def poll(self):
+        # one bus transaction, returns the delay until the next poll or None once
+        # the probe reported a result. Raises TimeoutError after the deadline
+        try:
+            interval = self._poll()
+        except Exception:
+            self._record(False)
+            raise
+
+        if interval is None:
+            self._record(self.result.state == TestState.SUCCESS)
+        return interval
+
+    def _record(self, success):
+        now = time.monotonic()
+        self.duration = now - self.start
+        phases = {}
+        for (start, state), (end, _) in zip(
+            self.transitions, self.transitions[1:] + [(now - self.start, None)]
+        ):
+            phase = TEST_STATE_PHASES.get(state)
+            if phase:
+                phases[phase] = phases.get(phase, 0) + end - start
+
+        metrics.cycle_metrics.record_unit(
+            metrics.OPERATION_TEST,
+            self.instr.serial.port,
+            now - self.start,
+            success,
+            phases,
+        )
+
+    def _poll(self):
+        self.status = modbus_get_status(self.instr)
+        modbus_state = self.status.state
+        now = time.monotonic()
+
+        if modbus_state != self.state:
+            self.transitions.append((now - self.start, modbus_state))
+            self.scheduler.transition(modbus_state, now)
+            if self.state_func:
+                self.state_func(self.status)
+            self.state = modbus_state
+
+        if modbus_state == TestState.FAILED or modbus_state == TestState.SUCCESS:
+            self.result = self.status
+            return None
+
+        interval = self.scheduler.next_interval(now)
+        if self.deadline is not None:
+            remaining = self.start + self.deadline - now
+            if remaining <= 0:
+                raise TimeoutError(
+                    f"Test still in state {modbus_state} after {self.deadline}s"
+                )
+            interval = min(interval, remaining)
+
+        return interval
+
+
+def modbus_wait_result(instr, state_func=None, deadline=None, sleep_func=time.sleep):
+    # poll the test state until the probe reports a result, returns the final
+    # ProbeStatus. state_func(status) is called on every state change
+    # Raises TimeoutError once deadline seconds have passed without a result
+    probe_test = ProbeTest(instr, state_func, deadline)
+    while True:
+        interval = probe_test.poll()
+        if interval is None:
+            return probe_test.result
+        sleep_func(interval)
+
+
+def modbus_test_bus(
+    serial_port,
+    slave_addresses,
+    state_func=None,
+    deadline=None,
+    sleep_func=time.sleep,
+    settings=MODBUS_SETTINGS_DEFAULT,
+    registers=MODBUS_REGISTERS_DEFAULT,
+    durations=None,
+):
+    # test every probe on one bus, a single thread owns the bus so requests never
+    # collide. Returns slave address -> final ProbeStatus or the exception that
+    # stopped the test of that probe. state_func(slave_address, status) on state
+    # changes, sleep_func(seconds) may raise to stop the test of the whole bus
+    # durations, if given, is filled with slave address -> seconds the test of
+    # each probe lasted, from its start to its own result
+    results = {}
+    pending = []
+    if durations is None:
+        durations = {}
+
+    for slave_address in slave_addresses:
+        start = time.monotonic()
+        try:
+            instr = modbus_connect(serial_port, slave_address, settings, registers)
+            modbus_set_cmd(instr, 1)
+        except IOError as error:
+            results[slave_address] = error
+            durations[slave_address] = time.monotonic() - start
+            continue
+
+        probe_state_func = None
+        if state_func:
+            probe_state_func = partial(state_func, slave_address)
+        probe_test = ProbeTest(instr, probe_state_func, deadline)
+        heapq.heappush(pending, (time.monotonic(), slave_address, probe_test))
+
+    # always poll the probe that is due first
+    while pending:
+        due, slave_address, probe_test = heapq.heappop(pending)
+        delay = due - time.monotonic()
+        if delay > 0:
+            sleep_func(delay)
+
+        try:
+            interval = probe_test.poll()
+        except IOError as error:
+            results[slave_address] = error
+            durations[slave_address] = probe_test.duration
+            continue
+
+        if interval is None:
+            results[slave_address] = probe_test.result
+            durations[slave_address] = probe_test.duration
+        else:
+            heapq.heappush(
+                pending, (time.monotonic() + interval, slave_address, probe_test)
+            )
+
+    return results
+
+
+def modbus_test_buses(
+    buses, state_func=None, result_func=None, deadline=None, durations=None, **kwargs
+):
+    # buses is serial port -> slave addresses, every bus is tested in parallel
+    # state_func(serial_port, slave_address, status) and
+    # result_func(serial_port, slave_address, result) are called from the workers
+    # durations, if given, is filled with (serial port, slave address) -> seconds
+    # before result_func is called. kwargs are the modbus settings and registers
+    # of modbus_test_bus
+    def test_bus(serial_port, slave_addresses):
+        threading.current_thread().name = serial_port
+        bus_state_func = partial(state_func, serial_port) if state_func else None
+        bus_durations = {}
+        results = modbus_test_bus(
+            serial_port,
+            slave_addresses,
+            bus_state_func,
+            deadline,
+            durations=bus_durations,
+            **kwargs,
+        )
+        if durations is not None:
+            for slave_address, duration in bus_durations.items():
+                durations[(serial_port, slave_address)] = duration
+        if result_func:
+            for slave_address, result in results.items():
+                result_func(serial_port, slave_address, result)
+        return results
+
+    results = {}
+    if not buses:
+        return results
+
+    with ThreadPoolExecutor(max_workers=len(buses)) as executor:
+        futures = {
+            executor.submit(test_bus, serial_port, slave_addresses): serial_port
+            for serial_port, slave_addresses in buses.items()
+        }
+        for future in as_completed(futures):
+            serial_port = futures[future]
+            for slave_address, result in future.result().items():
+                results[(serial_port, slave_address)] = result
+
+    return results
+
+
+def warm_up():
+    # import the programming and modbus stacks ahead of the first job, from a
+    # background thread once the window is shown
+    import minimalmodbus
+    from pymcuprog.backend import Backend
+    from pymcuprog.hexfileutils import read_memories_from_hex
+    from pymcuprog.deviceinfo import deviceinfo
+
+    deviceinfo.getdeviceinfo(UPDI_DEVICE_DEFAULT)
 
 
 def get_formatted_serial_ports():
@@ -46,48 +648,830 @@ def get_port_from_formatted_serial_port(formatted_port):
     return formatted_port.split("(")[0].strip() if formatted_port else None
 
 
-def flash_file(filename, serial_port):
+class SerialPortWatcher:
+    # keeps one list of formatted serial ports up to date from a background thread
+    # change_func(ports, added, removed) is called from that thread on every change
+    # udev events are used when pyudev is available, diffed polling otherwise
+
+    def __init__(self, change_func=None, interval=1.0):
+        self.change_func = change_func
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.ports = get_formatted_serial_ports()
+
+    def get_ports(self):
+        with self.lock:
+            return list(self.ports)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run, name="serial port watcher", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def rescan(self):
+        ports = get_formatted_serial_ports()
+        with self.lock:
+            added = [port for port in ports if port not in self.ports]
+            removed = [port for port in self.ports if port not in ports]
+            self.ports = ports
+
+        if (added or removed) and self.change_func:
+            self.change_func(ports, added, removed)
+
+    def _run(self):
+        try:
+            import pyudev
+
+            context = pyudev.Context()
+            monitor = pyudev.Monitor.from_netlink(context)
+            monitor.filter_by("tty")
+            monitor.start()
+        except (ImportError, OSError):
+            monitor = None
+
+        while not self.stopped.is_set():
+            if monitor is None:
+                self.stopped.wait(self.interval)
+            elif monitor.poll(timeout=self.interval) is None:
+                continue
+            else:
+                # hotplug events come in bursts, scan once they settled
+                while monitor.poll(timeout=0.2) is not None:
+                    pass
+
+            if not self.stopped.is_set():
+                self.rescan()
+
+
+def _get_memory_layout(device_memory_info):
+    from pymcuprog.deviceinfo.deviceinfokeys import DeviceMemoryInfoKeys
+
+    # everything read_memories_from_hex uses to split the hex file into segments
+    return tuple(
+        sorted(
+            (
+                name,
+                info[DeviceMemoryInfoKeys.ADDRESS],
+                info[DeviceMemoryInfoKeys.SIZE],
+                info[DeviceMemoryInfoKeys.HEXFILE_ADDRESS],
+                info[DeviceMemoryInfoKeys.HEXFILE_SIZE],
+            )
+            for name, info in device_memory_info.mem_by_name.items()
+        )
+    )
+
+
+def read_memories_from_hex_cached(filename, device_memory_info):
+    # the returned segments are shared between sessions, never modify them
+    stat = os.stat(filename)
+    layout = _get_memory_layout(device_memory_info)
+
+    with _hex_cache_lock:
+        digest = _hex_file_digests.get(filename)
+        if digest and digest[:2] == (stat.st_mtime_ns, stat.st_size):
+            memory_segments = _hex_memory_segments.get((digest[2], layout))
+            if memory_segments is not None:
+                _hex_memory_segments.move_to_end((digest[2], layout))
+                _hex_cache_stats["hits"] += 1
+                return memory_segments
+
+    # the file changed on disk, or it was never parsed for this memory layout
+    with open(filename, "rb") as hexfile:
+        content = hexfile.read()
+    sha256 = hashlib.sha256(content).hexdigest()
+
+    with _hex_cache_lock:
+        # a touched file with the same content is still a hit
+        memory_segments = _hex_memory_segments.get((sha256, layout))
+        if memory_segments is None:
+            from pymcuprog.hexfileutils import read_memories_from_hex
+
+            memory_segments = read_memories_from_hex(
+                io.StringIO(content.decode("ascii")), device_memory_info
+            )
+            _hex_memory_segments[(sha256, layout)] = memory_segments
+            _hex_cache_stats["misses"] += 1
+            while len(_hex_memory_segments) > HEX_CACHE_IMAGES:
+                key, _ = _hex_memory_segments.popitem(last=False)
+                _hex_flash_checksums.pop(key, None)
+        else:
+            _hex_memory_segments.move_to_end((sha256, layout))
+            _hex_cache_stats["hits"] += 1
+        _hex_file_digests[filename] = (stat.st_mtime_ns, stat.st_size, sha256)
+
+    return memory_segments
+
+
+def get_hex_cache_stats():
+    with _hex_cache_lock:
+        return dict(_hex_cache_stats, images=len(_hex_memory_segments))
+
+
+def get_hex_file_sha256(filename):
+    # content hash of a hex file already read by read_memories_from_hex_cached
+    with _hex_cache_lock:
+        digest = _hex_file_digests.get(filename)
+    return digest[2] if digest else None
+
+
+def clear_hex_cache():
+    with _hex_cache_lock:
+        _hex_file_digests.clear()
+        _hex_memory_segments.clear()
+        _hex_flash_checksums.clear()
+        _hex_cache_stats.update(hits=0, misses=0)
+
+
+def crc16_ccitt(data, crc=0xFFFF):
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+
+def get_flash_checksum(filename, device_memory_info):
+    # (flash offset, checksum bytes) to write at the end of the flash for the
+    # CRCSCAN, None when the hex file itself uses the last two bytes
+    from pymcuprog.deviceinfo.memorynames import MemoryNames
+    from pymcuprog.deviceinfo.deviceinfokeys import DeviceMemoryInfoKeys
+
+    memory_segments = read_memories_from_hex_cached(filename, device_memory_info)
+    key = (get_hex_file_sha256(filename), _get_memory_layout(device_memory_info))
+    with _hex_cache_lock:
+        if key in _hex_flash_checksums:
+            return _hex_flash_checksums[key]
+
+    # the unused flash is left erased
+    size = device_memory_info.mem_by_name[MemoryNames.FLASH][DeviceMemoryInfoKeys.SIZE]
+    image = bytearray([0xFF]) * size
+    checksum = (size - 2, None)
+    for segment in memory_segments:
+        if segment.memory_info[DeviceMemoryInfoKeys.NAME] != MemoryNames.FLASH:
+            continue
+        image[segment.offset : segment.offset + len(segment.data)] = segment.data
+        if segment.offset + len(segment.data) > size - 2:
+            checksum = None
+
+    if checksum:
+        # stored most significant byte first
+        checksum = (size - 2, crc16_ccitt(image[:-2]).to_bytes(2, "big"))
+
+    with _hex_cache_lock:
+        _hex_flash_checksums[key] = checksum
+    return checksum
+
+
+def _is_audit_due(serial_port, audit_interval):
+    with _verify_counts_lock:
+        count = _verify_counts.get(serial_port, 0)
+        _verify_counts[serial_port] = count + 1
+    return bool(audit_interval) and count % audit_interval == 0
+
+
+def _crcscan_flash(backend):
+    # True when the CRC of the flash computed by the device matches the checksum
+    # at its end, only a couple of bytes go through the UPDI link
+    readwrite = backend.programmer.get_device_model().avr.readwrite
+    readwrite.write_byte(CRCSCAN_CTRLB, CRCSCAN_CTRLB_SRC_FLASH)
+    readwrite.write_byte(CRCSCAN_CTRLA, CRCSCAN_CTRLA_ENABLE)
+
+    deadline = time.monotonic() + CRCSCAN_TIMEOUT
+    while True:
+        status = readwrite.read_byte(CRCSCAN_STATUS)
+        if not status & CRCSCAN_STATUS_BUSY:
+            return bool(status & CRCSCAN_STATUS_OK)
+        if time.monotonic() > deadline:
+            return False
+
+
+@contextmanager
+def _timed(timings, phase):
+    # add the time spent in the block to timings[phase]
+    start = time.perf_counter()
     try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0) + time.perf_counter() - start
+
+
+def _verify_memory(backend, data, memory_name, offset):
+    # verify may pad the data in place, keep the cached segment intact
+    if not backend.verify_memory(data[:], memory_name, offset):
+        raise ValueError(f"Verify failed for {memory_name} memory")
+
+
+def _get_differing_ranges(data, data_read, offset, page_size):
+    # (start, end) memory offsets of the runs of pages whose content differs
+    ranges = []
+    page = offset - offset % page_size
+    while page < offset + len(data):
+        start = max(page, offset)
+        end = min(page + page_size, offset + len(data))
+        if (
+            data[start - offset : end - offset]
+            != data_read[start - offset : end - offset]
+        ):
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        page += page_size
+    return ranges
+
+
+def _write_memory_segments_incremental(backend, memory_segments, progress, timings):
+    from pymcuprog.deviceinfo.memorynames import MemoryNames
+    from pymcuprog.deviceinfo.deviceinfokeys import DeviceMemoryInfoKeys
+
+    # flash offset -> byte of every flash segment, a page may hold more segments
+    flash_image = {}
+    flash_pages = set()
+    flash_info = None
+
+    for segment in memory_segments:
+        memory_info = segment.memory_info
+        memory_name = memory_info[DeviceMemoryInfoKeys.NAME]
+        page_size = memory_info[DeviceMemoryInfoKeys.PAGE_SIZE]
+
+        # a single read tells if the segment is already programmed
+        progress(f"reading {memory_name}")
+        with _timed(timings, "verify"):
+            data_read = backend.read_memory(
+                memory_name, segment.offset, len(segment.data)
+            )[0].data
+        ranges = _get_differing_ranges(
+            bytearray(segment.data), data_read, segment.offset, page_size
+        )
+
+        if memory_name == MemoryNames.FLASH:
+            # flash pages are erased before writing, rewrite them as a whole
+            flash_info = memory_info
+            flash_image.update(
+                zip(
+                    range(segment.offset, segment.offset + len(segment.data)),
+                    segment.data,
+                )
+            )
+            for start, end in ranges:
+                flash_pages.update(range(start - start % page_size, end, page_size))
+            continue
+
+        if not ranges:
+            progress(f"{memory_name} up to date")
+            continue
+
+        # the other memories are written with an erase/write command
+        progress(f"rewriting {len(ranges)} ranges of {memory_name}")
+        for start, end in ranges:
+            data = segment.data[start - segment.offset : end - segment.offset]
+            with _timed(timings, "write"):
+                backend.write_memory(data, memory_name, start)
+            with _timed(timings, "verify"):
+                _verify_memory(backend, data, memory_name, start)
+
+    if flash_info is None:
+        return
+    if not flash_pages:
+        progress(f"{MemoryNames.FLASH} up to date")
+        return
+
+    progress(f"rewriting {len(flash_pages)} pages of {MemoryNames.FLASH}")
+    address = flash_info[DeviceMemoryInfoKeys.ADDRESS]
+    page_size = flash_info[DeviceMemoryInfoKeys.PAGE_SIZE]
+    nvm = backend.programmer.get_device_model().avr.nvm
+
+    # erase and write each run of consecutive pages at once
+    runs = []
+    for page in sorted(flash_pages):
+        if runs and runs[-1][1] == page:
+            runs[-1][1] = page + page_size
+        else:
+            runs.append([page, page + page_size])
+    for start, end in runs:
+        with _timed(timings, "erase"):
+            for page in range(start, end, page_size):
+                nvm.erase_flash_page(address + page)
+        # bytes outside the hex file are left erased, like after a chip erase
+        data = bytearray(flash_image.get(offset, 0xFF) for offset in range(start, end))
+        with _timed(timings, "write"):
+            backend.write_memory(data, MemoryNames.FLASH, start)
+        with _timed(timings, "verify"):
+            _verify_memory(backend, data, MemoryNames.FLASH, start)
+
+
+# serial port prefix -> factory(serial_port, device, baudrate, timeout) of a
+# backend in programming mode, used instead of pymcuprog for those ports
+updi_backend_factories = {}
+
+
+class UpdiSession:
+    # a tool connection kept open on one UPDI adapter across consecutive devices
+
+    def __init__(self, serial_port, device, baudrate=115200, timeout=1.0):
+        self.serial_port = serial_port
+        self.device = device
+        self.baudrate = baudrate
+        self.timeout = timeout
+        # held by whoever is programming through this adapter
+        self.lock = threading.Lock()
+        self.backend = None
+        self.in_progmode = False
+
+    def get_config(self):
+        return (self.device, self.baudrate, self.timeout)
+
+    def open(self):
+        from pymcuprog.backend import Backend, SessionConfig
+        from pymcuprog.toolconnection import ToolSerialConnection
+
+        # ports served by another backend, e.g. a simulated target
+        for prefix, backend_factory in updi_backend_factories.items():
+            if self.serial_port.startswith(prefix):
+                self.backend = backend_factory(
+                    self.serial_port, self.device, self.baudrate, self.timeout
+                )
+                self.in_progmode = True
+                return
+
         # instantiate backend
         backend = Backend()
 
         # setup tool connection
         transport = ToolSerialConnection(
-            serialport=serial_port, baudrate=115200, timeout=1.0
+            serialport=self.serial_port, baudrate=self.baudrate, timeout=self.timeout
+        )
+
+        try:
+            # connect to tool using transport
+            # this can trigger a PymcuprogToolConnectionError exception
+            backend.connect_to_tool(transport)
+
+            # start the session, this opens the serial port and enters programming mode
+            # this can trigger one of the following exceptions:
+            #   PymcuprogDeviceLockedError
+            #   PymcuprogNotSupportedError
+            #   PymcuprogSessionConfigError
+            backend.start_session(SessionConfig(self.device))
+        except Exception:
+            _close_backend(backend)
+            raise
+
+        self.backend = backend
+        self.in_progmode = True
+        self._trace()
+
+    def _trace(self):
+        # the traffic after the session start, a double break reopens the port
+        import serialtrace
+
+        phy = self.backend.programmer.get_device_model().avr.phy
+        if not isinstance(phy.ser, serialtrace.TracingSerial):
+            phy.ser = serialtrace.serial_capture.wrap(phy.ser, self.serial_port, "updi")
+
+    def begin(self):
+        # enter programming mode on the device currently attached to the adapter
+        if self.backend is None:
+            self.open()
+        elif not self.in_progmode:
+            try:
+                avr = self.backend.programmer.get_device_model().avr
+                # the previous device disabled its UPDI when it was released
+                avr.readwrite.datalink.init_datalink()
+                avr.read_device_info()
+                self.backend.programmer.start()
+                self.in_progmode = True
+                self._trace()
+            except Exception as error:
+                # stale session, e.g. the adapter was unplugged: rebuild it
+                logger.warning(
+                    "%s: rebuilding the UPDI session, %s", self.serial_port, error
+                )
+                self.close()
+                self.open()
+
+        return self.backend
+
+    def end(self):
+        # leave programming mode, the device is released from reset
+        if self.backend is None or not self.in_progmode:
+            return
+
+        self.in_progmode = False
+        try:
+            # through the programmer: Backend.release_from_reset also ends the
+            # session, and every later call on the backend would then fail
+            self.backend.programmer.release_from_reset()
+        except Exception as error:
+            logger.warning("%s: release from reset failed, %s", self.serial_port, error)
+            self.close()
+
+    def abort(self):
+        # called without the lock, from another thread: closing the serial port
+        # makes the blocking call of the programming thread fail right away
+        backend = self.backend
+        if backend is None:
+            return
+        try:
+            backend.programmer.get_device_model().avr.phy.ser.close()
+        except AttributeError:
+            pass
+
+    def close(self):
+        if self.backend is None:
+            return
+
+        backend, self.backend = self.backend, None
+        if self.in_progmode:
+            self.in_progmode = False
+            try:
+                backend.end_session()
+            except Exception as error:
+                logger.warning(
+                    "%s: ending the session failed, %s", self.serial_port, error
+                )
+        else:
+            # the device already left programming mode, only the housekeeping is left
+            backend.session_active = False
+        _close_backend(backend)
+
+
+def _close_backend(backend):
+    # pymcuprog only closes the serial port when the UPDI stack is collected
+    try:
+        backend.programmer.get_device_model().avr.phy.ser.close()
+    except AttributeError:
+        pass
+    backend.disconnect_from_tool()
+
+
+class UpdiSessionPool:
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, serial_port, device, baudrate=115200, timeout=1.0):
+        with self.lock:
+            session = self.sessions.get(serial_port)
+            if session and session.get_config() == (device, baudrate, timeout):
+                return session
+
+            stale_session = session
+            session = UpdiSession(serial_port, device, baudrate, timeout)
+            self.sessions[serial_port] = session
+
+        if stale_session:
+            with stale_session.lock:
+                stale_session.close()
+        return session
+
+    def close(self, serial_port):
+        with self.lock:
+            session = self.sessions.pop(serial_port, None)
+
+        if session:
+            with session.lock:
+                session.close()
+
+    def abort(self, serial_port):
+        # the aborted session is rebuilt by its next begin
+        with self.lock:
+            session = self.sessions.get(serial_port)
+
+        if session:
+            session.abort()
+
+    def close_all(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+
+        for session in sessions:
+            with session.lock:
+                session.close()
+
+
+# one session per UPDI adapter, reused by every flash on that port
+updi_sessions = UpdiSessionPool()
+atexit.register(updi_sessions.close_all)
+
+
+def negotiate_updi_baudrate(serial_port, device, progress_func=None):
+    from pymcuprog.deviceinfo.memorynames import MemoryNames
+
+    # try progressively faster baud rates on the attached device and keep the
+    # fastest one that still works, None if not even the slowest one does
+    progress = progress_func or (lambda stage: None)
+
+    best_baudrate = None
+    for baudrate in UPDI_BAUDRATES:
+        progress(f"trying {baudrate} baud")
+        session = updi_sessions.get(serial_port, device, baudrate)
+        with session.lock:
+            try:
+                backend = session.begin()
+                backend.read_device_id()
+                # a bulk read, single register accesses rarely fail
+                backend.read_memory(MemoryNames.FLASH, 0, 256)
+            except Exception as error:
+                logger.warning("%s: %d baud failed, %s", serial_port, baudrate, error)
+                session.close()
+                break
+            finally:
+                session.end()
+        best_baudrate = baudrate
+
+    if best_baudrate:
+        logger.info("Fastest stable baud rate on %s: %d", serial_port, best_baudrate)
+        with _updi_baudrates_lock:
+            _updi_baudrates[serial_port] = best_baudrate
+    return best_baudrate
+
+
+def get_updi_baudrate(serial_port, device, progress_func=None):
+    with _updi_baudrates_lock:
+        baudrate = _updi_baudrates.get(serial_port)
+    if baudrate is None:
+        baudrate = negotiate_updi_baudrate(serial_port, device, progress_func)
+    return baudrate or UPDI_BAUDRATE_DEFAULT
+
+
+def forget_updi_baudrate(serial_port):
+    with _updi_baudrates_lock:
+        _updi_baudrates.pop(serial_port, None)
+
+
+def is_transient_flash_error(error):
+    # a loose contact or a busy adapter, worth another attempt, unlike a locked
+    # device or a failed verify
+    from pymcuprog.pymcuprog_errors import (
+        PymcuprogSerialUpdiProtocolError,
+        PymcuprogToolConnectionError,
+    )
+
+    return isinstance(
+        error,
+        (OSError, PymcuprogSerialUpdiProtocolError, PymcuprogToolConnectionError),
+    )
+
+
+def flash_file(
+    filename,
+    serial_port,
+    progress_func=None,
+    incremental=False,
+    baudrate=UPDI_BAUDRATE_DEFAULT,
+    report=None,
+    device=UPDI_DEVICE_DEFAULT,
+    verify=VERIFY_READBACK,
+    audit_interval=VERIFY_AUDIT_INTERVAL,
+    serializer=None,
+    record_metrics=True,
+):
+    # progress_func(stage) is called before each programming stage
+    # report, if given, is a dict filled with the device id, the firmware hash,
+    # the verify used, the seconds spent in each phase and the error that stopped
+    # the flash. With the crc verify every audit_interval-th device of the port is
+    # also read back. serializer, a serialization.Serializer, patches the data of
+    # each unit over the image of the hex file. record_metrics is False when the
+    # caller records the unit itself, e.g. once after its retries
+    progress = progress_func or (lambda stage: None)
+    if report is None:
+        report = {}
+    timings = report.setdefault("timings", {})
+    report.update(firmware_file=filename, success=False)
+    start = time.perf_counter()
+
+    # configure the session
+    auto_baudrate = baudrate == UPDI_BAUDRATE_AUTO
+
+    try:
+        if auto_baudrate:
+            with _timed(timings, "negotiate"):
+                baudrate = get_updi_baudrate(serial_port, device, progress)
+        session = updi_sessions.get(serial_port, device, baudrate)
+
+        report["baudrate"] = baudrate
+
+        with session.lock:
+            try:
+                progress("connecting")
+                # tool connection and start_session, or only re-entering
+                # programming mode when the session is reused
+                with _timed(timings, "session"):
+                    backend = session.begin()
+                audit = verify == VERIFY_CRC and _is_audit_due(
+                    serial_port, audit_interval
+                )
+                _program_device(
+                    backend,
+                    filename,
+                    progress,
+                    incremental,
+                    report,
+                    verify,
+                    audit,
+                    serializer,
+                )
+            finally:
+                with _timed(timings, "release"):
+                    session.end()
+    except Exception as error:
+        logger.warning("%s: flash failed, %s", serial_port, error)
+        report["error"] = str(error) or type(error).__name__
+        report["transient"] = is_transient_flash_error(error)
+        if serializer and report.get("unit_data") is not None:
+            # the next attempt or the next unit gets the record of this one
+            serializer.release(report["unit_data"])
+        if auto_baudrate:
+            # negotiate again on the next device, starting from the slowest rate
+            forget_updi_baudrate(serial_port)
+    else:
+        report["success"] = True
+
+    if record_metrics:
+        metrics.cycle_metrics.record_unit(
+            metrics.OPERATION_FLASH,
+            serial_port,
+            time.perf_counter() - start,
+            report["success"],
+            timings,
         )
+    return report["success"]
+
 
-        # connect to tool using transport
-        # this can trigger a PymcuprogToolConnectionError exception
-        backend.connect_to_tool(transport)
+def _program_device(
+    backend,
+    filename,
+    progress,
+    incremental,
+    report,
+    verify=VERIFY_READBACK,
+    audit=False,
+    serializer=None,
+):
+    from pymcuprog.deviceinfo.memorynames import MemoryNames, MemoryNameAliases
+    from pymcuprog.deviceinfo.deviceinfokeys import DeviceMemoryInfoKeys
 
-        # configure the session
-        device = "attiny202"
-        sessionconfig = SessionConfig(device)
+    timings = report["timings"]
 
-        # start the session
-        # this can trigger one of the following exceptions:
-        #   PymcuprogDeviceLockedError
-        #   PymcuprogNotSupportedError
-        #   PymcuprogSessionConfigError
-        backend.start_session(sessionconfig)
+    # ping the device
+    with _timed(timings, "device_id"):
+        report["device_id"] = bytes(backend.read_device_id()).hex()
 
-        # ping the device
-        device_id = backend.read_device_id()
+    memory_segments = read_memories_from_hex_cached(
+        filename, backend.device_memory_info
+    )
+    report["firmware_sha256"] = get_hex_file_sha256(filename)
 
-        # erase before write
+    if serializer:
+        import serialization
+
+        # only the segments holding the data of this unit are copied
+        with _timed(timings, "serialize"):
+            report["unit_data"], patches = serializer.next_unit(report)
+            memory_segments = serialization.apply_patches(
+                memory_segments, patches, backend.device_memory_info
+            )
+        logger.info("unit data: %s", report["unit_data"])
+
+    report["verify"] = VERIFY_READBACK
+    if incremental:
+        # compare before touching the device, rewrite only what differs, the
+        # flash is read anyway
+        _write_memory_segments_incremental(backend, memory_segments, progress, timings)
+        return
+
+    checksum = None
+    if verify == VERIFY_CRC:
+        checksum = get_flash_checksum(filename, backend.device_memory_info)
+        if checksum is None:
+            logger.warning("no room for the flash checksum, reading back instead")
+
+    # erase before write
+    progress("erasing")
+    with _timed(timings, "erase"):
         backend.erase(MemoryNameAliases.ALL, address=None)
 
-        # write content of list of memory segments
-        memory_segments = read_memories_from_hex(filename, backend.device_memory_info)
-        for segment in memory_segments:
-            memory_name = segment.memory_info[DeviceMemoryInfoKeys.NAME]
-            # write
+    # write content of list of memory segments
+    for segment in memory_segments:
+        memory_name = segment.memory_info[DeviceMemoryInfoKeys.NAME]
+        # write
+        progress(f"writing {memory_name}")
+        write_start = time.perf_counter()
+        with _timed(timings, "write"):
             backend.write_memory(segment.data, memory_name, segment.offset)
-            # verify
-            backend.verify_memory(segment.data, memory_name, segment.offset)
-    except Exception as error:
-        # if the exception is important, it was then handled by the logger
-        print(error)
-        return False
+        if checksum and memory_name == MemoryNames.FLASH and not audit:
+            logger.info(
+                "%s: %d bytes, write %.0f B/s",
+                memory_name,
+                len(segment.data),
+                len(segment.data) / max(time.perf_counter() - write_start, 1e-6),
+            )
+            continue
+        # verify
+        progress(f"verifying {memory_name}")
+        verify_start = time.perf_counter()
+        with _timed(timings, "verify"):
+            _verify_memory(backend, segment.data, memory_name, segment.offset)
+        verify_end = time.perf_counter()
+
+        logger.info(
+            "%s: %d bytes, write %.0f B/s, verify %.0f B/s",
+            memory_name,
+            len(segment.data),
+            len(segment.data) / max(verify_start - write_start, 1e-6),
+            len(segment.data) / max(verify_end - verify_start, 1e-6),
+        )
+
+    if checksum:
+        _verify_flash_crc(backend, memory_segments, checksum, progress, report, audit)
+
+
+def _verify_flash_crc(backend, memory_segments, checksum, progress, report, audit):
+    from pymcuprog.deviceinfo.memorynames import MemoryNames
+    from pymcuprog.deviceinfo.deviceinfokeys import DeviceMemoryInfoKeys
+
+    timings = report["timings"]
+    offset, data = checksum
+    with _timed(timings, "write"):
+        backend.write_memory(bytearray(data), MemoryNames.FLASH, offset)
+
+    progress(f"verifying {MemoryNames.FLASH} crc")
+    with _timed(timings, "verify"):
+        crc_ok = _crcscan_flash(backend)
+    if crc_ok:
+        report["verify"] = VERIFY_CRC + "+" + VERIFY_READBACK if audit else VERIFY_CRC
+        return
+
+    if audit:
+        # the flash was read back already, the scan can't be trusted on this device
+        logger.warning("flash crc mismatch on a verified image")
+        return
+
+    # tell a bad image from a scan that did not run
+    logger.warning("flash crc mismatch, reading back instead")
+    progress(f"verifying {MemoryNames.FLASH}")
+    with _timed(timings, "verify"):
+        for segment in memory_segments:
+            if segment.memory_info[DeviceMemoryInfoKeys.NAME] == MemoryNames.FLASH:
+                _verify_memory(backend, segment.data, MemoryNames.FLASH, segment.offset)
+
+
+def flash_file_batch(
+    filename,
+    serial_ports,
+    progress_func=None,
+    result_func=None,
+    max_workers=FLASH_MAX_WORKERS,
+    reports=None,
+    **kwargs,
+):
+    # progress_func(serial_port, stage) and result_func(serial_port, success) are
+    # called from the worker threads, as soon as each port makes progress
+    # reports, if given, is a dict filled with serial port -> flash_file report
+    # before result_func is called. kwargs are passed through to flash_file
+    def flash_port(serial_port):
+        # name the worker after its port, so log records can be told apart
+        threading.current_thread().name = serial_port
+
+        if reports is not None:
+            kwargs_port = dict(kwargs, report=reports.setdefault(serial_port, {}))
+        else:
+            kwargs_port = kwargs
+
+        if progress_func:
+            success = flash_file(
+                filename,
+                serial_port,
+                lambda stage: progress_func(serial_port, stage),
+                **kwargs_port,
+            )
+        else:
+            success = flash_file(filename, serial_port, **kwargs_port)
+
+        if result_func:
+            result_func(serial_port, success)
+        return success
+
+    results = {}
+    if not serial_ports:
+        return results
+
+    # every port runs its own backend session, bounded by the number of workers
+    workers = min(max_workers, len(serial_ports))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(flash_port, port): port for port in serial_ports}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
 
-    return True
+    return results